@@ -0,0 +1,123 @@
+"""Benchmark del camino real de envío contra la Graph API falsa (services/fake_graph).
+
+Encola N mensajes de texto en el OutboundDispatcher (graph_client keep-alive,
+token bucket por número, reintentos con backoff) y mide throughput, latencia
+encolado->aceptado, reintentos y conexiones abiertas. Sin red ni Meta.
+
+Uso:
+    # 1) levantar la Graph API falsa (o: docker compose --profile loadtest up fake_graph)
+    PYTHONPATH=. uvicorn services.fake_graph.app:app --port 9000
+    # 2) correr el benchmark
+    PYTHONPATH=. python scripts/bench_send_path.py --base-url http://localhost:9000 \\
+        --messages 2000 --recipients 200 [--latency-ms 150 --rate-429 0.02 --rate-5xx 0.01]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+
+def _parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser()
+    p.add_argument("--base-url", default="http://localhost:9000")
+    p.add_argument("--messages", type=int, default=2000)
+    p.add_argument("--recipients", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=None, help="OUTBOUND_CONCURRENCY")
+    p.add_argument("--rate-per-s", type=float, default=None, help="OUTBOUND_RATE_PER_NUMBER_PER_S")
+    p.add_argument("--latency-ms", type=int, default=None)
+    p.add_argument("--latency-jitter-ms", type=int, default=None)
+    p.add_argument("--rate-429", type=float, default=None)
+    p.add_argument("--rate-5xx", type=float, default=None)
+    return p.parse_args()
+
+
+def _configure_env(args: argparse.Namespace) -> None:
+    # Antes de importar services.api.*: Settings se lee al importar
+    os.environ["WHATSAPP_GRAPH_BASE_URL"] = args.base_url
+    os.environ.setdefault("WHATSAPP_PHONE_NUMBER_ID", "100000000000001")
+    os.environ.setdefault("WHATSAPP_ACCESS_TOKEN", "fake-token")
+    os.environ["DELIVERY_TRACKING_ENABLED"] = "0"
+    if args.concurrency is not None:
+        os.environ["OUTBOUND_CONCURRENCY"] = str(args.concurrency)
+    if args.rate_per_s is not None:
+        os.environ["OUTBOUND_RATE_PER_NUMBER_PER_S"] = str(args.rate_per_s)
+        os.environ["OUTBOUND_BURST_PER_NUMBER"] = str(max(1, int(args.rate_per_s)))
+
+
+async def _run(args: argparse.Namespace) -> int:
+    from services.common.metrics import metrics
+    from services.api.graph_client import graph_client
+    from services.api.outbound_dispatcher import PRIORITY_INTERACTIVE
+    from services.api.settings import settings
+    from services.api.whatsapp_cloud import dispatcher
+
+    fake_config = {
+        k: v
+        for k, v in {
+            "latency_ms": args.latency_ms,
+            "latency_jitter_ms": args.latency_jitter_ms,
+            "rate_429": args.rate_429,
+            "rate_5xx": args.rate_5xx,
+        }.items()
+        if v is not None
+    }
+    client = graph_client.client
+    await client.delete(f"{args.base_url}/_fake/messages")
+    if fake_config:
+        await client.post(f"{args.base_url}/_fake/config", json=fake_config)
+
+    latencies: list[float] = []
+    failures: dict[str, int] = {}
+
+    def on_done(job, ok: bool, detail) -> None:
+        if ok:
+            latencies.append(time.perf_counter() - job.enqueued_at)
+        else:
+            failures[detail] = failures.get(detail, 0) + 1
+
+    dispatcher.start()
+    t0 = time.perf_counter()
+    for i in range(args.messages):
+        to = f"569{(i % args.recipients):08d}"
+        payload = {"messaging_product": "whatsapp", "to": to, "type": "text", "text": {"body": f"bench {i}"}}
+        dispatcher.enqueue(
+            to, "text", payload, settings.whatsapp_phone_number_id, priority=PRIORITY_INTERACTIVE, on_done=on_done
+        )
+    await dispatcher.drain()
+    elapsed = time.perf_counter() - t0
+
+    fake_stats = (await client.get(f"{args.base_url}/_fake/stats")).json()
+    await dispatcher.stop()
+    await graph_client.aclose()
+
+    counters = metrics.snapshot()["counters"]
+    latencies.sort()
+
+    def pct(q: float) -> float:
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+
+    print(f"messages={args.messages} recipients={args.recipients} concurrency={settings.outbound_concurrency}")
+    print(f"sent={len(latencies)} failed={sum(failures.values())} {failures or ''}")
+    print(f"elapsed={elapsed:.2f}s throughput={len(latencies) / elapsed:.1f} msg/s")
+    print(f"latency_ms p50={pct(0.50):.1f} p90={pct(0.90):.1f} p99={pct(0.99):.1f}")
+    print(
+        "retries={} connections_opened={}".format(
+            int(sum(v for k, v in counters.items() if k.startswith("outbound_retries_total"))),
+            int(counters.get("graph_http_connections_opened_total", 0)),
+        )
+    )
+    print(f"fake_graph={ {k: v for k, v in fake_stats.items() if k != 'config'} }")
+    return 0 if not failures else 1
+
+
+def main() -> int:
+    args = _parse_args()
+    _configure_env(args)
+    return asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""Micro-benchmark del extractor de payloads del webhook de WhatsApp.
+
+Compara el camino anterior (json + recorrido con _safe_get) contra
+services.api.webhook_payload.extract_events sobre formas reales de payload
+de Meta (texto, list_reply, lote de mensajes, callback solo de estados).
+
+Uso:
+    PYTHONPATH=. python scripts/bench_webhook_extract.py [--number 20000]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import timeit
+
+from services.api.webhook_payload import extract_events, orjson
+
+PHONE_NUMBER_ID = "929895850207298"
+
+
+def _value(messages=None, statuses=None, contacts=None) -> dict:
+    value = {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "56912345678", "phone_number_id": PHONE_NUMBER_ID},
+    }
+    if contacts is not None:
+        value["contacts"] = contacts
+    if messages is not None:
+        value["messages"] = messages
+    if statuses is not None:
+        value["statuses"] = statuses
+    return value
+
+
+def _payload(*values: dict) -> bytes:
+    body = {
+        "object": "whatsapp_business_account",
+        "entry": [
+            {
+                "id": "102290129340398",
+                "changes": [{"value": v, "field": "messages"} for v in values],
+            }
+        ],
+    }
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+def _text_message(i: int, wa_id: str = "56911112222") -> dict:
+    return {
+        "from": wa_id,
+        "id": f"wamid.HBgLNTY5MTExMTIyMjIVAgASGBQzQTc3RjQ5{i:06d}AA==",
+        "timestamp": "1760659200",
+        "text": {"body": "Hola, necesito un gasfiter en Concepción, se me gotea el calefón"},
+        "type": "text",
+    }
+
+
+def _contact(wa_id: str = "56911112222") -> dict:
+    return {"profile": {"name": "Cliente Prueba"}, "wa_id": wa_id}
+
+
+PAYLOADS: dict[str, bytes] = {
+    "text": _payload(_value(messages=[_text_message(1)], contacts=[_contact()])),
+    "list_reply": _payload(
+        _value(
+            contacts=[_contact()],
+            messages=[
+                {
+                    "context": {"from": "56987654321", "id": "wamid.HBgLNTY5ODc2NTQzMjEVAgARGBI4QTA="},
+                    "from": "56911112222",
+                    "id": "wamid.HBgLNTY5MTExMTIyMjIVAgASGBQzQUYxRTk2RkQ3QjQ1QUM0QkZGMwA=",
+                    "timestamp": "1760659260",
+                    "type": "interactive",
+                    "interactive": {
+                        "type": "list_reply",
+                        "list_reply": {"id": "comuna:concepcion", "title": "Concepción"},
+                    },
+                }
+            ],
+        )
+    ),
+    "batch_10": _payload(
+        *[
+            _value(messages=[_text_message(i, f"5691111{i:04d}")], contacts=[_contact(f"5691111{i:04d}")])
+            for i in range(10)
+        ]
+    ),
+    "status_only": _payload(
+        _value(
+            statuses=[
+                {
+                    "id": "wamid.HBgLNTY5MTExMTIyMjIVAgARGBI5QjQ0RTYzQjA3RkU0NzE0QkMA",
+                    "status": "delivered",
+                    "timestamp": "1760659205",
+                    "recipient_id": "56911112222",
+                    "conversation": {
+                        "id": "0d6d2d2f7c4b4e0e9d1e6c0a1b2c3d4e",
+                        "origin": {"type": "service"},
+                    },
+                    "pricing": {"billable": True, "pricing_model": "CBP", "category": "service"},
+                }
+            ]
+        )
+    ),
+}
+
+
+# ---- Camino anterior (referencia) ----
+
+def _safe_get(d, *keys, default=None):
+    cur = d
+    for k in keys:
+        try:
+            cur = cur[k]
+        except Exception:
+            return default
+    return cur
+
+
+def legacy_extract(body: bytes) -> list[tuple]:
+    payload = json.loads(body)
+    out = []
+    for entry in _safe_get(payload, "entry", default=None) or []:
+        for change in _safe_get(entry, "changes", default=None) or []:
+            value = _safe_get(change, "value", default={})
+            for message in value.get("messages", []):
+                wa_id = message.get("from") or _safe_get(value, "contacts", 0, "wa_id", default=None)
+                mtype = message.get("type")
+                text = None
+                if mtype == "text":
+                    text = _safe_get(message, "text", "body", default=None)
+                elif mtype == "interactive":
+                    list_reply = _safe_get(message, "interactive", "list_reply", default={})
+                    button_reply = _safe_get(message, "interactive", "button_reply", default={})
+                    reply_id = list_reply.get("id") or button_reply.get("id")
+                    text = list_reply.get("title") or button_reply.get("title") or reply_id
+                out.append((wa_id, message.get("id"), mtype, text))
+    return out
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"decoder: {'orjson' if orjson else 'json (orjson no instalado)'} | iteraciones: {args.number}")
+    print(f"{'payload':<12} {'bytes':>6} {'legacy µs':>10} {'new µs':>8} {'speedup':>8}")
+    for name, body in PAYLOADS.items():
+        legacy = timeit.timeit(lambda: legacy_extract(body), number=args.number) / args.number * 1e6
+        new = timeit.timeit(lambda: extract_events(body), number=args.number) / args.number * 1e6
+        print(f"{name:<12} {len(body):>6} {legacy:>10.2f} {new:>8.2f} {legacy / new:>7.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""Reporte de latencias de entrega por paso de la conversación.
+
+Lee outbound_messages (wamid + callbacks de estado) y muestra p50/p90/p99 de:
+  - reply:    mensaje entrante -> envío aceptado por Meta
+  - delivery: envío -> "delivered"
+  - e2e:      mensaje entrante -> "delivered" (lo que realmente espera el usuario)
+
+Uso:
+    DATABASE_URL=... python scripts/report_delivery_latency.py [--hours 24]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+
+from sqlalchemy import create_engine, text
+
+REPORT_SQL = text(
+    """
+    WITH m AS (
+        SELECT
+            coalesce(step, '-') AS step,
+            extract(epoch FROM sent_at - inbound_at) AS reply_s,
+            extract(epoch FROM delivered_at - sent_at) AS delivery_s,
+            extract(epoch FROM delivered_at - inbound_at) AS e2e_s,
+            status
+        FROM outbound_messages
+        WHERE sent_at >= now() - make_interval(hours => :hours)
+    )
+    SELECT
+        step,
+        count(*) AS sent,
+        count(*) FILTER (WHERE status = 'failed') AS failed,
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY reply_s) AS reply_p50,
+        percentile_cont(0.99) WITHIN GROUP (ORDER BY reply_s) AS reply_p99,
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY delivery_s) AS delivery_p50,
+        percentile_cont(0.99) WITHIN GROUP (ORDER BY delivery_s) AS delivery_p99,
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY e2e_s) AS e2e_p50,
+        percentile_cont(0.9) WITHIN GROUP (ORDER BY e2e_s) AS e2e_p90,
+        percentile_cont(0.99) WITHIN GROUP (ORDER BY e2e_s) AS e2e_p99
+    FROM m
+    GROUP BY step
+    ORDER BY sent DESC
+    """
+)
+
+
+def _fmt(v) -> str:
+    return "-" if v is None else f"{float(v):.2f}"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=int, default=24)
+    args = parser.parse_args()
+
+    database_url = os.getenv("DATABASE_URL") or os.getenv("database_url")
+    if not database_url:
+        print("DATABASE_URL is not set.")
+        return 1
+
+    engine = create_engine(database_url, pool_pre_ping=True)
+    with engine.connect() as conn:
+        rows = conn.execute(REPORT_SQL, {"hours": args.hours}).all()
+
+    cols = ["reply_p50", "reply_p99", "delivery_p50", "delivery_p99", "e2e_p50", "e2e_p90", "e2e_p99"]
+    print(f"Últimas {args.hours}h (segundos)")
+    print(f"{'step':<22} {'sent':>6} {'failed':>6} " + " ".join(f"{c:>12}" for c in cols))
+    for r in rows:
+        m = r._mapping
+        print(f"{m['step']:<22} {m['sent']:>6} {m['failed']:>6} " + " ".join(f"{_fmt(m[c]):>12}" for c in cols))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,411 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+from sqlalchemy import and_, func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.db import AsyncSessionLocal, SessionLocal, engine
+from services.api.deps import get_async_db, require_admin
+from services.api.models import Campaign, CampaignDelivery, Provider
+from services.api.outbound_dispatcher import PRIORITY_BULK
+from services.api.settings import settings
+from services.api.whatsapp_cloud import send_template
+
+logger = setup_logging("campaigns")
+
+# pg_try_advisory_lock(_LOCK_NS, campaign_id): una campaña corre en un solo proceso
+_LOCK_NS = 4201
+
+
+def _recipients(campaign: Campaign, after_id: int = 0):
+    """
+    Proveedores pendientes de la campaña, en orden de id desde after_id (keyset).
+    Pendiente = sin entrega SENT: los FAILED (cola llena, sin configurar, error de
+    Meta) se reintentan al reanudar.
+    """
+    stmt = (
+        select(Provider.id, Provider.whatsapp_e164)
+        .where(Provider.active.is_(True))
+        .where(Provider.whatsapp_e164 != "")
+        .where(Provider.id > after_id)
+        .where(
+            ~select(CampaignDelivery.id)
+            .where(
+                and_(
+                    CampaignDelivery.campaign_id == campaign.id,
+                    CampaignDelivery.provider_id == Provider.id,
+                    CampaignDelivery.status == "SENT",
+                )
+            )
+            .exists()
+        )
+        .order_by(Provider.id.asc())
+    )
+    if campaign.service:
+        stmt = stmt.where(Provider.service == campaign.service)
+    if campaign.comuna:
+        stmt = stmt.where(Provider.comuna == campaign.comuna)
+    return stmt
+
+
+def _count_recipients(db: Session, campaign: Campaign) -> int:
+    return db.execute(select(func.count()).select_from(_recipients(campaign).subquery())).scalar_one()
+
+
+def _fetch_recipients(campaign: Campaign, after_id: int, limit: int) -> list[tuple[int, str]]:
+    # Un lote por transacción corta: nada queda abierto mientras la campaña envía
+    with SessionLocal() as db:
+        return [tuple(r) for r in db.execute(_recipients(campaign, after_id).limit(limit)).all()]
+
+
+def _try_lock(campaign_id: int) -> Optional[Connection]:
+    """
+    Advisory lock de sesión en una conexión propia en AUTOCOMMIT: dura lo que la
+    campaña sin mantener una transacción abierta (no frena el vacuum).
+    """
+    conn = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    if conn.execute(select(func.pg_try_advisory_lock(_LOCK_NS, campaign_id))).scalar():
+        return conn
+    conn.close()
+    return None
+
+
+def _unlock(conn: Connection, campaign_id: int) -> None:
+    # El lock es de la conexión física: cerrarla solo la devuelve al pool
+    try:
+        conn.execute(select(func.pg_advisory_unlock(_LOCK_NS, campaign_id)))
+    finally:
+        conn.close()
+
+
+def _write_checkpoint(campaign_id: int, checkpoint: int, results: list[dict], status: Optional[str] = None) -> None:
+    """
+    Resultados por proveedor + contadores + checkpoint en una sola transacción.
+    Un reintento reemplaza la entrega FAILED anterior (y deja de contarla como fallida).
+    """
+    with SessionLocal() as db:
+        retried = set()
+        if results:
+            retried = set(
+                db.execute(
+                    select(CampaignDelivery.provider_id)
+                    .where(CampaignDelivery.campaign_id == campaign_id)
+                    .where(CampaignDelivery.provider_id.in_([r["provider_id"] for r in results]))
+                    .where(CampaignDelivery.status == "FAILED")
+                ).scalars()
+            )
+        sent = sum(1 for r in results if r["status"] == "SENT")
+        failed = len(results) - sent - sum(1 for r in results if r["provider_id"] in retried)
+        values = {
+            "sent": Campaign.sent + sent,
+            "failed": Campaign.failed + failed,
+            "last_provider_id": func.greatest(Campaign.last_provider_id, checkpoint),
+        }
+        if len(results) > sent:
+            values["last_error"] = next(r["error"] for r in reversed(results) if r["status"] == "FAILED")
+        if status is not None:
+            values["status"] = status
+            if status in ("DONE", "FAILED"):
+                values["finished_at"] = func.now()
+        if results:
+            stmt = pg_insert(CampaignDelivery).values([{"campaign_id": campaign_id, **r} for r in results])
+            db.execute(
+                stmt.on_conflict_do_update(
+                    constraint="uq_campaign_delivery",
+                    set_={
+                        "status": stmt.excluded.status,
+                        "wa_message_id": stmt.excluded.wa_message_id,
+                        "error": stmt.excluded.error,
+                    },
+                    where=CampaignDelivery.status == "FAILED",
+                )
+            )
+        db.execute(update(Campaign).where(Campaign.id == campaign_id).values(**values))
+        db.commit()
+
+
+@dataclass
+class _Run:
+    campaign_id: int
+    slots: asyncio.Semaphore
+    inflight: set[int] = field(default_factory=set)
+    results: list[dict] = field(default_factory=list)
+    last_dispatched: int = 0
+    dispatched: int = 0
+    stopping: bool = False
+    started: float = field(default_factory=time.monotonic)
+
+
+class CampaignRunner:
+    """
+    Motor de campañas de plantillas a proveedores.
+
+    - Lee destinatarios por lotes keyset (id > último, LIMIT CAMPAIGN_FETCH_SIZE),
+      cada uno en una transacción corta: una campaña de horas no retiene el
+      horizonte de vacuum. El advisory lock va en su propia conexión en AUTOCOMMIT.
+    - Envía por send_template (mismo camino que _notify_provider_new_lead) con
+      prioridad BULK: el dispatcher aplica el rate limit por número y las
+      respuestas interactivas salen antes.
+    - Concurrencia acotada: a lo más CAMPAIGN_MAX_INFLIGHT envíos en la cola de salida.
+    - Checkpoint cada CAMPAIGN_CHECKPOINT_EVERY resultados: el checkpoint es el
+      menor id aún en vuelo, así una campaña interrumpida se reanuda sin reenviar
+      lo ya enviado. Al reanudar se recorre desde el inicio: los FAILED se reintentan.
+    """
+
+    def __init__(self) -> None:
+        self._runs: dict[int, _Run] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._shutting_down = False
+
+        metrics.register_gauge("campaign_inflight", lambda: sum(len(r.inflight) for r in self._runs.values()))
+
+    def running(self, campaign_id: int) -> bool:
+        return campaign_id in self._tasks
+
+    def start(self, campaign_id: int) -> bool:
+        if campaign_id in self._tasks:
+            return False
+        task = asyncio.create_task(self._run(campaign_id), name=f"campaign-{campaign_id}")
+        self._tasks[campaign_id] = task
+        task.add_done_callback(lambda _t: self._tasks.pop(campaign_id, None))
+        return True
+
+    def pause(self, campaign_id: int) -> bool:
+        run = self._runs.get(campaign_id)
+        if run is None:
+            return False
+        run.stopping = True
+        return True
+
+    async def resume_interrupted(self) -> None:
+        """Al arrancar: retoma las campañas que quedaron RUNNING (reinicio del proceso)."""
+        try:
+            async with AsyncSessionLocal() as db:
+                ids = (await db.scalars(select(Campaign.id).where(Campaign.status == "RUNNING"))).all()
+        except Exception:
+            logger.exception("❌ No se pudieron leer las campañas pendientes")
+            return
+        for campaign_id in ids:
+            self.start(campaign_id)
+
+    async def stop(self) -> None:
+        """Shutdown: deja de despachar y espera el checkpoint final (quedan RUNNING para reanudar)."""
+        self._shutting_down = True
+        for run in self._runs.values():
+            run.stopping = True
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _on_done(self, run: _Run, provider_id: int, job, ok: bool, detail: Optional[str]) -> None:
+        run.inflight.discard(provider_id)
+        run.slots.release()
+        if ok:
+            run.results.append({"provider_id": provider_id, "status": "SENT", "wa_message_id": detail, "error": None})
+            metrics.inc("campaign_sent_total")
+        else:
+            run.results.append({"provider_id": provider_id, "status": "FAILED", "wa_message_id": None, "error": detail})
+            metrics.inc("campaign_failed_total", reason=detail)
+
+    def _checkpoint_value(self, run: _Run) -> int:
+        # Todo id menor al primero en vuelo ya tiene resultado (o se despachó antes)
+        return min(run.inflight) - 1 if run.inflight else run.last_dispatched
+
+    async def _checkpoint(self, run: _Run, status: Optional[str] = None) -> None:
+        results, run.results = run.results, []
+        await asyncio.to_thread(_write_checkpoint, run.campaign_id, self._checkpoint_value(run), results, status)
+
+    async def _run(self, campaign_id: int) -> None:
+        run = _Run(campaign_id=campaign_id, slots=asyncio.Semaphore(max(1, settings.campaign_max_inflight)))
+        lock_conn = None
+        try:
+            lock_conn = await asyncio.to_thread(_try_lock, campaign_id)
+            if lock_conn is None:
+                logger.info("📣 Campaña %s ya corre en otro proceso", campaign_id)
+                return
+            self._runs[campaign_id] = run
+            await self._execute(run)
+        except Exception:
+            logger.exception("❌ Campaña %s falló; queda FAILED (se puede reanudar)", campaign_id)
+            metrics.inc("campaign_runs_failed_total")
+            await asyncio.to_thread(
+                _write_checkpoint, campaign_id, self._checkpoint_value(run), run.results, "FAILED"
+            )
+        finally:
+            self._runs.pop(campaign_id, None)
+            if lock_conn is not None:
+                await asyncio.to_thread(_unlock, lock_conn, campaign_id)
+
+    async def _execute(self, run: _Run) -> None:
+        def _prepare() -> Campaign:
+            # expire_on_commit=False: el Campaign se sigue leyendo ya fuera de la sesión
+            with SessionLocal(expire_on_commit=False) as db:
+                campaign = db.get(Campaign, run.campaign_id)
+                if campaign.status != "RUNNING" or not campaign.total:
+                    pending = _count_recipients(db, campaign)
+                    if not campaign.total:
+                        campaign.total = pending
+                    campaign.status = "RUNNING"
+                    campaign.started_at = campaign.started_at or datetime.now(timezone.utc)
+                    campaign.finished_at = None
+                    db.commit()
+                return campaign
+
+        campaign = await asyncio.to_thread(_prepare)
+        run.last_dispatched = campaign.last_provider_id
+        template = (campaign.template_name, campaign.language_code, campaign.components)
+        logger.info("📣 Campaña %s iniciada | template=%s | total=%s", campaign.id, campaign.template_name, campaign.total)
+
+        after_id = 0
+        while not run.stopping:
+            batch = await asyncio.to_thread(_fetch_recipients, campaign, after_id, settings.campaign_fetch_size)
+            if not batch:
+                break
+            after_id = batch[-1][0]
+            for provider_id, wa_id in batch:
+                await run.slots.acquire()
+                if run.stopping:
+                    run.slots.release()
+                    break
+                run.inflight.add(provider_id)
+                run.last_dispatched = max(run.last_dispatched, provider_id)
+                res = await send_template(
+                    wa_id,
+                    template[0],
+                    language_code=template[1],
+                    components=template[2],
+                    priority=PRIORITY_BULK,
+                    on_done=functools.partial(self._on_done, run, provider_id),
+                )
+                if not res.get("ok"):
+                    # Cola llena / WhatsApp sin configurar: no habrá on_done
+                    reason = res.get("error") or ("not_configured" if res.get("mock") else "not_sent")
+                    self._on_done(run, provider_id, None, False, reason)
+                run.dispatched += 1
+
+                if len(run.results) >= settings.campaign_checkpoint_every:
+                    await self._checkpoint(run)
+
+        while run.inflight:
+            await asyncio.sleep(0.2)
+            if len(run.results) >= settings.campaign_checkpoint_every:
+                await self._checkpoint(run)
+
+        if not run.stopping:
+            final = "DONE"
+        elif self._shutting_down:
+            final = None  # shutdown: queda RUNNING y se retoma al arrancar
+        else:
+            final = "PAUSED"
+        await self._checkpoint(run, final)
+        elapsed = time.monotonic() - run.started
+        logger.info(
+            "📣 Campaña %s -> %s | despachados=%s | %.1f msg/s",
+            run.campaign_id, final or "RUNNING", run.dispatched, run.dispatched / elapsed if elapsed else 0.0,
+        )
+
+
+campaign_runner = CampaignRunner()
+
+
+# ---------------------------------------------------------------------------
+# API de administración
+# ---------------------------------------------------------------------------
+
+router = APIRouter(prefix="/admin/campaigns", tags=["campaigns"], dependencies=[Depends(require_admin)])
+
+
+class CampaignCreate(BaseModel):
+    name: str
+    template_name: str
+    language_code: str = "es_ES"
+    components: Optional[list[dict]] = None
+    service: Optional[str] = None
+    comuna: Optional[str] = None
+    start: bool = False
+
+
+async def _report(db: AsyncSession, campaign: Campaign) -> dict:
+    processed = campaign.sent + campaign.failed
+    end = campaign.finished_at or datetime.now(timezone.utc)
+    elapsed = (end - campaign.started_at).total_seconds() if campaign.started_at else 0.0
+    failures = (
+        await db.execute(
+            select(CampaignDelivery.error, func.count())
+            .where(CampaignDelivery.campaign_id == campaign.id, CampaignDelivery.status == "FAILED")
+            .group_by(CampaignDelivery.error)
+        )
+    ).all()
+    return {
+        "id": campaign.id,
+        "name": campaign.name,
+        "template_name": campaign.template_name,
+        "status": campaign.status,
+        "running_here": campaign_runner.running(campaign.id),
+        "total": campaign.total,
+        "sent": campaign.sent,
+        "failed": campaign.failed,
+        "remaining": max(0, campaign.total - processed),
+        "checkpoint_provider_id": campaign.last_provider_id,
+        "elapsed_seconds": round(elapsed, 1),
+        "throughput_per_s": round(processed / elapsed, 2) if elapsed > 0 else None,
+        "failures": {error or "unknown": n for error, n in failures},
+        "last_error": campaign.last_error,
+    }
+
+
+async def _get(db: AsyncSession, campaign_id: int) -> Campaign:
+    campaign = await db.get(Campaign, campaign_id)
+    if campaign is None:
+        raise HTTPException(status_code=404, detail="campaign not found")
+    return campaign
+
+
+@router.post("")
+async def create_campaign(body: CampaignCreate, db: AsyncSession = Depends(get_async_db)):
+    campaign = Campaign(**body.model_dump(exclude={"start"}), status="DRAFT")
+    db.add(campaign)
+    await db.commit()
+    await db.refresh(campaign)
+    logger.info("📣 Campaña creada | id=%s | template=%s", campaign.id, campaign.template_name)
+    if body.start:
+        campaign_runner.start(campaign.id)
+    return await _report(db, campaign)
+
+
+@router.get("")
+async def list_campaigns(db: AsyncSession = Depends(get_async_db)):
+    campaigns = (await db.scalars(select(Campaign).order_by(Campaign.id.desc()).limit(50))).all()
+    return [await _report(db, c) for c in campaigns]
+
+
+@router.get("/{campaign_id}")
+async def get_campaign(campaign_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await _report(db, await _get(db, campaign_id))
+
+
+@router.post("/{campaign_id}/start")
+async def start_campaign(campaign_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Inicia o reanuda desde el checkpoint."""
+    campaign = await _get(db, campaign_id)
+    if campaign.status == "DONE":
+        raise HTTPException(status_code=409, detail="campaign already done")
+    return {"ok": True, "started": campaign_runner.start(campaign_id)}
+
+
+@router.post("/{campaign_id}/pause")
+async def pause_campaign(campaign_id: int, db: AsyncSession = Depends(get_async_db)):
+    await _get(db, campaign_id)
+    return {"ok": True, "paused": campaign_runner.pause(campaign_id)}
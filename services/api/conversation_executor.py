@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Set, Tuple
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.db import AsyncSessionLocal
+from services.api.db_stats import track_db
+from services.api.delivery_tracking import turn_context
+from services.api.leads_flow import handle_user_incoming
+from services.api.load_shedding import load_shedder
+from services.api.outbox import bind_outbox, outbox_relay
+from services.api.settings import settings
+from services.api.webhook_payload import InboundEvent
+
+logger = setup_logging("conversation_executor")
+
+Handler = Callable[[str, InboundEvent], Awaitable[Any]]
+LaneItem = Tuple[InboundEvent, asyncio.Future, float]
+
+class ConversationExecutor:
+    """
+    Executor con un "lane" lógico por wa_id.
+
+    - Los mensajes de un mismo wa_id se ejecutan estrictamente en orden
+      (nunca dos turnos del mismo usuario leyendo/escribiendo su ConversationState
+      y Lead a la vez).
+    - Lanes de distintos wa_id corren en paralelo, acotados por max_concurrency.
+
+    Un lane solo existe mientras tiene trabajo pendiente: no hay tareas ociosas.
+    """
+
+    def __init__(self, handler: Handler, max_concurrency: int):
+        self._handler = handler
+        self._max_concurrency = max(1, max_concurrency)
+        self._sem = asyncio.Semaphore(self._max_concurrency)
+        self._lanes: Dict[str, Deque[LaneItem]] = {}
+        self._tasks: Set[asyncio.Task] = set()  # referencias fuertes: el loop solo guarda débiles
+        self._running = 0
+
+        metrics.register_gauge("executor_lanes_active", lambda: len(self._lanes))
+        metrics.register_gauge("executor_running", lambda: self._running)
+        metrics.register_gauge("executor_queue_depth", self.queue_depth)
+        metrics.register_gauge("executor_max_lane_depth", self.max_lane_depth)
+        metrics.register_gauge("executor_max_concurrency", lambda: self._max_concurrency)
+
+    def queue_depth(self) -> int:
+        """Mensajes aceptados que aún no empiezan a ejecutarse."""
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def max_lane_depth(self) -> int:
+        return max((len(lane) for lane in self._lanes.values()), default=0)
+
+    def submit(self, wa_id: str, item: InboundEvent) -> asyncio.Future:
+        """Encola item en el lane de wa_id. El future se resuelve al terminar su turno."""
+        fut = asyncio.get_running_loop().create_future()
+        lane = self._lanes.get(wa_id)
+        if lane is None:
+            lane = self._lanes[wa_id] = deque()
+            lane.append((item, fut, time.perf_counter()))
+            task = asyncio.create_task(self._drain(wa_id, lane), name=f"lane-{wa_id}")
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            lane.append((item, fut, time.perf_counter()))
+        metrics.inc("executor_submitted_total")
+        return fut
+
+    async def _drain(self, wa_id: str, lane: Deque[LaneItem]) -> None:
+        try:
+            while lane:
+                item, fut, enqueued_at = lane.popleft()
+                async with self._sem:
+                    started = time.perf_counter()
+                    metrics.observe("executor_wait_seconds", started - enqueued_at)
+                    self._running += 1
+                    try:
+                        result = await self._handler(wa_id, item)
+                    except Exception as e:
+                        metrics.inc("executor_failed_total")
+                        if not fut.done():
+                            fut.set_exception(e)
+                    else:
+                        metrics.inc("executor_completed_total")
+                        if not fut.done():
+                            fut.set_result(result)
+                    finally:
+                        self._running -= 1
+                        finished = time.perf_counter()
+                        metrics.observe("executor_run_seconds", finished - started)
+                        load_shedder.observe_turn(finished - enqueued_at)
+        finally:
+            # Sin awaits entre el último `while lane` y aquí: ningún submit puede colarse.
+            self._lanes.pop(wa_id, None)
+
+
+async def _run_turn(wa_id: str, item: InboundEvent) -> None:
+    async with AsyncSessionLocal() as db:
+        try:
+            with turn_context(
+                wa_id=wa_id,
+                inbound_message_id=item.msg_id,
+                inbound_at=item.received_at,
+                phone_number_id=item.phone_number_id,
+            ), bind_outbox(db), track_db(db) as db_stats:
+                await handle_user_incoming(db=db, wa_id=wa_id, text=item.text, raw_message=item.message)
+                # Unidad de trabajo: el flujo solo modifica objetos; un único commit
+                # persiste el turno completo y libera sus envíos (outbox o dispatcher).
+                await db.commit()
+            outbox_relay.notify()
+            logger.info(
+                "✅ Processed message | wa_id=%s | msg_id=%s | selects=%s | commits=%s",
+                wa_id,
+                item.msg_id,
+                db_stats["select"],
+                db_stats["commit"],
+            )
+        except Exception:
+            await db.rollback()
+            raise
+
+
+executor = ConversationExecutor(
+    _run_turn,
+    max_concurrency=settings.conversation_max_concurrency,
+)
+load_shedder.add_depth_source(executor.queue_depth)
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 DATABASE_URL = os.getenv(
@@ -21,4 +22,20 @@ SessionLocal = sessionmaker(
     autocommit=False,
 )
 
+# Camino del webhook (turnos de conversación): mismo DATABASE_URL, driver psycopg
+# en modo async, para que una consulta lenta no bloquee el event loop.
+# expire_on_commit=False: el flujo sigue leyendo lead/state después de cada
+# commit y en async no hay lazy-load implícito.
+async_engine = create_async_engine(
+    DATABASE_URL,
+    pool_pre_ping=True,
+    echo=False,
+)
+
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
 Base = declarative_base()
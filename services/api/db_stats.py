@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator, Union
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import ORMExecuteState, Session
+
+from services.common.metrics import metrics
+
+_STATS_KEY = "db_stats"
+_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+KINDS = ("select", "write", "flush", "commit")
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _count_execute(state: ORMExecuteState) -> None:
+    stats = state.session.info.get(_STATS_KEY)
+    if stats is not None:
+        stats["select" if state.is_select else "write"] += 1
+
+
+@event.listens_for(Session, "after_flush")
+def _count_flush(db: Session, _flush_context) -> None:
+    stats = db.info.get(_STATS_KEY)
+    if stats is not None:
+        stats["flush"] += 1
+
+
+@event.listens_for(Session, "after_commit")
+def _count_commit(db: Session) -> None:
+    stats = db.info.get(_STATS_KEY)
+    if stats is not None:
+        stats["commit"] += 1
+
+
+@contextmanager
+def track_db(db: Union[Session, AsyncSession]) -> Iterator[Counter]:
+    """
+    Cuenta SELECTs, escrituras directas (UPDATE/DELETE por sentencia), flushes y
+    commits de la sesión mientras dura el bloque; al salir los publica como
+    histogramas turn_db_<kind>s (un valor por turno).
+    """
+    stats: Counter = Counter()
+    db.info[_STATS_KEY] = stats
+    try:
+        yield stats
+    finally:
+        db.info.pop(_STATS_KEY, None)
+        for kind in KINDS:
+            metrics.observe(f"turn_db_{kind}s", stats[kind], buckets=_BUCKETS)
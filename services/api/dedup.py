@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Hashable, Iterable
+
+from sqlalchemy import String, Text, and_, column, insert, select, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from services.common.metrics import metrics
+from services.api.models import InboundMessage, InboundMessageLog
+from services.api.settings import settings
+
+
+class RecentIdCache:
+    """
+    Conjunto acotado (LRU + TTL) de message_id vistos recientemente.
+
+    Frena las tormentas de reintentos de Meta sin tocar Postgres. Es solo un
+    filtro rápido: la fuente de verdad sigue siendo uq_inbound_wa_msg.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max(1, max_size)
+        self.ttl_seconds = ttl_seconds
+        self._items: "OrderedDict[Hashable, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        expires_at = self._items.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._items[key]
+            return False
+        self._items.move_to_end(key)
+        return True
+
+    def add(self, key: Hashable) -> None:
+        self._items[key] = time.monotonic() + self.ttl_seconds
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def add_many(self, keys: Iterable[Hashable]) -> None:
+        for k in keys:
+            self.add(k)
+
+
+recent_message_ids = RecentIdCache(settings.dedup_cache_size, settings.dedup_cache_ttl_seconds)
+metrics.register_gauge("dedup_cache_size", lambda: len(recent_message_ids))
+
+
+def claim_new_message_ids(db: Session, rows: list[dict]) -> set[tuple[str, str]]:
+    """
+    Registra los (wa_id, message_id) en un solo round-trip:
+    INSERT ... ON CONFLICT ON CONSTRAINT uq_inbound_wa_msg DO NOTHING RETURNING.
+
+    Con INBOUND_TEXT_RETENTION_DAYS > 0 el mismo statement (CTE) copia el texto
+    de las claves recién insertadas a inbound_message_log (particionada por día).
+
+    Devuelve las claves efectivamente insertadas (las demás ya existían).
+    El commit lo hace quien llama.
+    """
+    if not rows:
+        return set()
+    if settings.inbound_text_retention_days <= 0:
+        stmt = (
+            pg_insert(InboundMessage)
+            .values([{"customer_wa_id": r["customer_wa_id"], "message_id": r["message_id"]} for r in rows])
+            .on_conflict_do_nothing(constraint="uq_inbound_wa_msg")
+            .returning(InboundMessage.customer_wa_id, InboundMessage.message_id)
+        )
+        return {(r[0], r[1]) for r in db.execute(stmt).all()}
+
+    incoming = (
+        select(
+            values(
+                column("customer_wa_id", String),
+                column("message_id", String),
+                column("text", Text),
+                name="v",
+            ).data([(r["customer_wa_id"], r["message_id"], r.get("text") or "") for r in rows])
+        )
+    ).cte("incoming")
+    claimed = (
+        pg_insert(InboundMessage)
+        .from_select(
+            ["customer_wa_id", "message_id"],
+            select(incoming.c.customer_wa_id, incoming.c.message_id),
+        )
+        .on_conflict_do_nothing(constraint="uq_inbound_wa_msg")
+        .returning(InboundMessage.customer_wa_id, InboundMessage.message_id, InboundMessage.created_at)
+        .cte("claimed")
+    )
+    stmt = (
+        insert(InboundMessageLog)
+        .from_select(
+            ["customer_wa_id", "message_id", "created_at", "text"],
+            select(claimed.c.customer_wa_id, claimed.c.message_id, claimed.c.created_at, incoming.c.text).join(
+                incoming,
+                and_(
+                    incoming.c.customer_wa_id == claimed.c.customer_wa_id,
+                    incoming.c.message_id == claimed.c.message_id,
+                ),
+            ),
+        )
+        .returning(InboundMessageLog.customer_wa_id, InboundMessageLog.message_id)
+    )
+    return {(r[0], r[1]) for r in db.execute(stmt).all()}
@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+from sqlalchemy import case, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.db import SessionLocal
+from services.api.dedup import RecentIdCache
+from services.api.models import OutboundMessage
+from services.api.settings import settings
+from services.api.webhook_payload import StatusEvent
+
+logger = setup_logging("delivery_tracking")
+
+
+@dataclass
+class TurnInfo:
+    """Contexto del turno en curso: permite atribuir cada envío a su mensaje de entrada y paso."""
+
+    wa_id: Optional[str] = None
+    inbound_message_id: Optional[str] = None
+    inbound_at: Optional[float] = None  # epoch (s)
+    step: Optional[str] = None
+    phone_number_id: Optional[str] = None  # número al que escribió el usuario
+
+
+current_turn: ContextVar[Optional[TurnInfo]] = ContextVar("current_turn", default=None)
+
+
+@contextmanager
+def turn_context(**kwargs) -> Iterator[TurnInfo]:
+    turn = TurnInfo(**kwargs)
+    token = current_turn.set(turn)
+    try:
+        yield turn
+    finally:
+        current_turn.reset(token)
+
+
+def set_turn_step(step: Optional[str]) -> None:
+    """Fija el paso de la conversación del turno (el paso en que estaba el usuario al escribir)."""
+    turn = current_turn.get()
+    if turn is not None and turn.step is None:
+        turn.step = step
+
+
+def _ts(epoch: Optional[float]) -> Optional[datetime]:
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(epoch, tz=timezone.utc)
+
+
+def _seconds(a: Optional[datetime], b: Optional[datetime]) -> Optional[float]:
+    if a is None or b is None:
+        return None
+    return max(0.0, (b - a).total_seconds())
+
+
+def _observe_delivery(step: Optional[str], inbound_at, sent_at, delivered_at) -> None:
+    label = step or "none"
+    d = _seconds(sent_at, delivered_at)
+    if d is not None:
+        metrics.observe("wa_delivery_latency_seconds", d, step=label)
+    e2e = _seconds(inbound_at, delivered_at)
+    if e2e is not None:
+        metrics.observe("wa_end_to_end_latency_seconds", e2e, step=label)
+
+
+class DeliveryTracker:
+    """
+    Buffer en memoria de envíos (wamid) y callbacks de estado, escrito en lote.
+
+    - record_outbound() se llama tras cada envío aceptado por Meta.
+    - add_statuses() recibe los callbacks del webhook (ya deduplicados en memoria).
+    - flush() hace un upsert en lote por cada tipo y alimenta los histogramas
+      inbound -> enviado -> entregado por paso de la conversación.
+    """
+
+    def __init__(self, max_buffer: int = 10000):
+        self.max_buffer = max_buffer
+        self._outbound: list[dict] = []
+        self._statuses: dict[str, dict] = {}
+        self._recent_statuses = RecentIdCache(max_buffer * 5, 3600)
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        metrics.register_gauge("delivery_tracking_buffered", lambda: len(self._outbound) + len(self._statuses))
+
+    # ---- captura ----
+
+    def record_outbound(self, wa_message_id: str, to_wa_id: str, kind: str) -> None:
+        if not settings.delivery_tracking_enabled:
+            return
+        now = time.time()
+        turn = current_turn.get()
+        step = turn.step if turn else None
+        if turn and turn.inbound_at:
+            metrics.observe("wa_reply_latency_seconds", max(0.0, now - turn.inbound_at), step=step or "none")
+        if len(self._outbound) >= self.max_buffer:
+            metrics.inc("delivery_tracking_dropped_total")
+            return
+        self._outbound.append(
+            {
+                "wa_message_id": wa_message_id,
+                "to_wa_id": to_wa_id,
+                "kind": kind,
+                "conversation_wa_id": turn.wa_id if turn else None,
+                "step": step,
+                "inbound_message_id": turn.inbound_message_id if turn else None,
+                "inbound_at": _ts(turn.inbound_at) if turn else None,
+                "sent_at": _ts(now),
+                "status": "sent",
+            }
+        )
+
+    def add_statuses(self, events: list[StatusEvent]) -> None:
+        for ev in events:
+            key = (ev.wa_message_id, ev.status)
+            if key in self._recent_statuses:
+                metrics.inc("delivery_status_duplicates_total")
+                continue
+            self._recent_statuses.add(key)
+            metrics.inc("delivery_status_total", status=ev.status)
+            if ev.status not in ("delivered", "read", "failed"):
+                continue
+            if ev.wa_message_id not in self._statuses and len(self._statuses) >= self.max_buffer:
+                metrics.inc("delivery_tracking_dropped_total")
+                continue
+            row = self._statuses.setdefault(
+                ev.wa_message_id,
+                {
+                    "wa_message_id": ev.wa_message_id,
+                    "to_wa_id": ev.recipient_id,
+                    "delivered_at": None,
+                    "read_at": None,
+                    "failed_at": None,
+                    "errors": None,
+                },
+            )
+            at = _ts(ev.timestamp) or _ts(time.time())
+            column = f"{ev.status}_at"
+            if row[column] is None or at < row[column]:
+                row[column] = at
+            if ev.errors:
+                row["errors"] = ev.errors
+
+    # ---- escritura ----
+
+    def _write_outbound(self, db, rows: list[dict]) -> None:
+        stmt = pg_insert(OutboundMessage).values(rows)
+        ex = stmt.excluded
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[OutboundMessage.wa_message_id],
+            set_={
+                "to_wa_id": ex.to_wa_id,
+                "kind": ex.kind,
+                "conversation_wa_id": ex.conversation_wa_id,
+                "step": ex.step,
+                "inbound_message_id": ex.inbound_message_id,
+                "inbound_at": ex.inbound_at,
+                "sent_at": ex.sent_at,
+            },
+        ).returning(
+            OutboundMessage.step,
+            OutboundMessage.inbound_at,
+            OutboundMessage.sent_at,
+            OutboundMessage.delivered_at,
+        )
+        for step, inbound_at, sent_at, delivered_at in db.execute(stmt).all():
+            # El callback "delivered" llegó antes que el registro del envío
+            if delivered_at is not None:
+                _observe_delivery(step, inbound_at, sent_at, delivered_at)
+
+    def _write_statuses(self, db, rows: list[dict]) -> None:
+        for r in rows:
+            r["status"] = (
+                "failed" if r["failed_at"] else "read" if r["read_at"] else "delivered" if r["delivered_at"] else "sent"
+            )
+        tbl = OutboundMessage.__table__
+        stmt = pg_insert(tbl).values(rows)
+        ex = stmt.excluded
+        delivered = func.coalesce(tbl.c.delivered_at, ex.delivered_at)
+        read = func.coalesce(tbl.c.read_at, ex.read_at)
+        failed = func.coalesce(tbl.c.failed_at, ex.failed_at)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[tbl.c.wa_message_id],
+            set_={
+                "to_wa_id": func.coalesce(tbl.c.to_wa_id, ex.to_wa_id),
+                "delivered_at": delivered,
+                "read_at": read,
+                "failed_at": failed,
+                "errors": func.coalesce(ex.errors, tbl.c.errors),
+                "status": case(
+                    (failed.isnot(None), "failed"),
+                    (read.isnot(None), "read"),
+                    (delivered.isnot(None), "delivered"),
+                    else_="sent",
+                ),
+            },
+        ).returning(tbl.c.wa_message_id, tbl.c.step, tbl.c.inbound_at, tbl.c.sent_at, tbl.c.delivered_at)
+
+        by_id = {r["wa_message_id"]: r for r in rows}
+        for wa_message_id, step, inbound_at, sent_at, delivered_at in db.execute(stmt).all():
+            mine = by_id.get(wa_message_id)
+            # Solo si este lote fijó delivered_at (evita contar dos veces) y el envío ya está registrado
+            if sent_at is not None and mine and mine["delivered_at"] is not None and mine["delivered_at"] == delivered_at:
+                _observe_delivery(step, inbound_at, sent_at, delivered_at)
+
+    def _write(self, outbound: list[dict], statuses: list[dict]) -> None:
+        with SessionLocal() as db:
+            if outbound:
+                self._write_outbound(db, outbound)
+            if statuses:
+                self._write_statuses(db, statuses)
+            db.commit()
+
+    async def flush(self) -> None:
+        if not self._outbound and not self._statuses:
+            return
+        outbound, self._outbound = self._outbound, []
+        statuses, self._statuses = list(self._statuses.values()), {}
+        try:
+            await asyncio.to_thread(self._write, outbound, statuses)
+            metrics.inc("delivery_tracking_written_total", len(outbound) + len(statuses))
+        except Exception:
+            metrics.inc("delivery_tracking_write_errors_total")
+            logger.exception(
+                "❌ No se pudo registrar entregas | outbound=%s | statuses=%s", len(outbound), len(statuses)
+            )
+            self._requeue(outbound, statuses)
+
+    def _requeue(self, outbound: list[dict], statuses: list[dict]) -> None:
+        """Devuelve un lote fallido al frente del buffer (se reintenta en el próximo flush), hasta max_buffer."""
+        merged = outbound + self._outbound
+        dropped = max(0, len(merged) - self.max_buffer)
+        self._outbound = merged[dropped:]  # si no cabe, se pierde lo más antiguo
+
+        pending, self._statuses = self._statuses, {}
+        for row in statuses:
+            self._statuses[row["wa_message_id"]] = row
+        for wa_message_id, row in pending.items():
+            prev = self._statuses.get(wa_message_id)
+            if prev is None:
+                self._statuses[wa_message_id] = row
+                continue
+            # Mismo wamid en el lote fallido y en el nuevo: gana el timestamp más temprano
+            for column in ("delivered_at", "read_at", "failed_at"):
+                if row[column] is not None and (prev[column] is None or row[column] < prev[column]):
+                    prev[column] = row[column]
+            prev["errors"] = row["errors"] or prev["errors"]
+        while len(self._statuses) > self.max_buffer:
+            self._statuses.pop(next(iter(self._statuses)))
+            dropped += 1
+        if dropped:
+            metrics.inc("delivery_tracking_dropped_total", dropped)
+
+    # ---- ciclo de vida (API) ----
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(), name="delivery-tracker")
+
+    async def stop(self) -> None:
+        self._stopping = True
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        interval_s = max(0.05, settings.delivery_tracking_flush_ms / 1000.0)
+        while not self._stopping:
+            await asyncio.sleep(interval_s)
+            await self.flush()
+
+
+delivery_tracker = DeliveryTracker()
@@ -1,7 +1,12 @@
 # services/api/deps.py
-from typing import Generator
+import hmac
+from typing import AsyncGenerator, Generator, Optional
+
+from fastapi import Header, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from .db import SessionLocal
+from .db import AsyncSessionLocal, SessionLocal
+from .settings import settings
 
 def get_db() -> Generator[Session, None, None]:
     db = SessionLocal()
@@ -9,3 +14,16 @@ def get_db() -> Generator[Session, None, None]:
         yield db
     finally:
         db.close()
+
+
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    # Para endpoints async: la sesión sync bloquearía el event loop en cada consulta
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def require_admin(x_admin_token: Optional[str] = Header(default=None)) -> None:
+    if not settings.admin_api_token:
+        raise HTTPException(status_code=503, detail="ADMIN_API_TOKEN no configurado")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, settings.admin_api_token):
+        raise HTTPException(status_code=401, detail="unauthorized")
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Optional
+
+import httpx
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.settings import settings
+
+logger = setup_logging("graph_client")
+
+try:  # HTTP/2 requiere el extra httpx[http2] (paquete h2)
+    import h2  # noqa: F401
+
+    _HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    _HTTP2_AVAILABLE = False
+
+
+async def _trace(event_name: str, info: dict) -> None:
+    # Solo las conexiones nuevas pasan por connect_tcp: el resto de requests reutiliza una del pool
+    if event_name == "connection.connect_tcp.complete":
+        metrics.inc("graph_http_connections_opened_total")
+    elif event_name == "connection.start_tls.complete":
+        metrics.inc("graph_http_tls_handshakes_total")
+
+
+class GraphClient:
+    """
+    Un único httpx.AsyncClient por proceso para la Graph API de WhatsApp.
+
+    Mantiene conexiones keep-alive (y multiplexa con HTTP/2 si h2 está instalado),
+    con URL base y headers de autorización fijados una sola vez. Se crea al
+    primer uso dentro del event loop y se cierra en el shutdown (API) o al
+    terminar el worker.
+    """
+
+    def __init__(self) -> None:
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _build(self) -> httpx.AsyncClient:
+        http2 = bool(settings.graph_http2) and _HTTP2_AVAILABLE
+        if settings.graph_http2 and not _HTTP2_AVAILABLE:
+            logger.warning("GRAPH_HTTP2=1 pero falta el paquete h2; se usa HTTP/1.1 keep-alive")
+        return httpx.AsyncClient(
+            base_url=f"{settings.whatsapp_graph_base_url.rstrip('/')}/{settings.whatsapp_graph_version}/",
+            headers={
+                "Authorization": f"Bearer {settings.whatsapp_access_token}",
+                "Content-Type": "application/json",
+            },
+            http2=http2,
+            timeout=httpx.Timeout(settings.graph_timeout_seconds, connect=settings.graph_connect_timeout_seconds),
+            limits=httpx.Limits(
+                max_connections=settings.graph_max_connections,
+                max_keepalive_connections=settings.graph_max_keepalive_connections,
+                keepalive_expiry=settings.graph_keepalive_expiry_seconds,
+            ),
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            # Un cliente queda atado a su event loop: si cambia (tests, scripts), se crea otro.
+            self._client = self._build()
+            self._loop = loop
+            metrics.inc("graph_http_clients_created_total")
+        return self._client
+
+    async def post(self, path: str, payload: dict) -> httpx.Response:
+        r = await self.client.post(path, json=payload, extensions={"trace": _trace})
+        metrics.inc("graph_http_requests_total", http_version=r.http_version)
+        return r
+
+    async def aclose(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        self._loop = None
+
+
+graph_client = GraphClient()
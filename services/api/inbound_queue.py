@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import re
+from dataclasses import replace
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.orm import Session, aliased
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.db import SessionLocal
+from services.api.conversation_executor import executor
+from services.api.load_shedding import load_shedder
+from services.api.models import InboundQueueItem
+from services.api.settings import settings
+from services.api.webhook_payload import InboundEvent
+
+logger = setup_logging("inbound_queue")
+
+# Cada cuánto se relee la profundidad de la cola (señal de load shedding)
+DEPTH_REFRESH_S = 2.0
+
+# Respuestas cortas a un menú/pregunta ("1", "si", "5 excelente"): siempre van solas,
+# el paso de la conversación depende de ellas.
+_MENU_ANSWER = re.compile(r"^\s*(\d{1,2}\b.*|si|sí|s|no|n)\s*$", re.IGNORECASE)
+
+
+def can_coalesce(item: InboundEvent) -> bool:
+    """Solo texto libre se fusiona; respuestas interactivas y de menú no."""
+    return item.type == "text" and bool(item.text) and not _MENU_ANSWER.match(item.text)
+
+
+def merge_events(items: list[InboundEvent]) -> InboundEvent:
+    """Un solo turno con los textos en orden; conserva el último mensaje y la hora del primero."""
+    if len(items) == 1:
+        return items[0]
+    return replace(
+        items[-1],
+        text=" ".join(i.text.strip() for i in items if i.text),
+        received_at=items[0].received_at,
+    )
+
+
+def enqueue_message(
+    db: Session,
+    *,
+    wa_id: str,
+    msg_id: Optional[str],
+    text: str,
+    raw_message=None,
+    phone_number_id: Optional[str] = None,
+    delay_s: float = 0.0,
+) -> None:
+    """
+    Agrega el mensaje a la cola durable. El commit lo hace quien llama (junto a la idempotencia).
+    delay_s > 0 lo deja disponible más tarde (mensajes diferidos por el límite de entrada).
+    """
+    item = InboundQueueItem(
+        customer_wa_id=wa_id,
+        message_id=msg_id,
+        text=text or "",
+        raw_message=raw_message,
+        phone_number_id=phone_number_id,
+        status="PENDING",
+        attempts=0,
+    )
+    if delay_s > 0:
+        item.available_at = datetime.utcnow() + timedelta(seconds=delay_s)
+    db.add(item)
+
+
+def _claim_batch(limit: int) -> list[dict]:
+    """
+    Toma hasta `limit` mensajes PENDING (FOR UPDATE SKIP LOCKED) y los marca PROCESSING.
+
+    Solo el mensaje más antiguo de cada wa_id, y solo si ese wa_id no tiene otro
+    en PROCESSING: dos turnos del mismo usuario nunca van en paralelo ni en
+    desorden. Un mensaje anterior en PENDING (p. ej. en backoff tras un error)
+    retiene a los siguientes. Vale también entre consumidores concurrentes: en
+    cualquier snapshot el anterior se ve PENDING o PROCESSING.
+    """
+    q = aliased(InboundQueueItem)
+    busy = aliased(InboundQueueItem)
+    candidates = (
+        select(q.id)
+        .where(q.status == "PENDING")
+        .where(q.available_at <= func.now())
+        .where(
+            ~select(busy.id)
+            .where(busy.customer_wa_id == q.customer_wa_id)
+            .where(
+                or_(
+                    busy.status == "PROCESSING",
+                    and_(busy.status == "PENDING", busy.id < q.id),
+                )
+            )
+            .exists()
+        )
+        .order_by(q.id.asc())
+        .limit(limit)
+        .with_for_update(skip_locked=True, of=q)
+        .scalar_subquery()
+    )
+    stmt = (
+        update(InboundQueueItem)
+        .where(InboundQueueItem.id.in_(candidates))
+        .values(
+            status="PROCESSING",
+            locked_at=func.now(),
+            attempts=InboundQueueItem.attempts + 1,
+        )
+        .returning(
+            InboundQueueItem.id,
+            InboundQueueItem.customer_wa_id,
+            InboundQueueItem.message_id,
+            InboundQueueItem.text,
+            InboundQueueItem.raw_message,
+            InboundQueueItem.phone_number_id,
+            InboundQueueItem.attempts,
+            InboundQueueItem.created_at,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    with SessionLocal() as db:
+        rows = db.execute(stmt).mappings().all()
+        db.commit()
+    return sorted((dict(r) for r in rows), key=lambda r: r["id"])
+
+
+def _claim_followers(wa_id: str, after_id: int, limit: int) -> tuple[list[dict], bool]:
+    """
+    Marca PROCESSING los PENDING de wa_id posteriores a after_id mientras sean
+    texto libre ya disponible (se fusionan en el turno de after_id). Sin carrera
+    con otros consumidores: con after_id en PROCESSING, _claim_batch no entrega
+    nada de este wa_id. Devuelve (filas, cortado): cortado = la racha terminó en
+    un mensaje que debe ir solo.
+    """
+    q = InboundQueueItem
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(
+                q.id,
+                q.customer_wa_id,
+                q.message_id,
+                q.text,
+                q.raw_message,
+                q.phone_number_id,
+                q.attempts,
+                q.created_at,
+                (q.available_at <= func.now()).label("ready"),
+            )
+            .where(q.customer_wa_id == wa_id)
+            .where(q.status == "PENDING")
+            .where(q.id > after_id)
+            .order_by(q.id.asc())
+            .limit(limit)
+            .with_for_update()
+        ).mappings().all()
+        taken: list[dict] = []
+        cut = False
+        for r in rows:
+            if not r["ready"] or not can_coalesce(_to_event(r)):
+                cut = True
+                break
+            row = dict(r)
+            del row["ready"]
+            row["attempts"] += 1
+            taken.append(row)
+        if taken:
+            db.execute(
+                update(q)
+                .where(q.id.in_([r["id"] for r in taken]))
+                .values(status="PROCESSING", locked_at=func.now(), attempts=q.attempts + 1)
+            )
+        db.commit()
+    return taken, cut
+
+
+def _mark_done(item_ids: list[int]) -> None:
+    with SessionLocal() as db:
+        db.execute(
+            update(InboundQueueItem)
+            .where(InboundQueueItem.id.in_(item_ids))
+            .values(status="DONE", processed_at=func.now(), locked_at=None, last_error=None)
+        )
+        db.commit()
+
+
+def _mark_failed(item_id: int, attempts: int, error: str) -> None:
+    """
+    Reintenta con backoff exponencial; tras max_attempts queda FAILED. Mientras
+    espera, los mensajes posteriores del mismo wa_id no se toman (_claim_batch).
+    """
+    if attempts >= settings.inbound_queue_max_attempts:
+        values = {"status": "FAILED", "locked_at": None, "last_error": error[:2000]}
+    else:
+        delay_s = min(300.0, (2 ** attempts) + random.uniform(0, 1))
+        values = {
+            "status": "PENDING",
+            "locked_at": None,
+            "last_error": error[:2000],
+            "available_at": datetime.utcnow() + timedelta(seconds=delay_s),
+        }
+    with SessionLocal() as db:
+        db.execute(update(InboundQueueItem).where(InboundQueueItem.id == item_id).values(**values))
+        db.commit()
+
+
+def _pending_depth() -> int:
+    """Mensajes PENDING ya disponibles (cubierto por ix_inbound_queue_pending)."""
+    with SessionLocal() as db:
+        return db.execute(
+            select(func.count(InboundQueueItem.id))
+            .where(InboundQueueItem.status == "PENDING")
+            .where(InboundQueueItem.available_at <= func.now())
+        ).scalar_one()
+
+
+def _housekeeping() -> None:
+    """Libera mensajes PROCESSING abandonados (crash) y purga los DONE antiguos."""
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=settings.inbound_queue_lock_timeout_seconds)
+    done_before = now - timedelta(hours=settings.inbound_queue_retention_hours)
+    with SessionLocal() as db:
+        released = db.execute(
+            update(InboundQueueItem)
+            .where(InboundQueueItem.status == "PROCESSING")
+            .where(InboundQueueItem.locked_at < stale_before)
+            .values(status="PENDING", locked_at=None)
+        ).rowcount
+        purged = db.execute(
+            delete(InboundQueueItem)
+            .where(InboundQueueItem.status == "DONE")
+            .where(InboundQueueItem.processed_at < done_before)
+        ).rowcount
+        db.commit()
+    if released or purged:
+        logger.info("🧹 Inbound queue housekeeping | released=%s | purged=%s", released, purged)
+
+
+def _to_event(item) -> InboundEvent:
+    return InboundEvent(
+        wa_id=item["customer_wa_id"],
+        msg_id=item["message_id"],
+        type=(item["raw_message"] or {}).get("type"),
+        text=item["text"],
+        phone_number_id=item["phone_number_id"],
+        received_at=item["created_at"].timestamp(),
+        message=item["raw_message"],
+    )
+
+
+async def _take_followers(item: dict) -> list[dict]:
+    """
+    Ventana de fusión: espera CONVERSATION_COALESCE_MS por más textos del mismo
+    wa_id; se reinicia con cada texto nuevo, hasta CONVERSATION_COALESCE_MAX_MS.
+    """
+    coalesce_s = max(0, settings.conversation_coalesce_ms) / 1000.0
+    if not coalesce_s:
+        return []
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max(coalesce_s, settings.conversation_coalesce_max_ms / 1000.0)
+    followers: list[dict] = []
+    after_id = item["id"]
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(min(coalesce_s, remaining))
+        rows, cut = await asyncio.to_thread(
+            _claim_followers, item["customer_wa_id"], after_id, max(1, settings.inbound_queue_batch_size)
+        )
+        followers += rows
+        if not rows or cut:
+            break
+        after_id = rows[-1]["id"]
+    if followers:
+        metrics.inc("inbound_queue_coalesced_total", len(followers))
+    return followers
+
+
+async def _process_item(item: dict) -> None:
+    wa_id = item["customer_wa_id"]
+    items = [item]
+    if can_coalesce(_to_event(item)):
+        items += await _take_followers(item)
+    turn = merge_events([_to_event(i) for i in items])
+    try:
+        await executor.submit(wa_id, turn)
+    except Exception as e:
+        logger.exception("❌ Error procesando mensaje en cola | wa_id=%s | msg_id=%s | err=%s", wa_id, turn.msg_id, e)
+        for i in items:
+            await asyncio.to_thread(_mark_failed, i["id"], i["attempts"], repr(e))
+        return
+    await asyncio.to_thread(_mark_done, [i["id"] for i in items])
+
+
+class InboundQueueConsumers:
+    """
+    Pool de consumidores de la cola de entrada.
+
+    Cada consumidor toma un lote con SKIP LOCKED (varios procesos/réplicas pueden
+    drenar la misma tabla) y lo entrega al executor por wa_id: orden por usuario,
+    paralelismo entre usuarios. Los textos libres consecutivos de un wa_id que
+    llegan dentro de la ventana de fusión se ejecutan como un solo turno. El webhook llama a notify() tras encolar para no
+    esperar al siguiente poll.
+    """
+
+    def __init__(self) -> None:
+        self._tasks: list[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._pending = 0  # PENDING en la tabla a la última lectura (0 si no corren)
+
+        metrics.register_gauge("inbound_queue_pending", lambda: self._pending)
+
+    def pending_depth(self) -> int:
+        return self._pending if self._tasks else 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        n = max(1, settings.inbound_queue_consumers)
+        self._tasks = [asyncio.create_task(self._run(i), name=f"inbound-consumer-{i}") for i in range(n)]
+        logger.info("📥 Inbound queue consumers started | n=%s", n)
+
+    async def stop(self) -> None:
+        self._stopping = True
+        if self._wakeup:
+            self._wakeup.set()
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("📥 Inbound queue consumers stopped")
+
+    def notify(self) -> None:
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _wait(self, timeout_s: float) -> None:
+        assert self._wakeup is not None
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout_s)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run(self, idx: int) -> None:
+        poll_s = max(0.05, settings.inbound_queue_poll_interval_ms / 1000.0)
+        housekeeping_every_s = max(5.0, settings.inbound_queue_lock_timeout_seconds / 2)
+        last_housekeeping = 0.0
+        last_depth = 0.0
+        loop = asyncio.get_running_loop()
+
+        while not self._stopping:
+            try:
+                if idx == 0 and loop.time() - last_housekeeping >= housekeeping_every_s:
+                    last_housekeeping = loop.time()
+                    await asyncio.to_thread(_housekeeping)
+                if idx == 0 and loop.time() - last_depth >= DEPTH_REFRESH_S:
+                    # El backlog de ack-first vive en Postgres, no en el executor
+                    last_depth = loop.time()
+                    self._pending = await asyncio.to_thread(_pending_depth)
+
+                items = await asyncio.to_thread(_claim_batch, max(1, settings.inbound_queue_batch_size))
+                if not items:
+                    await self._wait(poll_s)
+                    continue
+                await asyncio.gather(*(_process_item(item) for item in items))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("❌ Inbound consumer %s falló; reintentando", idx)
+                await asyncio.sleep(poll_s)
+
+
+consumers = InboundQueueConsumers()
+load_shedder.add_depth_source(consumers.pending_depth)
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import re
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import delete, select, text
+from sqlalchemy.orm import Session
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.models import InboundMessage, InboundMessageLog
+from services.api.settings import settings
+
+logger = setup_logging("inbound_retention")
+
+LOG_TABLE = InboundMessageLog.__tablename__
+DEFAULT_PARTITION = f"{LOG_TABLE}_default"
+_PARTITION_NAME = re.compile(rf"^{LOG_TABLE}_(\d{{8}})$")
+
+
+def _partition_name(day: date) -> str:
+    return f"{LOG_TABLE}_{day:%Y%m%d}"
+
+
+def _today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def ensure_schema(db: Session) -> None:
+    """
+    create_all no agrega índices a tablas existentes: se asegura aquí el índice
+    que usa la poda de inbound_messages, más la partición DEFAULT del log.
+    """
+    db.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_inbound_messages_created_at ON inbound_messages (created_at)")
+    )
+    db.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {LOG_TABLE} DEFAULT"))
+
+
+def _bounds(day: date) -> tuple[str, str]:
+    return f"{day.isoformat()} 00:00:00+00", f"{(day + timedelta(days=1)).isoformat()} 00:00:00+00"
+
+
+def _create_partition(db: Session, day: date) -> None:
+    name = _partition_name(day)
+    start, end = _bounds(day)
+    in_range = f"created_at >= '{start}' AND created_at < '{end}'"
+    spilled = db.execute(text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_range})")).scalar()
+    if not spilled:
+        db.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {LOG_TABLE} FOR VALUES FROM ('{start}') TO ('{end}')"))
+        return
+    # La DEFAULT ya tiene filas de ese día (mantención atrasada): CREATE ... PARTITION OF
+    # fallaría. Se saca la DEFAULT, se crea el día, se mueven sus filas y se vuelve a adjuntar.
+    db.execute(text(f"ALTER TABLE {LOG_TABLE} DETACH PARTITION {DEFAULT_PARTITION}"))
+    db.execute(text(f"CREATE TABLE {name} PARTITION OF {LOG_TABLE} FOR VALUES FROM ('{start}') TO ('{end}')"))
+    moved = db.execute(
+        text(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE {in_range} RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        )
+    ).rowcount
+    db.execute(text(f"ALTER TABLE {LOG_TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    metrics.inc("inbound_log_default_moved_total", moved)
+    logger.warning("📦 Inbound log: %s filas movidas de la partición DEFAULT a %s", moved, name)
+
+
+def ensure_log_partitions(db: Session, days_ahead: int | None = None) -> int:
+    """
+    Crea las particiones diarias (UTC) de hoy y de los próximos días. Idempotente.
+    Cada día va en su savepoint: si uno falla, los demás se crean igual.
+    """
+    if days_ahead is None:
+        days_ahead = settings.inbound_log_partitions_ahead
+    today = _today()
+    created = 0
+    for offset in range(max(0, days_ahead) + 1):
+        day = today + timedelta(days=offset)
+        name = _partition_name(day)
+        exists = db.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar()
+        if exists:
+            continue
+        try:
+            with db.begin_nested():
+                _create_partition(db, day)
+        except Exception:
+            metrics.inc("inbound_log_partition_errors_total")
+            logger.exception("❌ Inbound log: no se pudo crear la partición %s", name)
+            continue
+        created += 1
+    return created
+
+
+def _log_partitions(db: Session) -> list[tuple[str, date]]:
+    rows = db.execute(
+        text(
+            """
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = :parent
+            """
+        ),
+        {"parent": LOG_TABLE},
+    ).scalars()
+    out = []
+    for name in rows:
+        m = _PARTITION_NAME.match(name)
+        if m:
+            out.append((name, datetime.strptime(m.group(1), "%Y%m%d").date()))
+    return sorted(out, key=lambda p: p[1])
+
+
+def drop_expired_log_partitions(db: Session) -> list[str]:
+    """DROP de las particiones diarias completamente fuera de la retención."""
+    retention_days = settings.inbound_text_retention_days
+    # Con 0 no se escriben textos nuevos: basta con 1 día para vaciar lo anterior
+    keep_from = _today() - timedelta(days=max(1, retention_days))
+    dropped = []
+    for name, day in _log_partitions(db):
+        if day < keep_from:
+            db.execute(text(f"DROP TABLE IF EXISTS {name}"))
+            dropped.append(name)
+    return dropped
+
+
+def prune_default_partition(db: Session) -> int:
+    """
+    Retención de la partición DEFAULT (no se puede dropear): DELETE de lo que
+    quedó ahí fuera de la ventana, p. ej. días en que la mantención no corrió.
+    """
+    keep_from = _today() - timedelta(days=max(1, settings.inbound_text_retention_days))
+    return db.execute(
+        text(f"DELETE FROM {DEFAULT_PARTITION} WHERE created_at < :keep_from"),
+        {"keep_from": datetime.combine(keep_from, datetime.min.time(), tzinfo=timezone.utc)},
+    ).rowcount
+
+
+def prune_dedup_ledger(db: Session) -> int:
+    """
+    Borra claves de inbound_messages fuera de la ventana de reintentos, en lotes
+    cortos (cada lote en su propia transacción) para no bloquear el webhook.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=settings.inbound_dedup_window_hours)
+    batch = max(1, settings.inbound_prune_batch_size)
+    total = 0
+    while True:
+        ids = (
+            select(InboundMessage.id)
+            .where(InboundMessage.created_at < cutoff)
+            .order_by(InboundMessage.created_at)
+            .limit(batch)
+            .scalar_subquery()
+        )
+        deleted = db.execute(delete(InboundMessage).where(InboundMessage.id.in_(ids))).rowcount
+        db.commit()
+        total += deleted
+        if deleted < batch:
+            return total
+
+
+def run_maintenance(db: Session) -> None:
+    """
+    Partición por adelantado + poda del log (DROP, y DELETE en la DEFAULT) y del
+    registro de dedup (DELETE por lotes). Cada parte por separado: un error en
+    las particiones no deja sin poda al registro de dedup.
+    """
+    created, dropped, default_pruned, pruned = 0, [], 0, 0
+    try:
+        ensure_schema(db)
+        created = ensure_log_partitions(db)
+        dropped = drop_expired_log_partitions(db)
+        default_pruned = prune_default_partition(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.exception("❌ Inbound retention: falló la mantención de particiones")
+    try:
+        pruned = prune_dedup_ledger(db)
+    except Exception:
+        db.rollback()
+        logger.exception("❌ Inbound retention: falló la poda del registro de dedup")
+
+    metrics.inc("inbound_log_partitions_created_total", created)
+    metrics.inc("inbound_log_partitions_dropped_total", len(dropped))
+    metrics.inc("inbound_log_default_pruned_total", default_pruned)
+    metrics.inc("inbound_dedup_pruned_total", pruned)
+    if created or dropped or default_pruned or pruned:
+        logger.info(
+            "🧹 Inbound retention | partitions_created=%s | partitions_dropped=%s | default_pruned=%s | dedup_pruned=%s",
+            created,
+            dropped,
+            default_pruned,
+            pruned,
+        )
@@ -0,0 +1,310 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import json
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.settings import settings
+from services.api.webhook_payload import InboundEvent
+
+try:  # mismo criterio que webhook_payload: orjson si está
+    import orjson
+
+    def _dumps(obj: dict) -> bytes:
+        return orjson.dumps(obj)
+
+    _loads = orjson.loads
+except ImportError:  # pragma: no cover
+    def _dumps(obj: dict) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    _loads = json.loads
+
+logger = setup_logging("inbound_spool")
+
+_PREFIX = "inbound-"
+_SUFFIX = ".jsonl"
+_DEAD_LETTER = "dead-letter.jsonl"
+
+# Una línea que falla por algo distinto a la DB caída se reintenta hasta aquí
+MAX_LINE_FAILURES = 3
+
+ReplayHandler = Callable[[list[InboundEvent]], Awaitable[None]]
+
+
+def spool_dir() -> str:
+    return settings.inbound_spool_dir or os.path.join(os.getenv("LOG_DIR", "logs"), "spool")
+
+
+def _record(event: InboundEvent) -> bytes:
+    return _dumps(dataclasses.asdict(event)) + b"\n"
+
+
+def _event(line: bytes) -> InboundEvent:
+    return InboundEvent(**_loads(line))
+
+
+def db_unavailable(exc: BaseException) -> bool:
+    """Error de conexión / disponibilidad (reintentar más tarde), no del evento en sí."""
+    if isinstance(exc, (OperationalError, InterfaceError, PoolTimeoutError, ConnectionError)):
+        return True
+    return isinstance(exc, DBAPIError) and exc.connection_invalidated
+
+
+def _write_and_sync(fh, data: bytes) -> None:
+    fh.write(data)
+    fh.flush()
+    os.fsync(fh.fileno())
+
+
+class InboundSpool:
+    """
+    Spool local (append-only, JSON lines) de eventos entrantes para cuando
+    Postgres no responde: el webhook escribe aquí en vez de perder el mensaje.
+
+    - fsync por lotes: las escrituras que llegan dentro de INBOUND_SPOOL_FSYNC_MS
+      comparten un solo fsync; append() vuelve recién con los datos en disco.
+    - Segmentos: el replayer rota el segmento activo y drena los cerrados en
+      orden (nombre = timestamp), borrando cada uno al terminarlo.
+    - Reproducir dos veces es inocuo: el replay pasa por la misma idempotencia
+      (uq_inbound_wa_msg) que el webhook.
+    - Orden: mientras quede algo en el spool (backlogged), el webhook sigue
+      escribiendo aquí aunque la DB ya responda; así lo nuevo no adelanta a lo
+      que espera replay.
+    - Un evento que falla por otra causa que la DB caída se reintenta
+      MAX_LINE_FAILURES veces y luego va a dead-letter.jsonl (no frena el resto).
+
+    Con la DB sana no se toca: cero latencia extra en el camino normal.
+    """
+
+    def __init__(self, directory: str, fsync_ms: int, replay_interval_s: float, replay_batch: int):
+        self.directory = directory
+        self.fsync_s = max(0, fsync_ms) / 1000.0
+        self.replay_interval_s = replay_interval_s
+        self.replay_batch = max(1, replay_batch)
+        self._fh = None
+        self._active: Optional[str] = None
+        self._pending: list[tuple[bytes, asyncio.Future]] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._tasks: list[asyncio.Task] = []
+        self._handler: Optional[ReplayHandler] = None
+        self._offsets: dict[str, int] = {}  # progreso del replay por segmento (líneas)
+        self._failures: dict[tuple[str, int], int] = {}  # (segmento, línea) -> fallos
+        self._backlog = False
+
+        metrics.register_gauge("inbound_spool_segments", lambda: len(self._segments()) if self._tasks else 0)
+
+    # -- escritura -----------------------------------------------------------
+
+    def _segments(self) -> list[str]:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if n.startswith(_PREFIX) and n.endswith(_SUFFIX))
+
+    def _open_segment(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._active = f"{_PREFIX}{time.time_ns():020d}{_SUFFIX}"
+        self._fh = open(os.path.join(self.directory, self._active), "ab")
+
+    def _close_segment(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+        self._fh = None
+        self._active = None
+
+    @property
+    def backlogged(self) -> bool:
+        """Hay eventos en el spool sin reproducir: lo nuevo también va al spool."""
+        return self._backlog
+
+    async def append(self, events: list[InboundEvent]) -> None:
+        """Escribe los eventos y espera el fsync del lote que los incluye."""
+        if not self._tasks:
+            raise RuntimeError("inbound spool no iniciado")
+        self._backlog = True  # antes del primer await: el chequeo del webhook ya lo ve
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((b"".join(_record(e) for e in events), fut))
+        self._wake.set()
+        await fut
+        metrics.inc("inbound_spooled_total", len(events))
+
+    async def _flusher(self) -> None:
+        while True:
+            await self._wake.wait()
+            if self.fsync_s:
+                await asyncio.sleep(self.fsync_s)  # junta más escrituras en el mismo fsync
+            self._wake.clear()
+            batch, self._pending = self._pending, []
+            if not batch:
+                continue
+            try:
+                async with self._lock:
+                    if self._fh is None:
+                        await asyncio.to_thread(self._open_segment)
+                    await asyncio.to_thread(_write_and_sync, self._fh, b"".join(data for data, _ in batch))
+                metrics.inc("inbound_spool_fsyncs_total")
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_result(None)
+            except Exception as e:
+                logger.exception("❌ Spool: no se pudo escribir en disco")
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    # -- replay --------------------------------------------------------------
+
+    def _read_lines(self, name: str) -> list[bytes]:
+        with open(os.path.join(self.directory, name), "rb") as fh:
+            return [line for line in fh.read().splitlines() if line.strip()]
+
+    def _dead_letter(self, name: str, line: bytes) -> None:
+        with open(os.path.join(self.directory, _DEAD_LETTER), "ab") as fh:
+            _write_and_sync(fh, line.rstrip(b"\n") + b"\n")
+
+    async def _replay_lines(self, name: str, start: int, chunk: list[bytes]) -> bool:
+        """
+        Reproduce una línea a la vez (tras fallar el lote por otra causa que la DB).
+        False si hay que pausar: DB caída o una línea que aún tiene reintentos.
+        """
+        for i, line in enumerate(chunk, start):
+            try:
+                await self._handler([_event(line)])
+            except Exception as e:
+                if db_unavailable(e):
+                    self._offsets[name] = i
+                    logger.warning("⏳ Spool: replay pausado (DB aún no disponible) | segment=%s | err=%r", name, e)
+                    return False
+                key = (name, i)
+                self._failures[key] = self._failures.get(key, 0) + 1
+                if self._failures[key] < MAX_LINE_FAILURES:
+                    self._offsets[name] = i
+                    logger.warning("⏳ Spool: evento falló, se reintenta | segment=%s | line=%s | err=%r", name, i, e)
+                    return False
+                await asyncio.to_thread(self._dead_letter, name, line)
+                self._failures.pop(key, None)
+                metrics.inc("inbound_spool_dead_letter_total")
+                logger.error("☠️ Spool: evento a dead-letter | segment=%s | line=%s | err=%r", name, i, e)
+                continue
+            metrics.inc("inbound_spool_replayed_total")
+        return True
+
+    async def _replay_segment(self, name: str) -> bool:
+        """True si el segmento quedó drenado (y borrado)."""
+        lines = await asyncio.to_thread(self._read_lines, name)
+        done = self._offsets.get(name, 0)
+        while done < len(lines):
+            chunk = lines[done : done + self.replay_batch]
+            events = []
+            for line in chunk:
+                try:
+                    events.append(_event(line))
+                except Exception:
+                    # Línea truncada (corte a mitad de escritura): no se puede recuperar
+                    metrics.inc("inbound_spool_corrupt_total")
+                    logger.error("❌ Spool: línea ilegible en %s (se omite)", name)
+            try:
+                if events:
+                    await self._handler(events)
+            except Exception as e:
+                if db_unavailable(e):
+                    self._offsets[name] = done
+                    logger.warning("⏳ Spool: replay pausado (DB aún no disponible) | segment=%s | err=%r", name, e)
+                    return False
+                # Algún evento del lote es el problema: línea a línea para aislarlo
+                if not await self._replay_lines(name, done, chunk):
+                    return False
+            else:
+                metrics.inc("inbound_spool_replayed_total", len(events))
+            done += len(chunk)
+        await asyncio.to_thread(os.remove, os.path.join(self.directory, name))
+        self._offsets.pop(name, None)
+        self._failures = {k: v for k, v in self._failures.items() if k[0] != name}
+        logger.info("✅ Spool: segmento reproducido | segment=%s | events=%s", name, len(lines))
+        return True
+
+    async def _replay_pass(self) -> bool:
+        """Drena los segmentos cerrados; True si todos quedaron reproducidos."""
+        async with self._lock:
+            # Rota el activo: lo escrito hasta aquí se drena; lo nuevo va a otro segmento
+            if self._fh is not None:
+                await asyncio.to_thread(self._close_segment)
+            segments = self._segments()
+            if not segments and not self._pending:
+                # Sin await entre el chequeo y esto: ningún append queda fuera
+                self._backlog = False
+                return True
+        if not segments:
+            await asyncio.sleep(self.fsync_s or 0.01)  # lote en camino al disco
+            return True
+        for name in segments:
+            if not await self._replay_segment(name):
+                return False
+        return True
+
+    async def _replayer(self) -> None:
+        while True:
+            try:
+                # Mientras se drene sin errores se sigue (lo que llegó durante el replay
+                # está en un segmento nuevo); al vaciarse, el webhook vuelve a la DB
+                while self._backlog and await self._replay_pass():
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("❌ Spool: error en el replayer")
+            await asyncio.sleep(self.replay_interval_s)
+
+    # -- ciclo de vida -------------------------------------------------------
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self, handler: ReplayHandler) -> None:
+        if self._tasks:
+            return
+        self._handler = handler
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        pending = self._segments()
+        if pending:
+            self._backlog = True
+            logger.warning("📼 Spool: %s segmentos pendientes de un arranque anterior", len(pending))
+        self._tasks = [
+            asyncio.create_task(self._flusher(), name="inbound-spool-flusher"),
+            asyncio.create_task(self._replayer(), name="inbound-spool-replayer"),
+        ]
+
+    async def stop(self) -> None:
+        if not self._tasks:
+            return
+        # Lo pendiente de escribir se sincroniza antes de cerrar
+        while self._pending:
+            self._wake.set()
+            await asyncio.sleep(self.fsync_s or 0.01)
+        async with self._lock:
+            pass  # espera un fsync en curso
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._close_segment()
+
+
+inbound_spool = InboundSpool(
+    directory=spool_dir(),
+    fsync_ms=settings.inbound_spool_fsync_ms,
+    replay_interval_s=settings.inbound_spool_replay_interval_seconds,
+    replay_batch=settings.inbound_spool_replay_batch,
+)
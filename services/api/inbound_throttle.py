@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+from typing import Optional
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.common.rate_limit import KeyedTokenBuckets, TokenBucket
+from services.api.settings import settings
+
+logger = setup_logging("inbound_throttle")
+
+
+class InboundThrottle:
+    """
+    Límite de entrada antes de handle_user_incoming: un bucket por wa_id más uno global.
+
+    admit() devuelve:
+      - 0.0   -> procesar ya
+      - > 0   -> diferir esos segundos (INBOUND_RATE_LIMIT_MODE=defer)
+      - None  -> descartar (sin DB, sin LLM, sin respuesta)
+    """
+
+    def __init__(
+        self,
+        user_rate_per_min: float,
+        user_burst: int,
+        global_rate_per_s: float,
+        global_burst: int,
+        mode: str = "reject",
+        defer_max_ms: int = 0,
+        max_keys: int = 100000,
+    ):
+        self.mode = mode
+        self.defer_max_s = max(0, defer_max_ms) / 1000.0
+        self.users = KeyedTokenBuckets(user_rate_per_min / 60.0, user_burst, max_keys=max_keys)
+        self.global_bucket = TokenBucket(global_rate_per_s, global_burst)
+
+        metrics.register_gauge("inbound_throttle_keys", lambda: len(self.users))
+
+    def _reject(self, wa_id: str, scope: str) -> None:
+        metrics.inc("inbound_throttled_total", scope=scope, action="rejected")
+        logger.debug("🚦 Mensaje descartado por límite | wa_id=%s | scope=%s", wa_id, scope)
+        return None
+
+    def admit(self, wa_id: str) -> Optional[float]:
+        user = self.users.get(wa_id)
+        if self.mode != "defer":
+            if not user.try_acquire():
+                return self._reject(wa_id, "user")
+            if not self.global_bucket.try_acquire():
+                user.refund()
+                return self._reject(wa_id, "global")
+            metrics.inc("inbound_admitted_total")
+            return 0.0
+
+        user_wait = user.wait_time()
+        global_wait = self.global_bucket.wait_time()
+        delay = max(user_wait, global_wait)
+        if delay > self.defer_max_s:
+            return self._reject(wa_id, "user" if user_wait >= global_wait else "global")
+        user.reserve()
+        self.global_bucket.reserve()
+        metrics.inc("inbound_admitted_total")
+        if delay > 0:
+            metrics.inc("inbound_throttled_total", scope="user" if user_wait >= global_wait else "global", action="deferred")
+            metrics.observe("inbound_defer_seconds", delay)
+        return delay
+
+
+inbound_throttle = InboundThrottle(
+    user_rate_per_min=settings.inbound_user_rate_per_min,
+    user_burst=settings.inbound_user_burst,
+    global_rate_per_s=settings.inbound_global_rate_per_s,
+    global_burst=settings.inbound_global_burst,
+    mode=settings.inbound_rate_limit_mode,
+    defer_max_ms=settings.inbound_defer_max_ms,
+)
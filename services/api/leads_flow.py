@@ -1,26 +1,29 @@
-from sqlalchemy import and_, func, or_
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from services.common.logging_config import setup_logging
 from datetime import datetime
 import unicodedata
 
-from services.api.matching import list_available_services
+from services.api.matching import list_available_services, list_known_comunas
 from services.api.models import (
     ConversationState,
     Customer,
     Lead,
     LeadOffer,
     Provider,
-    ProviderCoverage,
-    ProviderState,
     Review,
 )
 import difflib
 import re
 
 
+from services.api.match_keys import COMUNA_ALIASES
 from services.api.settings import settings
+from services.api.delivery_tracking import current_turn, set_turn_step
+from services.api.sender_pool import remember_sender
+from services.api.upserts import ensure_customer, get_or_create_current_lead, get_or_create_state
+from services.api.provider_followups import answer_summary, parse_reply, pending_questions, unresolved_prompt
 from services.api.whatsapp_cloud import send_list, send_template, send_text
 
 
@@ -37,20 +40,6 @@ def _normalize_text(text: str) -> str:
     t = unicodedata.normalize('NFD', t).encode('ascii', 'ignore').decode('ascii')
     return t
 
-# Comuna aliases for common abbreviations
-COMUNA_ALIASES = {
-    "conce": "concepcion",
-    "cpt": "concepcion",
-    "san pedro": "san pedro de la paz",
-    "spdp": "san pedro de la paz",
-    "los angeles": "los angeles",
-    "la": "los angeles",
-    "thno": "talcahuano",
-    "talc": "talcahuano",
-    "talcahuano": "talcahuano",
-    # Add more as needed
-}
-
 INTRO = (
     "Hola 👋 Soy ConectaPro.\n"
     "Te ayudo a conectar con profesionales según tu necesidad y comuna.\n\n"
@@ -181,44 +170,43 @@ def _sync_state_after_options(state: ConversationState, lead: Lead) -> None:
         state.step = "WAIT_CHOICE"
 
 
-def _ensure_customer(db: Session, wa_id: str) -> Customer:
-    cust = db.query(Customer).filter(Customer.wa_id == wa_id).first()
-    if not cust:
-        cust = Customer(wa_id=wa_id)
-        db.add(cust)
-        db.commit()
-    return cust
-
-
-def _clear_customer_pending(db: Session, wa_id: str, lead_id: int):
-    cust = db.query(Customer).filter(Customer.wa_id == wa_id).first()
+async def _clear_customer_pending(db: AsyncSession, wa_id: str, lead_id: int):
+    cust = await db.scalar(select(Customer).where(Customer.wa_id == wa_id))
     if cust and cust.pending_lead_id == lead_id:
         cust.pending_lead_id = None
         cust.blocked_until = None
-        db.commit()
 
 
-async def _handle_provider_followup(db: Session, provider: Provider, text: str) -> bool:
-    st = db.query(ProviderState).filter(ProviderState.provider_id == provider.id).first()
-    if not st or not st.pending_lead_id or not st.pending_question:
+async def _handle_provider_followup(db: AsyncSession, provider: Provider, text: str) -> bool:
+    # Preguntas pendientes por lead (el worker las envía en un digest: "12 SI", "15 NO")
+    pending = await db.run_sync(pending_questions, provider.id)
+    if not pending:
         return False
 
-    lead = db.query(Lead).filter(Lead.id == st.pending_lead_id).first()
-    if not lead:
-        return False
-
-    ans = _parse_yes_no(text)
-    if ans is None:
-        await send_text(provider.whatsapp_e164, "Responde 1=SI o 2=NO para continuar.")
-        return True
-
-    if st.pending_question == "CONTACT":
-        lead.provider_contact_confirmed = ans
-    elif st.pending_question == "SERVICE":
-        lead.provider_service_confirmed = ans
-
-    db.commit()
-    await send_text(provider.whatsapp_e164, "Gracias, respuesta registrada.")
+    answers = parse_reply(text, pending)
+    if not answers:
+        ans = _parse_yes_no(text)
+        if len(pending) > 1:
+            await send_text(provider.whatsapp_e164, unresolved_prompt(pending))
+            return True
+        if ans is None:
+            await send_text(provider.whatsapp_e164, "Responde 1=SI o 2=NO para continuar.")
+            return True
+        answers = {next(iter(pending)): ans}
+
+    for lead in await db.scalars(select(Lead).where(Lead.id.in_(list(answers)))):
+        if pending[lead.id] == "CONTACT":
+            lead.provider_contact_confirmed = answers[lead.id]
+        else:
+            lead.provider_service_confirmed = answers[lead.id]
+
+    if len(pending) == 1:
+        reply = "Gracias, respuesta registrada."
+    else:
+        reply = f"Gracias, respuesta registrada ({answer_summary(answers)})."
+        if len(answers) < len(pending):
+            reply += "\n\n" + unresolved_prompt(pending, answers)
+    await send_text(provider.whatsapp_e164, reply)
     return True
 
 
@@ -274,65 +262,53 @@ async def _notify_provider_new_lead(provider: Provider, lead: Lead) -> None:
     await send_text(provider.whatsapp_e164, message)
 
 
-async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=None):
+async def handle_user_incoming(db: AsyncSession, wa_id: str, text: str, raw_message=None):
     logger.info("➡️ Enter | wa_id=%s | text=%s", wa_id, text)
 
-    provider = db.query(Provider).filter(Provider.whatsapp_e164 == wa_id).first()
+    turn = current_turn.get()
+    inbound_number = turn.phone_number_id if turn else None
+
+    provider = await db.scalar(select(Provider).where(Provider.whatsapp_e164 == wa_id).limit(1))
     if provider:
+        remember_sender(db, provider, inbound_number)
+        set_turn_step("PROVIDER_FOLLOWUP")
         handled = await _handle_provider_followup(db, provider, text)
         if handled:
             return
         await send_text(provider.whatsapp_e164, "No tengo seguimientos pendientes para ti.")
         return
 
-    # Load / create conversation state
-    state = db.query(ConversationState).filter(ConversationState.customer_wa_id == wa_id).first()
-    if not state:
-        state = ConversationState(
-            customer_wa_id=wa_id,
-            step="START",
-            lead_id=None
-        )
-
-        db.add(state)
-        db.commit()
+    # Load / create conversation state + current lead (un round trip cada uno)
+    state, created = await get_or_create_state(db, wa_id)
+    if created:
         logger.info("🆕 Created ConversationState | wa_id=%s | step=START", wa_id)
+    remember_sender(db, state, inbound_number)
 
-    # Load / create current lead
-    lead = db.query(Lead).filter(Lead.customer_wa_id== wa_id).order_by(Lead.id.desc()).first()
-    if not lead:
-        lead = Lead(customer_wa_id=wa_id, status="OPEN")
-        db.add(lead)
-        db.commit()
+    lead, created = await get_or_create_current_lead(db, wa_id)
+    if created:
         logger.info("🆕 Created Lead | wa_id=%s | lead_id=%s", wa_id, lead.id)
     if not state.lead_id:
         state.lead_id = lead.id
-        db.commit()
 
     logger.info(
         "🧠 State snapshot | wa_id=%s | step=%s | lead_id=%s | status=%s | service=%s | comuna=%s",
         wa_id, state.step, lead.id, lead.status, lead.service, lead.comuna
     )
+    set_turn_step(state.step)
 
     if _is_greeting(text) and state.step != "START":
         state.step = "START"
         lead.status = "OPEN"
-        db.commit()
         await send_text(wa_id, INTRO)
         return
 
     # Service universe from DB (Provider.service values)
-    services = list_available_services(db)
+    services = await list_available_services(db)
     logger.info("📚 Services loaded | count=%s", len(services) if services else 0)
 
     _service_to_intent, intent_to_services = build_service_intent_index(services, NLU.intents)
-    known_comunas_rows = db.query(func.distinct(Provider.comuna)).filter(Provider.comuna.isnot(None)).all()
-    known_comunas_rows.extend(db.query(func.distinct(ProviderCoverage.comuna)).filter(ProviderCoverage.comuna.isnot(None)).all())
     comunas_map: dict[str, str] = {}
-    for row in known_comunas_rows:
-        raw = row[0]
-        if not raw:
-            continue
+    for raw in await list_known_comunas(db):
         key = _normalize_text(raw)
         comunas_map.setdefault(key, raw)
 
@@ -363,7 +339,6 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             state.step = "WAIT_INTENT_CLARIFICATION"
             state.temp_data = {"intent_options": nlu.clarifying_options}
             lead.status = "WAIT_SERVICE"
-            db.commit()
             await send_text(wa_id, nlu.clarifying_question)
             return
 
@@ -377,21 +352,19 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
                     nlu.intent_id,
                     comuna_canonical,
                 )
-                best_service = pick_best_service_for_intent(db, nlu.intent_id, comuna_key, intent_to_services)
+                best_service = await pick_best_service_for_intent(db, nlu.intent_id, comuna_key, intent_to_services)
                 if best_service:
                     lead.service = best_service
                     lead.comuna = comuna_canonical
 
                     lead.status = "WAIT_CHOICE"
                     state.step = "WAIT_CHOICE"
-                    db.commit()
                     from services.api.options import _send_options
                     await _send_options(db, wa_id, lead)
                     _sync_state_after_options(state, lead)
-                    db.commit()
                     return
 
-                available_comunas = get_available_comunas_for_intent(db, nlu.intent_id, intent_to_services, comuna_canonical)
+                available_comunas = await get_available_comunas_for_intent(db, nlu.intent_id, intent_to_services, comuna_canonical)
                 if available_comunas:
                     comunas_str = ", ".join(available_comunas[:5])
                     message = (
@@ -406,14 +379,13 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
                         "Describe el problema con más detalle o prueba otra comuna."
                     )
 
-                state.temp_data = state.temp_data or {}
-                state.temp_data["previous_intent"] = nlu.intent_id
                 lead.service = None
                 lead.comuna = None
 
                 lead.status = "WAIT_SERVICE"
                 state.step = "WAIT_SERVICE"
-                db.commit()
+                state.temp_data = state.temp_data or {}
+                state.temp_data["previous_intent"] = nlu.intent_id
                 await _send_comuna_picker(wa_id, message, available_comunas)
                 return
 
@@ -421,8 +393,7 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             lead.service = f"INTENT:{nlu.intent_id}"
             lead.status = "WAIT_COMUNA"
             state.step = "WAIT_COMUNA"
-            db.commit()
-            available_comunas = get_available_comunas_for_intent(
+            available_comunas = await get_available_comunas_for_intent(
                 db,
                 nlu.intent_id,
                 intent_to_services,
@@ -440,14 +411,12 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             lead.service = service_guess
             lead.status = "WAIT_COMUNA"
             state.step = "WAIT_COMUNA"
-            db.commit()
             await send_text(wa_id, "Perfecto. ¿En qué comuna necesitas al profesional?")
             return
 
         logger.info("🤷 No match -> WAIT_SERVICE")
         state.step = "WAIT_SERVICE"
         lead.status = "WAIT_SERVICE"
-        db.commit()
         await send_text(
             wa_id,
             "No logré identificar tu necesidad 😕\n"
@@ -484,7 +453,6 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             logger.warning("⚠️ Could not map label to intent_id -> WAIT_SERVICE")
             state.step = "WAIT_SERVICE"
             lead.status = "WAIT_SERVICE"
-            db.commit()
             await send_text(wa_id, "No pude resolver tu opción. Describe tu necesidad nuevamente.")
             return
 
@@ -492,7 +460,6 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
         lead.status = "WAIT_COMUNA"
         state.step = "WAIT_COMUNA"
         state.temp_data = {}
-        db.commit()
         await send_text(wa_id, "Gracias 👍 ¿En qué comuna necesitas al profesional?")
         return
 
@@ -510,7 +477,7 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
         
         if text_norm in comunas_set and prev_intent:
             logger.info("🔄 Detected comuna with previous intent | comuna=%s | intent=%s", text_norm, prev_intent)
-            best_service = pick_best_service_for_intent(db, prev_intent, text_norm, intent_to_services)
+            best_service = await pick_best_service_for_intent(db, prev_intent, text_norm, intent_to_services)
             logger.info("🎯 pick_best_service_for_intent result | best_service=%s", best_service)
             if best_service:
                 logger.info("✅ Found service for comuna | best_service=%s", best_service)
@@ -519,15 +486,13 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
                 lead.status = "WAIT_CHOICE"
                 state.step = "WAIT_CHOICE"
                 state.temp_data = {}  # Clear
-                db.commit()
                 from services.api.options import _send_options
                 await _send_options(db, wa_id, lead)
                 _sync_state_after_options(state, lead)
-                db.commit()
                 return
             else:
                 # No service in this comuna either
-                available_comunas = get_available_comunas_for_intent(db, prev_intent, intent_to_services, comuna_canonical)
+                available_comunas = await get_available_comunas_for_intent(db, prev_intent, intent_to_services, comuna_canonical)
                 if available_comunas:
                     comunas_str = ", ".join(available_comunas[:5])
                     message = (
@@ -545,7 +510,6 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
                 lead.status = "WAIT_SERVICE"
                 state.step = "WAIT_SERVICE"
                 state.temp_data = {}
-                db.commit()
                 await _send_comuna_picker(wa_id, message, available_comunas)
                 return
         
@@ -559,7 +523,6 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             logger.info("❓ Still ambiguous -> WAIT_INTENT_CLARIFICATION")
             state.step = "WAIT_INTENT_CLARIFICATION"
             state.temp_data = {"intent_options": nlu2.clarifying_options}
-            db.commit()
             await send_text(wa_id, nlu2.clarifying_question)
             return
 
@@ -568,8 +531,7 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             lead.service = f"INTENT:{nlu2.intent_id}"
             lead.status = "WAIT_COMUNA"
             state.step = "WAIT_COMUNA"
-            db.commit()
-            available_comunas = get_available_comunas_for_intent(
+            available_comunas = await get_available_comunas_for_intent(
                 db,
                 nlu2.intent_id,
                 intent_to_services,
@@ -587,7 +549,6 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             lead.service = service_guess
             lead.status = "WAIT_COMUNA"
             state.step = "WAIT_COMUNA"
-            db.commit()
             await send_text(wa_id, "Perfecto. ¿En qué comuna necesitas al profesional?")
             return
 
@@ -616,16 +577,12 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             logger.info("🔁 Resolving intent -> service | intent_id=%s | comuna=%s", intent_id, comuna)
 
             if intent_id:
-                best_service = pick_best_service_for_intent(db, intent_id, comuna_key, intent_to_services)
+                best_service = await pick_best_service_for_intent(db, intent_id, comuna_key, intent_to_services)
                 logger.info("🎯 pick_best_service_for_intent result | best_service=%s", best_service)
 
                 if not best_service:
-                    # Save previous intent for context
-                    state.temp_data = state.temp_data or {}
-                    state.temp_data["previous_intent"] = intent_id
-                    
                     # Get available comunas for this service
-                    available_comunas = get_available_comunas_for_intent(db, intent_id, intent_to_services, comuna_canonical)
+                    available_comunas = await get_available_comunas_for_intent(db, intent_id, intent_to_services, comuna_canonical)
                     if available_comunas:
                         comunas_str = ", ".join(available_comunas[:5])  # Limit to 5
                         message = (
@@ -643,7 +600,9 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
                     lead.comuna = None
                     lead.status = "WAIT_SERVICE"
                     state.step = "WAIT_SERVICE"
-                    db.commit()
+                    # Save previous intent for context
+                    state.temp_data = state.temp_data or {}
+                    state.temp_data["previous_intent"] = intent_id
                     await _send_comuna_picker(wa_id, message, available_comunas)
                     return
 
@@ -652,28 +611,22 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
         # Continue to options step (existing options sender)
         lead.status = "WAIT_CHOICE"
         state.step = "WAIT_CHOICE"
-        db.commit()
 
         logger.info("📤 Sending options | lead_id=%s | service=%s | comuna=%s", lead.id, lead.service, lead.comuna)
         from services.api.options import _send_options
         await _send_options(db, wa_id, lead)
         _sync_state_after_options(state, lead)
-        db.commit()
         return
 
     # STEP: WAIT_CHOICE
     if state.step == "WAIT_CHOICE":
         offers = (
-            db.query(LeadOffer)
-            .filter(LeadOffer.lead_id == lead.id)
-            .order_by(LeadOffer.rank.asc())
-            .all()
-        )
+            await db.scalars(select(LeadOffer).where(LeadOffer.lead_id == lead.id).order_by(LeadOffer.rank.asc()))
+        ).all()
         if not offers:
             await send_text(wa_id, "No tengo opciones disponibles. Describe nuevamente tu necesidad.")
             state.step = "WAIT_SERVICE"
             lead.status = "WAIT_SERVICE"
-            db.commit()
             return
 
         choice_raw = (text or "").strip()
@@ -690,7 +643,6 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
         lead.provider_id = chosen.provider_id
         lead.status = "WAIT_CONSENT"
         state.step = "WAIT_CONSENT"
-        db.commit()
         await send_text(
             wa_id,
             "¿Autorizas que compartamos tu número con este profesional para que te contacte?\n"
@@ -708,27 +660,24 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
         if not consent:
             lead.status = "WAIT_CHOICE"
             state.step = "WAIT_CHOICE"
-            db.commit()
             from services.api.options import _send_options
             await _send_options(db, wa_id, lead)
             return
 
-        provider = db.query(Provider).filter(Provider.id == lead.provider_id).first()
+        provider = await db.scalar(select(Provider).where(Provider.id == lead.provider_id))
         if not provider:
             await send_text(wa_id, "No pude encontrar al profesional seleccionado. Elige otra opción.")
             lead.status = "WAIT_CHOICE"
             state.step = "WAIT_CHOICE"
-            db.commit()
             from services.api.options import _send_options
             await _send_options(db, wa_id, lead)
             return
 
-        _ensure_customer(db, wa_id)
+        await ensure_customer(db, wa_id)
 
         lead.status = "CONNECTED"
         lead.connected_at = datetime.utcnow()
         state.step = "CONNECTED"
-        db.commit()
 
         await send_text(
             wa_id,
@@ -746,7 +695,6 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             await send_text(wa_id, "Responde 1=SI o 2=NO para continuar.")
             return
         lead.user_contact_confirmed = ans
-        db.commit()
         await send_text(wa_id, "Gracias, respuesta registrada.")
         return
 
@@ -757,7 +705,6 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             await send_text(wa_id, "Responde 1=SI o 2=NO para continuar.")
             return
         lead.user_service_confirmed = ans
-        db.commit()
         await send_text(wa_id, "Gracias, respuesta registrada.")
         return
 
@@ -769,22 +716,19 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
             return
         if rating == 0:
             lead.status = "CLOSED"
-            db.commit()
-            _clear_customer_pending(db, wa_id, lead.id)
+            await _clear_customer_pending(db, wa_id, lead.id)
             await send_text(wa_id, "Gracias, tu caso fue cerrado.")
             return
 
-        provider = db.query(Provider).filter(Provider.id == lead.provider_id).first()
+        provider = await db.scalar(select(Provider).where(Provider.id == lead.provider_id))
         if provider:
             provider.rating_avg = (
                 (provider.rating_avg * provider.rating_count + rating) / (provider.rating_count + 1)
             )
             provider.rating_count += 1
-            db.commit()
 
         lead.rating_stars = rating
         lead.status = "CLOSED"
-        db.commit()
 
         if provider:
             review = Review(
@@ -795,14 +739,12 @@ async def handle_user_incoming(db: Session, wa_id: str, text: str, raw_message=N
                 comment=(text or "").strip(),
             )
             db.add(review)
-            db.commit()
 
-        _clear_customer_pending(db, wa_id, lead.id)
+        await _clear_customer_pending(db, wa_id, lead.id)
         await send_text(wa_id, "¡Gracias por tu evaluación! Caso cerrado.")
         return
 
     # Unknown step safety
     logger.warning("⚠️ Unknown step -> resetting to START | step=%s", state.step)
     state.step = "START"
-    db.commit()
     await send_text(wa_id, INTRO)
@@ -8,7 +8,7 @@ from sqlalchemy.orm import Session
 
 from services.common.logging_config import setup_logging
 from .knowledge_base import describe_conectapro
-from .matching import find_top_providers, list_available_services
+from .matching import find_top_providers_sync, list_available_services_sync
 from .models import Provider, ProviderCoverage
 from .nlu.engine import _norm
 from .settings import settings
@@ -201,17 +201,15 @@ Responde como orquestador: decide qué hacer y usa tools si es necesario.
         name = tool_call.function.name
         args = json.loads(tool_call.function.arguments)
 
-        lead_id = context.get("lead_id")
-        lead = None
-        if lead_id:
-            from .models import Lead
-            lead = db.query(Lead).filter(Lead.id == lead_id).first()
+        # Los cambios al lead no se escriben aquí (sesión de solo lectura en un
+        # thread): viajan en "lead_update" y los aplica el turno en su sesión.
+        has_lead = bool(context.get("lead_id"))
 
         if name == "describe_conectapro":
             return {"type": "describe_conectapro", "result": describe_conectapro()}
 
         if name == "list_services":
-            services = list_available_services(db)
+            services = list_available_services_sync(db)
             return {"type": "list_services", "result": services}
 
         if name == "query_providers":
@@ -222,22 +220,18 @@ Responde como orquestador: decide qué hacer y usa tools si es necesario.
             # Lógica similar a pick_best_service_for_intent
             # Retornar lista de proveedores
             providers = self._query_providers(db, service, comuna_norm)
-            # Update lead
-            if lead:
-                lead.service = service
-                lead.comuna = comuna
-                db.commit()
-            return {"type": "query_providers", "result": providers}
+            action = {"type": "query_providers", "result": providers}
+            if has_lead:
+                action["lead_update"] = {"service": service, "comuna": comuna}
+            return action
 
         if name == "list_comunas":
             service = args.get("service")
             comunas = self._get_comunas(db, service)
-            # Update lead
-            if lead:
-                if service:
-                    lead.service = service
-                db.commit()
-            return {"type": "list_comunas", "result": comunas}
+            action = {"type": "list_comunas", "result": comunas}
+            if has_lead and service:
+                action["lead_update"] = {"service": service}
+            return action
 
         if name == "send_options":
             lead_id = args.get("lead_id")
@@ -249,7 +243,7 @@ Responde como orquestador: decide qué hacer y usa tools si es necesario.
     def _query_providers(self, db: Session, service: str, comuna_norm: str) -> List[Dict]:
         if not service or not comuna_norm:
             return []
-        providers = find_top_providers(db, service=service, comuna=comuna_norm, limit=3)
+        providers = find_top_providers_sync(db, service=service, comuna=comuna_norm, limit=3)
         return [
             {"id": provider.id, "service": provider.service, "rating": provider.rating_avg}
             for provider in providers
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
+import asyncio
 from typing import Any
 
-from sqlalchemy import func
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from services.common.logging_config import setup_logging
+from services.api.db import SessionLocal
 from services.api.llm_orchestrator import get_orchestrator
+from services.api.load_shedding import load_shedder
 from services.api.matching import list_available_services
 from services.api.models import Lead, Provider, ProviderCoverage
 from services.api.settings import settings
@@ -15,26 +18,28 @@ from services.api.whatsapp_cloud import send_text
 logger = setup_logging("llm_router")
 
 
-def _list_available_comunas(db: Session) -> list[str]:
-    rows_cov = (
-        db.query(func.distinct(ProviderCoverage.comuna))
+async def _list_available_comunas(db: AsyncSession) -> list[str]:
+    rows_cov = await db.scalars(
+        select(func.distinct(ProviderCoverage.comuna))
         .join(Provider, Provider.id == ProviderCoverage.provider_id)
-        .filter(Provider.active == True)
-        .all()
+        .where(Provider.active == True)
     )
-    rows_direct = (
-        db.query(func.distinct(Provider.comuna))
-        .filter(Provider.active == True)
-        .all()
-    )
-    comunas = {row[0] for row in rows_cov if row[0]}
-    comunas |= {row[0] for row in rows_direct if row[0]}
+    comunas = {c for c in rows_cov if c}
+    rows_direct = await db.scalars(select(func.distinct(Provider.comuna)).where(Provider.active == True))
+    comunas |= {c for c in rows_direct if c}
     return sorted(comunas)
 
 
+def _orchestrate(orchestrator, text: str, context: dict, services: list[str], comunas: list[str]) -> dict:
+    # Las tools del orquestador son síncronas: usan su propia sesión en el thread,
+    # solo para leer (no toma locks ni espera los del turno)
+    with SessionLocal() as db:
+        return orchestrator.orchestrate_response(text, context, db, services, comunas)
+
+
 async def try_handle_llm(
     *,
-    db: Session,
+    db: AsyncSession,
     wa_id: str,
     text: str,
     state: Any,
@@ -46,14 +51,18 @@ async def try_handle_llm(
     if state.step in {"WAIT_CHOICE", "WAIT_CONSENT", "CONNECTED"}:
         return False
 
+    # Modo degradado: el flujo por reglas responde sin esperar a OpenAI
+    if load_shedder.skip("llm_router"):
+        return False
+
     try:
         orchestrator = get_orchestrator()
     except Exception as exc:
         logger.warning("LLM orchestrator unavailable: %s", exc)
         return False
 
-    services = list_available_services(db)
-    comunas = _list_available_comunas(db)
+    services = await list_available_services(db)
+    comunas = await _list_available_comunas(db)
     context = {
         "step": state.step,
         "current_service": lead.service,
@@ -61,23 +70,28 @@ async def try_handle_llm(
         "lead_id": lead.id,
     }
 
-    result = orchestrator.orchestrate_response(text, context, db, services, comunas)
+    # El cliente OpenAI del orquestador es síncrono: se ejecuta en un thread para
+    # no bloquear el event loop (webhook y demás conversaciones). Sus tools solo
+    # leen; los cambios al lead se aplican aquí y salen con el commit del turno.
+    result = await asyncio.to_thread(_orchestrate, orchestrator, text, context, services, comunas)
     actions = result.get("actions", [])
     response_text = result.get("response") or ""
 
+    for action in actions:
+        for field, value in (action.get("lead_update") or {}).items():
+            setattr(lead, field, value)
+
     for action in actions:
         if action.get("type") == "send_options":
             from services.api.options import _send_options
 
             lead.status = "WAIT_CHOICE"
             state.step = "WAIT_CHOICE"
-            db.commit()
             await _send_options(db, wa_id, lead)
             if lead.status == "WAIT_SERVICE":
                 state.step = "WAIT_SERVICE"
             elif lead.status == "WAIT_CHOICE":
                 state.step = "WAIT_CHOICE"
-            db.commit()
 
     if response_text:
         await send_text(wa_id, response_text)
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.settings import settings
+
+logger = setup_logging("load_shedding")
+
+
+class LoadShedder:
+    """
+    Modo degradado automático del pipeline de conversación.
+
+    Señales: mensajes esperando (en el executor y, en modo ack-first, PENDING en
+    la cola durable inbound_queue) y p99 de la duración de los turnos (espera +
+    ejecución) en una ventana móvil. Entra en modo degradado cuando
+    alguna supera su umbral de entrada; sale solo cuando ambas bajan de los de
+    salida y pasó el tiempo mínimo en el modo (histéresis, sin oscilar).
+
+    En modo degradado se apagan los caminos caros y opcionales (try_handle_llm y
+    la mitad LLM de NLUEngine.parse_hybrid): queda NLU por reglas y matching con cache.
+    """
+
+    def __init__(
+        self,
+        enter_depth: int,
+        exit_depth: int,
+        enter_p99_s: float,
+        exit_p99_s: float,
+        window_s: float,
+        min_hold_s: float,
+        eval_interval_s: float = 1.0,
+        max_samples: int = 5000,
+    ):
+        self.enter_depth = enter_depth
+        self.exit_depth = min(exit_depth, enter_depth)
+        self.enter_p99_s = enter_p99_s
+        self.exit_p99_s = min(exit_p99_s, enter_p99_s)
+        self.window_s = window_s
+        self.min_hold_s = min_hold_s
+        self.eval_interval_s = eval_interval_s
+        self._samples: Deque[Tuple[float, float]] = deque(maxlen=max_samples)
+        self._depth_fns: list[Callable[[], int]] = []
+        self._degraded = False
+        self._changed_at = 0.0
+        self._evaluated_at = 0.0
+        self._p99: Optional[float] = None
+
+        metrics.register_gauge("load_shedding_degraded", lambda: int(self._degraded))
+        metrics.register_gauge("load_shedding_turn_p99_seconds", lambda: self._p99 or 0.0)
+
+    def add_depth_source(self, fn: Callable[[], int]) -> None:
+        """Fuente de mensajes en espera; la profundidad es la suma de todas (sin I/O: se llama en el turno)."""
+        self._depth_fns.append(fn)
+
+    def observe_turn(self, seconds: float) -> None:
+        self._samples.append((time.monotonic(), seconds))
+
+    def _window_p99(self, now: float) -> Optional[float]:
+        cutoff = now - self.window_s
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+        if not self._samples:
+            return None
+        values = sorted(s for _, s in self._samples)
+        return values[min(len(values) - 1, int(0.99 * len(values)))]
+
+    def _evaluate(self, now: float) -> None:
+        self._evaluated_at = now
+        depth = sum(fn() for fn in self._depth_fns)
+        p99 = self._p99 = self._window_p99(now)
+        slow = p99 is not None and p99 >= self.enter_p99_s
+        if not self._degraded:
+            if depth >= self.enter_depth or slow:
+                self._switch(True, now, depth, p99)
+            return
+        recovered = depth <= self.exit_depth and (p99 is None or p99 <= self.exit_p99_s)
+        if recovered and now - self._changed_at >= self.min_hold_s:
+            self._switch(False, now, depth, p99)
+
+    def _switch(self, degraded: bool, now: float, depth: int, p99: Optional[float]) -> None:
+        self._degraded = degraded
+        self._changed_at = now
+        mode = "degraded" if degraded else "normal"
+        metrics.inc("load_shedding_transitions_total", to=mode)
+        log = logger.warning if degraded else logger.info
+        log("🛟 Load shedding -> %s | queue_depth=%s | turn_p99=%s", mode, depth, p99)
+
+    def degraded(self) -> bool:
+        if not settings.load_shedding_enabled:
+            return False
+        now = time.monotonic()
+        if now - self._evaluated_at >= self.eval_interval_s:
+            self._evaluate(now)
+        return self._degraded
+
+    def skip(self, path: str) -> bool:
+        """True si `path` debe omitirse ahora (y lo cuenta)."""
+        if self.degraded():
+            metrics.inc("load_shedding_skipped_total", path=path)
+            return True
+        return False
+
+
+load_shedder = LoadShedder(
+    enter_depth=settings.load_shedding_enter_queue_depth,
+    exit_depth=settings.load_shedding_exit_queue_depth,
+    enter_p99_s=settings.load_shedding_enter_p99_seconds,
+    exit_p99_s=settings.load_shedding_exit_p99_seconds,
+    window_s=settings.load_shedding_window_seconds,
+    min_hold_s=settings.load_shedding_min_hold_seconds,
+)
@@ -5,8 +5,19 @@ import time
 from sqlalchemy.exc import OperationalError
 
 from services.common.logging_config import setup_logging
-from .db import Base, engine
-from .whatsapp_webhook import router as whatsapp_router
+from services.common.metrics import metrics
+from .campaigns import campaign_runner, router as campaigns_router
+from .db import Base, SessionLocal, async_engine, engine
+from .delivery_tracking import delivery_tracker
+from .graph_client import graph_client
+from .inbound_queue import consumers as inbound_consumers
+from .inbound_spool import inbound_spool
+from .inbound_retention import ensure_log_partitions, ensure_schema
+from .outbox import outbox_relay
+from .schema_upgrades import apply_schema_upgrades
+from .settings import settings
+from .whatsapp_cloud import dispatcher
+from .whatsapp_webhook import replay_spooled, router as whatsapp_router
 
 logger = setup_logging("api")
 
@@ -22,6 +33,11 @@ def startup():
     while True:
         try:
             Base.metadata.create_all(bind=engine)
+            with SessionLocal() as db:
+                apply_schema_upgrades(db)
+                ensure_schema(db)
+                ensure_log_partitions(db)
+                db.commit()
             logger.info("✅ DB OK y tablas listas")
             break
         except OperationalError:
@@ -32,6 +48,33 @@ def startup():
             time.sleep(2)
 
 
+@app.on_event("startup")
+async def start_inbound_consumers():
+    dispatcher.start()
+    if settings.outbox_enabled:
+        await outbox_relay.start(dispatcher)
+    if settings.delivery_tracking_enabled:
+        await delivery_tracker.start()
+    if settings.inbound_queue_enabled:
+        await inbound_consumers.start()
+    if settings.inbound_spool_enabled:
+        await inbound_spool.start(replay_spooled)
+    await campaign_runner.resume_interrupted()
+
+
+@app.on_event("shutdown")
+async def stop_inbound_consumers():
+    await inbound_spool.stop()
+    if inbound_consumers.running:
+        await inbound_consumers.stop()
+    await campaign_runner.stop()
+    await outbox_relay.stop()
+    await dispatcher.stop()
+    await delivery_tracker.stop()
+    await graph_client.aclose()
+    await async_engine.dispose()
+
+
 @app.exception_handler(Exception)
 async def unhandled_exception_handler(request: Request, exc: Exception):
     logger.exception("Unhandled exception | %s %s", request.method, request.url.path)
@@ -39,8 +82,14 @@ async def unhandled_exception_handler(request: Request, exc: Exception):
 
 
 app.include_router(whatsapp_router)
+app.include_router(campaigns_router)
 
 
 @app.get("/health")
 def health():
     return {"ok": True}
+
+
+@app.get("/metrics")
+def get_metrics():
+    return metrics.snapshot()
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import hashlib
+
+# Claves normalizadas para el matching de servicio y comuna.
+# providers.service_key / providers.comuna_key / provider_coverage.comuna_key las
+# mantiene Postgres con un trigger (así también cubren los INSERT a mano de
+# docs/sql); el código compara contra ellas con la misma normalización en Python.
+
+# Abreviaturas y nombres cortos de comunas (claves ya normalizadas)
+COMUNA_ALIASES = {
+    "conce": "concepcion",
+    "cpt": "concepcion",
+    "san pedro": "san pedro de la paz",
+    "spdp": "san pedro de la paz",
+    "los angeles": "los angeles",
+    "la": "los angeles",
+    "thno": "talcahuano",
+    "talc": "talcahuano",
+    "talcahuano": "talcahuano",
+    # Add more as needed
+}
+
+_ACCENTS = "áéíóúüñ_-"
+_PLAIN = "aeiouun  "
+_TRANSLATION = str.maketrans(_ACCENTS, _PLAIN)
+
+
+def match_key(value: str | None) -> str:
+    """Minúsculas, sin tildes, '_'/'-' como espacio y espacios colapsados."""
+    if not value:
+        return ""
+    return " ".join(value.lower().translate(_TRANSLATION).split())
+
+
+def comuna_key(value: str | None) -> str:
+    key = match_key(value)
+    return COMUNA_ALIASES.get(key, key)
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _alias_cases() -> str:
+    return " ".join(
+        f"WHEN {_quote(alias)} THEN {_quote(target)}" for alias, target in COMUNA_ALIASES.items() if alias != target
+    )
+
+
+# Mismas reglas que match_key/comuna_key, en SQL (IMMUTABLE: usables en índices).
+_FUNCTIONS = [
+    f"""
+    CREATE OR REPLACE FUNCTION conectapro_match_key(value text) RETURNS text
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT NULLIF(btrim(regexp_replace(translate(lower(value), '{_ACCENTS}', '{_PLAIN}'), '\\s+', ' ', 'g')), '')
+    $$
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION conectapro_comuna_key(value text) RETURNS text
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT CASE k {_alias_cases()} ELSE k END FROM (SELECT conectapro_match_key(value) AS k) AS s
+    $$
+    """,
+]
+
+# Versión de las reglas (definición de las funciones + COMUNA_ALIASES): queda como
+# COMMENT de conectapro_comuna_key y el backfill solo corre cuando cambia.
+KEYS_VERSION = hashlib.sha1("".join(_FUNCTIONS).encode("utf-8")).hexdigest()[:16]
+
+
+def _create_trigger_if_missing(name: str, table: str, ddl: str) -> str:
+    # CREATE TRIGGER toma ACCESS EXCLUSIVE: solo si no existe (no en cada arranque)
+    return f"""
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger WHERE tgname = '{name}' AND tgrelid = '{table}'::regclass
+        ) THEN
+            {ddl};
+        END IF;
+    END
+    $$
+    """
+
+
+# Reaplicable en cada arranque sin tocar las tablas si nada cambió: columnas e
+# índices IF NOT EXISTS, triggers solo si faltan, backfill solo con reglas nuevas.
+MATCH_KEY_DDL: list[str] = [
+    "ALTER TABLE providers ADD COLUMN IF NOT EXISTS service_key VARCHAR(64)",
+    "ALTER TABLE providers ADD COLUMN IF NOT EXISTS comuna_key VARCHAR(64)",
+    "ALTER TABLE provider_coverage ADD COLUMN IF NOT EXISTS comuna_key VARCHAR(64)",
+    *_FUNCTIONS,
+    """
+    CREATE OR REPLACE FUNCTION providers_set_match_keys() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.service_key := conectapro_match_key(NEW.service);
+        NEW.comuna_key := conectapro_comuna_key(NEW.comuna);
+        RETURN NEW;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION provider_coverage_set_match_keys() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.comuna_key := conectapro_comuna_key(NEW.comuna);
+        RETURN NEW;
+    END
+    $$
+    """,
+    _create_trigger_if_missing(
+        "trg_providers_match_keys",
+        "providers",
+        "CREATE TRIGGER trg_providers_match_keys BEFORE INSERT OR UPDATE OF service, comuna ON providers "
+        "FOR EACH ROW EXECUTE FUNCTION providers_set_match_keys()",
+    ),
+    _create_trigger_if_missing(
+        "trg_provider_coverage_match_keys",
+        "provider_coverage",
+        "CREATE TRIGGER trg_provider_coverage_match_keys BEFORE INSERT OR UPDATE OF comuna ON provider_coverage "
+        "FOR EACH ROW EXECUTE FUNCTION provider_coverage_set_match_keys()",
+    ),
+    f"""
+    DO $$
+    BEGIN
+        IF obj_description('conectapro_comuna_key(text)'::regprocedure, 'pg_proc') IS DISTINCT FROM '{KEYS_VERSION}' THEN
+            UPDATE providers
+            SET service_key = conectapro_match_key(service), comuna_key = conectapro_comuna_key(comuna)
+            WHERE service_key IS DISTINCT FROM conectapro_match_key(service)
+               OR comuna_key IS DISTINCT FROM conectapro_comuna_key(comuna);
+            UPDATE provider_coverage
+            SET comuna_key = conectapro_comuna_key(comuna)
+            WHERE comuna_key IS DISTINCT FROM conectapro_comuna_key(comuna);
+            COMMENT ON FUNCTION conectapro_comuna_key(text) IS '{KEYS_VERSION}';
+        END IF;
+    END
+    $$
+    """,
+    # Matching = un range scan: servicio+comuna directos, o servicio y luego cobertura
+    """
+    CREATE INDEX IF NOT EXISTS ix_providers_match
+    ON providers (service_key, comuna_key, active, rating_avg DESC)
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_provider_coverage_match ON provider_coverage (comuna_key, provider_id)",
+]
@@ -1,16 +1,21 @@
 from __future__ import annotations
 
+import time
 from datetime import datetime
+from typing import Any
 
-
-from sqlalchemy import and_, func, or_
+from sqlalchemy import Select, and_, exists, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
+from .load_shedding import load_shedder
+from .match_keys import comuna_key, match_key
 from .models import Provider, ProviderCoverage
+from .settings import settings
 
-
-def _norm(s: str) -> str:
-    return (s or "").strip().lower()
+# Catálogos leídos en cada turno (servicios, comunas). Siempre se refrescan en
+# modo normal; en modo degradado se sirven desde aquí mientras no venza el TTL.
+_lookup_cache: dict[str, tuple[float, Any]] = {}
 
 
 def is_provider_blocked(p: Provider) -> bool:
@@ -20,62 +25,112 @@ def is_provider_blocked(p: Provider) -> bool:
     return p.blocked_until.replace(tzinfo=None) > datetime.utcnow()
 
 
-def _matches_comuna(provider: Provider, comuna_n: str) -> bool:
-    if not comuna_n:
-        return True
-    if provider.coverage_areas:
-        return any(_norm(cov.comuna) == comuna_n for cov in provider.coverage_areas)
-    return _norm(provider.comuna) == comuna_n
+def _cached(key: str) -> Any:
+    """Valor cacheado si estamos en modo degradado y no venció el TTL; si no, None."""
+    hit = _lookup_cache.get(key)
+    if hit is not None and load_shedder.degraded() and time.monotonic() - hit[0] < settings.matching_cache_ttl_seconds:
+        return hit[1]
+    return None
 
 
-def list_available_services(db: Session) -> list[str]:
-    """Servicios disponibles según providers activos."""
-    rows = (
-        db.query(Provider.service)
-        .filter(Provider.active == True)
+def _store(key: str, value: Any) -> Any:
+    _lookup_cache[key] = (time.monotonic(), value)
+    return value
+
+
+def _services_stmt() -> Select:
+    return (
+        select(Provider.service)
+        .where(Provider.active == True)
         .distinct()
         .order_by(Provider.service.asc())
-        .all()
     )
-    return [r[0] for r in rows if r and r[0]]
 
 
-def find_top_providers(db: Session, service: str, comuna: str, limit: int = 3) -> list[Provider]:
-    """Top providers por rating (y cantidad) para servicio+comuna, excluyendo bloqueados."""
-    service_n = _norm(service)
-    comuna_n = _norm(comuna)
-    if not service_n or not comuna_n:
-        return []
-
-    query = (
-        db.query(Provider)
-        .outerjoin(ProviderCoverage, ProviderCoverage.provider_id == Provider.id)
-        .filter(Provider.active == True)
-        .filter(func.lower(Provider.service) == service_n)
-        .filter(
+def _top_providers_stmt(service_k: str, comuna_k: str, limit: int) -> Select:
+    # Con cobertura declarada manda la cobertura; sin ella, la comuna del provider.
+    # Ambas ramas son range scans sobre ix_providers_match / ix_provider_coverage_match.
+    covered = select(ProviderCoverage.provider_id).where(ProviderCoverage.comuna_key == comuna_k)
+    has_coverage = exists().where(ProviderCoverage.provider_id == Provider.id)
+    stmt = (
+        select(Provider)
+        .where(Provider.service_key == service_k)
+        .where(Provider.active == True)
+        .where(
             or_(
-                func.lower(ProviderCoverage.comuna) == comuna_n,
-                and_(ProviderCoverage.id.is_(None), func.lower(Provider.comuna) == comuna_n),
+                Provider.id.in_(covered),
+                and_(Provider.comuna_key == comuna_k, ~has_coverage),
             )
         )
-
         .order_by(Provider.rating_avg.desc(), Provider.rating_count.desc(), Provider.id.asc())
     )
-
     if limit > 0:
-        query = query.limit(limit * 3)  # traemos extra para poder filtrar bloqueados
+        stmt = stmt.limit(limit * 3)  # traemos extra para poder filtrar bloqueados
+    return stmt
 
-    providers = query.all()
 
+def _pick_top(providers, limit: int) -> list[Provider]:
     out: list[Provider] = []
     for p in providers:
         if is_provider_blocked(p):
             continue
-        if service_n and _norm(p.service) != service_n:
-            continue
-        if comuna_n and not _matches_comuna(p, comuna_n):
-            continue
         out.append(p)
         if limit > 0 and len(out) >= limit:
             break
     return out
+
+
+async def list_available_services(db: AsyncSession) -> list[str]:
+    """Servicios disponibles según providers activos."""
+    cached = _cached("services")
+    if cached is not None:
+        return cached
+    rows = (await db.scalars(_services_stmt())).all()
+    return _store("services", [r for r in rows if r])
+
+
+def list_available_services_sync(db: Session) -> list[str]:
+    """Igual que list_available_services, para código síncrono (orquestador LLM en su thread)."""
+    cached = _cached("services")
+    if cached is not None:
+        return cached
+    rows = db.scalars(_services_stmt()).all()
+    return _store("services", [r for r in rows if r])
+
+
+async def list_known_comunas(db: AsyncSession) -> list[str]:
+    """Comunas conocidas (de providers y de sus coberturas), tal como están escritas."""
+    cached = _cached("comunas")
+    if cached is not None:
+        return cached
+    rows = list((await db.scalars(select(func.distinct(Provider.comuna)).where(Provider.comuna.isnot(None)))).all())
+    rows.extend(
+        (
+            await db.scalars(
+                select(func.distinct(ProviderCoverage.comuna)).where(ProviderCoverage.comuna.isnot(None))
+            )
+        ).all()
+    )
+    return _store("comunas", [r for r in rows if r])
+
+
+async def find_top_providers(db: AsyncSession, service: str, comuna: str, limit: int = 3) -> list[Provider]:
+    """Top providers por rating (y cantidad) para servicio+comuna, excluyendo bloqueados."""
+    service_k = match_key(service)
+    comuna_k = comuna_key(comuna)
+    if not service_k or not comuna_k:
+        return []
+
+    providers = (await db.scalars(_top_providers_stmt(service_k, comuna_k, limit))).all()
+    return _pick_top(providers, limit)
+
+
+def find_top_providers_sync(db: Session, service: str, comuna: str, limit: int = 3) -> list[Provider]:
+    """Igual que find_top_providers, para código síncrono (orquestador LLM en su thread)."""
+    service_k = match_key(service)
+    comuna_k = comuna_key(comuna)
+    if not service_k or not comuna_k:
+        return []
+
+    providers = db.scalars(_top_providers_stmt(service_k, comuna_k, limit)).all()
+    return _pick_top(providers, limit)
@@ -3,7 +3,10 @@ from __future__ import annotations
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import Boolean, DateTime, ForeignKey, Integer, String, Text, Float, func, UniqueConstraint, Index, JSON
+from sqlalchemy import Boolean, DateTime, FetchedValue, ForeignKey, Integer, String, Text, Float, func, UniqueConstraint, Index, JSON
+from sqlalchemy import text as sql_text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from .db import Base
@@ -11,13 +14,27 @@ from .db import Base
 
 class Provider(Base):
     __tablename__ = "providers"
+    __table_args__ = (
+        Index("ix_providers_match", "service_key", "comuna_key", "active", sql_text("rating_avg DESC")),
+    )
+    # Las claves de matching vuelven por RETURNING (el trigger las recalcula)
+    __mapper_args__ = {"eager_defaults": True}
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     service: Mapped[str] = mapped_column(String(64), index=True)
     comuna: Mapped[str] = mapped_column(String(64), index=True)
+    # Claves de matching (sin tildes, alias resueltos): las mantiene un trigger (ver match_keys)
+    service_key: Mapped[Optional[str]] = mapped_column(
+        String(64), nullable=True, server_default=FetchedValue(), server_onupdate=FetchedValue()
+    )
+    comuna_key: Mapped[Optional[str]] = mapped_column(
+        String(64), nullable=True, server_default=FetchedValue(), server_onupdate=FetchedValue()
+    )
 
     name: Mapped[str] = mapped_column(String(120), default="Tecnico")
-    whatsapp_e164: Mapped[str] = mapped_column(String(32), default="")  # Ej: 569XXXXXXXX
+    whatsapp_e164: Mapped[str] = mapped_column(String(32), default="", index=True)  # Ej: 569XXXXXXXX
+    # Número emisor asignado (pool de WHATSAPP_PHONE_NUMBER_IDS)
+    phone_number_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     active: Mapped[bool] = mapped_column(Boolean, default=True)
 
     # Reputación (solo se actualiza cuando hay servicio verificado)
@@ -44,20 +61,45 @@ class ProviderCoverage(Base):
     __table_args__ = (
         UniqueConstraint("provider_id", "comuna", name="uq_provider_coverage_provider_comuna"),
         Index("ix_provider_coverage_comuna", "comuna"),
+        Index("ix_provider_coverage_match", "comuna_key", "provider_id"),
     )
+    __mapper_args__ = {"eager_defaults": True}
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     provider_id: Mapped[int] = mapped_column(ForeignKey("providers.id"), nullable=False, index=True)
     comuna: Mapped[str] = mapped_column(String(64), nullable=False)
+    comuna_key: Mapped[Optional[str]] = mapped_column(
+        String(64), nullable=True, server_default=FetchedValue(), server_onupdate=FetchedValue()
+    )
 
     provider: Mapped[Provider] = relationship("Provider", back_populates="coverage_areas")
 
 
 class Lead(Base):
     __tablename__ = "leads"
+    __table_args__ = (
+        # Lead vigente del cliente (ORDER BY id DESC LIMIT 1)
+        Index("ix_leads_customer_current", "customer_wa_id", sql_text("id DESC")),
+        # Scans del worker: CONNECTED vencidos y recordatorios de confirmación vencidos
+        # (followup_sent_at <= now - 24h, ver worker._confirm_pending_to_review)
+        Index("ix_leads_connected_due", "connected_at", postgresql_where=sql_text("status = 'CONNECTED'")),
+        Index(
+            "ix_leads_followup_due",
+            "status",
+            "followup_sent_at",
+            postgresql_where=sql_text("status IN ('CONTACT_CONFIRM_PENDING', 'SERVICE_CONFIRM_PENDING')"),
+        ),
+        # Preguntas pendientes de un proveedor (pending_questions)
+        Index(
+            "ix_leads_provider_pending",
+            "provider_id",
+            "id",
+            postgresql_where=sql_text("status IN ('CONTACT_CONFIRM_PENDING', 'SERVICE_CONFIRM_PENDING')"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    customer_wa_id: Mapped[str] = mapped_column(String(64), index=True)
+    customer_wa_id: Mapped[str] = mapped_column(String(64))  # ver ix_leads_customer_current
     # Estados sugeridos: OPEN, WAIT_COMUNA, WAIT_OPTIONS, WAIT_CHOICE, WAIT_CONSENT,
     # CONNECTED, CONTACT_CONFIRM_PENDING, SERVICE_CONFIRM_PENDING, RATING_PENDING, CLOSED
     status: Mapped[str] = mapped_column(String(32), default="OPEN", index=True)
@@ -104,7 +146,10 @@ class ConversationState(Base):
 
     step: Mapped[str] = mapped_column(String(64), default="START", index=True)
     lead_id: Mapped[Optional[int]] = mapped_column(ForeignKey("leads.id"), nullable=True)
-    temp_data: Mapped[dict] = mapped_column(JSON, default=dict)
+    # MutableDict: temp_data[k] = v marca la fila como modificada (sin MutableDict se perdía)
+    temp_data: Mapped[dict] = mapped_column(MutableDict.as_mutable(JSONB), default=dict)
+    # Número emisor asignado: el número al que escribió el usuario (sticky)
+    phone_number_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
 
     updated_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False
@@ -172,6 +217,9 @@ class Review(Base):
 
 class ProviderState(Base):
     __tablename__ = "provider_state"
+    __table_args__ = (
+        Index("ix_provider_state_pending_lead", "pending_lead_id", postgresql_where=sql_text("pending_lead_id IS NOT NULL")),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     provider_id: Mapped[int] = mapped_column(ForeignKey("providers.id"), unique=True, index=True)
@@ -188,6 +236,9 @@ class InboundMessage(Base):
     """
     Idempotencia: WhatsApp puede reenviar el mismo mensaje (retries).
     Guardamos message_id por wa_id y NO procesamos doble.
+
+    Es solo un registro de claves: se poda a la ventana de reintentos de Meta
+    (INBOUND_DEDUP_WINDOW_HOURS). El texto vive en InboundMessageLog.
     """
     __tablename__ = "inbound_messages"
 
@@ -195,6 +246,7 @@ class InboundMessage(Base):
     customer_wa_id: Mapped[str] = mapped_column(String(64), index=True)
     message_id: Mapped[str] = mapped_column(String(128), nullable=False)
 
+    # Legado: ya no se escribe (ver InboundMessageLog); se mantiene por compatibilidad de esquema
     text: Mapped[str] = mapped_column(Text, default="")
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now(), nullable=False
@@ -203,4 +255,190 @@ class InboundMessage(Base):
     __table_args__ = (
         UniqueConstraint("customer_wa_id", "message_id", name="uq_inbound_wa_msg"),
         Index("ix_inbound_message_id", "message_id"),
+        Index("ix_inbound_messages_created_at", "created_at"),
+    )
+
+
+class InboundMessageLog(Base):
+    """
+    Historial de textos entrantes, particionado por día (RANGE sobre created_at).
+
+    La retención (INBOUND_TEXT_RETENTION_DAYS) se aplica con DROP de particiones
+    completas (ver inbound_retention.py), sin DELETE ni VACUUM sobre la tabla caliente.
+    Las particiones diarias se crean por adelantado; la DEFAULT atrapa lo demás.
+    """
+    __tablename__ = "inbound_message_log"
+
+    customer_wa_id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    message_id: Mapped[str] = mapped_column(String(128), primary_key=True)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), primary_key=True, server_default=func.now()
+    )
+    text: Mapped[str] = mapped_column(Text, default="")
+
+    __table_args__ = ({"postgresql_partition_by": "RANGE (created_at)"},)
+
+
+class InboundQueueItem(Base):
+    """
+    Cola durable de entrada (modo ack-first): el webhook solo inserta aquí y
+    responde 200; los consumidores la drenan y ejecutan handle_user_incoming.
+    """
+    __tablename__ = "inbound_queue"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    customer_wa_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    message_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    text: Mapped[str] = mapped_column(Text, default="")
+    raw_message: Mapped[Optional[dict]] = mapped_column(JSON, nullable=True)
+    phone_number_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+
+    # PENDING | PROCESSING | DONE | FAILED
+    status: Mapped[str] = mapped_column(String(16), default="PENDING", nullable=False)
+    attempts: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    available_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    locked_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    processed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+
+    __table_args__ = (
+        Index("ix_inbound_queue_pending", "id", postgresql_where=sql_text("status = 'PENDING'")),
+        Index("ix_inbound_queue_wa_status", "customer_wa_id", "status"),
+    )
+
+
+class OutboundMessage(Base):
+    """
+    Mensajes salientes aceptados por la Graph API (wamid) y su ciclo de entrega.
+
+    Se usa para medir cuánto espera realmente el usuario:
+    inbound_at -> sent_at -> delivered_at/read_at, por paso de la conversación.
+    Los callbacks de estado pueden llegar antes que el registro del envío:
+    ambos caminos hacen upsert por wa_message_id.
+    """
+    __tablename__ = "outbound_messages"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    wa_message_id: Mapped[str] = mapped_column(String(128), nullable=False, unique=True)
+    to_wa_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, index=True)
+    kind: Mapped[Optional[str]] = mapped_column(String(16), nullable=True)  # text | list | template
+
+    # Turno que originó el envío (si lo hubo)
+    conversation_wa_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    step: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    inbound_message_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    inbound_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    # sent | delivered | read | failed
+    status: Mapped[str] = mapped_column(String(16), default="sent", nullable=False)
+    sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    delivered_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    read_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    failed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    errors: Mapped[Optional[list]] = mapped_column(JSON, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+
+    __table_args__ = (
+        Index("ix_outbound_messages_step_sent", "step", "sent_at"),
+    )
+
+
+class OutboxMessage(Base):
+    """
+    Outbox transaccional: cada envío a WhatsApp se escribe aquí en la misma
+    transacción que el cambio de estado que lo origina. OutboxRelay lo toma
+    (PENDING -> SENDING) y lo entrega vía el dispatcher de salida; si el proceso
+    cae antes de registrar el resultado, la fila vuelve a PENDING (ver attempts).
+    """
+    __tablename__ = "outbox_messages"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    to_wa_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    kind: Mapped[str] = mapped_column(String(16), nullable=False)  # text | list | template
+    payload: Mapped[dict] = mapped_column(JSON, nullable=False)
+    phone_number_id: Mapped[str] = mapped_column(String(64), default="")
+    priority: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+    # PENDING | SENDING | SENT | FAILED
+    status: Mapped[str] = mapped_column(String(16), default="PENDING", nullable=False)
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
+    wa_message_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    # Turno que originó el envío (seguimiento de entrega)
+    conversation_wa_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    step: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    inbound_message_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    inbound_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    available_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+
+    __table_args__ = (
+        Index("ix_outbox_pending", "id", postgresql_where=sql_text("status = 'PENDING'")),
+        Index("ix_outbox_to_status", "to_wa_id", "status"),
+    )
+
+
+class Campaign(Base):
+    """
+    Envío masivo de una plantilla a proveedores (onboarding, disponibilidad...).
+    last_provider_id es el checkpoint: todo proveedor con id <= ese ya fue procesado.
+    """
+    __tablename__ = "campaigns"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    name: Mapped[str] = mapped_column(String(120), nullable=False)
+    template_name: Mapped[str] = mapped_column(String(128), nullable=False)
+    language_code: Mapped[str] = mapped_column(String(16), default="es_ES", nullable=False)
+    components: Mapped[Optional[list]] = mapped_column(JSON, nullable=True)
+
+    # Filtros de destinatarios (None = todos los proveedores activos)
+    service: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    comuna: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+
+    # DRAFT | RUNNING | PAUSED | DONE | FAILED
+    status: Mapped[str] = mapped_column(String(16), default="DRAFT", nullable=False)
+    total: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    sent: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    failed: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    last_provider_id: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    started_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+class CampaignDelivery(Base):
+    """Resultado por proveedor: al reanudar, no se reenvía a quien ya tiene fila."""
+    __tablename__ = "campaign_deliveries"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    campaign_id: Mapped[int] = mapped_column(ForeignKey("campaigns.id"), nullable=False)
+    provider_id: Mapped[int] = mapped_column(ForeignKey("providers.id"), nullable=False)
+    # SENT | FAILED
+    status: Mapped[str] = mapped_column(String(16), nullable=False)
+    wa_message_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("campaign_id", "provider_id", name="uq_campaign_delivery"),
     )
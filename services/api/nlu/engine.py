@@ -2,10 +2,12 @@ from __future__ import annotations
 
 from typing import List, Optional, Tuple
 
-from sqlalchemy import and_, func, or_
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from services.common.logging_config import setup_logging
+from ..load_shedding import load_shedder
+from ..match_keys import comuna_key
 from ..models import Provider, ProviderCoverage
 from .catalog import IntentDef, load_intents, intents_by_id
 from .llm_parser import try_llm_parse
@@ -14,14 +16,6 @@ from .types import NLUResult
 
 logger = setup_logging("nlu_engine")
 
-# Comuna aliases for common abbreviations
-COMUNA_ALIASES = {
-    "conce": "concepcion",
-    "san pedro": "san pedro de la paz",
-    "los angeles": "los angeles",  # if needed
-    # Add more as needed
-}
-
 # Proximity map for comunas in Biobío region (normalized)
 PROXIMITY_MAP = {
     "concepcion": ["talcahuano", "san pedro de la paz", "chiguayante", "hualpen", "coronel", "penco", "tome", "lota", "florida", "hualqui", "santa juana", "nacimento", "los angeles", "cabrero", "yumbel"],
@@ -78,7 +72,8 @@ class NLUEngine:
         return res
 
     async def parse_hybrid(self, text: str) -> NLUResult:
-        llm = await try_llm_parse(text, self.intents)
+        # En modo degradado se omite el LLM: queda solo el resultado por reglas
+        llm = None if load_shedder.skip("nlu_llm") else await try_llm_parse(text, self.intents)
         top = top_intents(text, self.intents, k=3)
         rules_scores = {intent_id: score for intent_id, score, _ in top}
 
@@ -178,46 +173,30 @@ def build_service_intent_index(
     return service_to_intent, intent_to_services
 
 
-def pick_best_service_for_intent(db: Session, intent_id: str, comuna: str, intent_to_services: dict[str, List[str]]) -> Optional[str]:
+async def pick_best_service_for_intent(db: AsyncSession, intent_id: str, comuna: str, intent_to_services: dict[str, List[str]]) -> Optional[str]:
     candidates = intent_to_services.get(intent_id) or []
     logger.info("🔍 pick_best_service_for_intent | intent_id=%s | comuna=%s | candidates=%s", intent_id, comuna, candidates)
     if not candidates:
         logger.info("❌ No candidates for intent")
         return None
 
-    normalized_comuna = _norm(comuna)
-    logger.info("🔄 Normalized comuna | original=%s | normalized=%s", comuna, normalized_comuna)
-    if not normalized_comuna:
+    key = comuna_key(comuna)
+    logger.info("🔄 Comuna key | original=%s | key=%s", comuna, key)
+    if not key:
         logger.info("❌ Normalized comuna is empty")
         return None
 
-    # Handle abbreviations
-    if normalized_comuna == "conce":
-        normalized_comuna = "concepcion"
-    normalized_comuna = COMUNA_ALIASES.get(normalized_comuna, normalized_comuna)
-    logger.info("📝 Final normalized comuna | %s", normalized_comuna)
-
+    # La comparación por comuna la resuelve el índice (provider_coverage.comuna_key)
     rows = (
-        db.query(Provider.id, Provider.service, Provider.rating_avg, ProviderCoverage.comuna)
-        .join(ProviderCoverage, ProviderCoverage.provider_id == Provider.id)
-        .filter(Provider.active == True)
-        .filter(Provider.service.in_(candidates))
-        .all()
-    )
-    logger.info("📊 Query results | rows_count=%s", len(rows))
-    for row in rows:
-        logger.info("📋 Row | id=%s | service=%s | rating=%s | cov_comuna=%s", row[0], row[1], row[2], row[3])
-    
-    # Filter by normalized comuna
-    filtered_rows = []
-    for provider_id, svc, rat, cov_comuna in rows:
-        norm_cov = _norm(cov_comuna) if cov_comuna else ""
-        logger.info("🔍 Checking comuna | cov_comuna=%s | norm_cov=%s | match=%s", cov_comuna, norm_cov, norm_cov == normalized_comuna)
-        if cov_comuna and _norm(cov_comuna) == normalized_comuna:
-            filtered_rows.append((provider_id, svc, rat))
-    
-    logger.info("✅ Filtered rows | count=%s", len(filtered_rows))
-    rows = filtered_rows
+        await db.execute(
+            select(Provider.id, Provider.service, Provider.rating_avg)
+            .join(ProviderCoverage, ProviderCoverage.provider_id == Provider.id)
+            .where(ProviderCoverage.comuna_key == key)
+            .where(Provider.active == True)
+            .where(Provider.service.in_(candidates))
+        )
+    ).all()
+    logger.info("✅ Matching rows | count=%s", len(rows))
     if not rows:
         return None
 
@@ -246,7 +225,7 @@ def pick_best_service_for_intent(db: Session, intent_id: str, comuna: str, inten
     return best_svc
 
 
-def get_available_comunas_for_intent(db: Session, intent_id: str, intent_to_services: dict[str, List[str]], reference_comuna: Optional[str] = None) -> List[str]:
+async def get_available_comunas_for_intent(db: AsyncSession, intent_id: str, intent_to_services: dict[str, List[str]], reference_comuna: Optional[str] = None) -> List[str]:
     candidates = intent_to_services.get(intent_id) or []
     logger.info("🌍 get_available_comunas_for_intent | intent_id=%s | candidates=%s | reference_comuna=%s", intent_id, candidates, reference_comuna)
     if not candidates:
@@ -254,19 +233,21 @@ def get_available_comunas_for_intent(db: Session, intent_id: str, intent_to_serv
         return []
 
     rows_cov = (
-        db.query(func.distinct(ProviderCoverage.comuna))
-        .join(Provider, Provider.id == ProviderCoverage.provider_id)
-        .filter(Provider.active == True)
-        .filter(Provider.service.in_(candidates))
-        .all()
-    )
+        await db.execute(
+            select(func.distinct(ProviderCoverage.comuna))
+            .join(Provider, Provider.id == ProviderCoverage.provider_id)
+            .where(Provider.active == True)
+            .where(Provider.service.in_(candidates))
+        )
+    ).all()
     rows_direct = (
-        db.query(func.distinct(Provider.comuna))
-        .outerjoin(ProviderCoverage, ProviderCoverage.provider_id == Provider.id)
-        .filter(Provider.active == True)
-        .filter(Provider.service.in_(candidates))
-        .all()
-    )
+        await db.execute(
+            select(func.distinct(Provider.comuna))
+            .outerjoin(ProviderCoverage, ProviderCoverage.provider_id == Provider.id)
+            .where(Provider.active == True)
+            .where(Provider.service.in_(candidates))
+        )
+    ).all()
     comunas_cov = [row[0] for row in rows_cov if row[0]]
     comunas_direct = [row[0] for row in rows_direct if row[0]]
     logger.info("📍 Available comunas | coverage=%s | direct=%s", comunas_cov, comunas_direct)
@@ -274,11 +255,7 @@ def get_available_comunas_for_intent(db: Session, intent_id: str, intent_to_serv
     all_comunas = set(comunas_cov) | set(comunas_direct)
     
     if reference_comuna:
-        ref_norm = _norm(reference_comuna)
-        # Handle abbreviations
-        if ref_norm == "conce":
-            ref_norm = "concepcion"
-        ref_norm = COMUNA_ALIASES.get(ref_norm, ref_norm)
+        ref_norm = comuna_key(reference_comuna)
         proximity_list = PROXIMITY_MAP.get(ref_norm, [])
         # Sort by proximity: first those in proximity_list, then others
         sorted_comunas = []
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from sqlalchemy.orm import Session
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from services.common.logging_config import setup_logging
 from services.api.matching import find_top_providers
@@ -18,7 +19,7 @@ def _options_limit() -> int:
     return 0
 
 
-async def _send_options(db: Session, wa_id: str, lead: Lead) -> None:
+async def _send_options(db: AsyncSession, wa_id: str, lead: Lead) -> None:
     if not lead.service or not lead.comuna:
         await send_text(
             wa_id,
@@ -27,7 +28,7 @@ async def _send_options(db: Session, wa_id: str, lead: Lead) -> None:
         return
 
     limit = _options_limit()
-    providers = find_top_providers(
+    providers = await find_top_providers(
         db=db,
         service=lead.service,
         comuna=lead.comuna,
@@ -36,7 +37,6 @@ async def _send_options(db: Session, wa_id: str, lead: Lead) -> None:
 
     if not providers:
         lead.status = "WAIT_SERVICE"
-        db.commit()
         await send_text(
             wa_id,
             "No encontré profesionales disponibles para esa necesidad en tu comuna.\n"
@@ -47,13 +47,11 @@ async def _send_options(db: Session, wa_id: str, lead: Lead) -> None:
     if limit > 0:
         providers = providers[:limit]
 
-    db.query(LeadOffer).filter(LeadOffer.lead_id == lead.id).delete()
-    db.commit()
+    await db.execute(delete(LeadOffer).where(LeadOffer.lead_id == lead.id))
 
     for idx, p in enumerate(providers, start=1):
         offer = LeadOffer(lead_id=lead.id, provider_id=p.id, rank=idx)
         db.add(offer)
-    db.commit()
 
     lines = [f"Tengo {len(providers)} profesionales que pueden ayudarte en {lead.comuna}:"]
     for idx, p in enumerate(providers, start=1):
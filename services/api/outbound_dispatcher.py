@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+import httpx
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.common.rate_limit import KeyedTokenBuckets
+from services.api.delivery_tracking import TurnInfo, current_turn
+from services.api.settings import settings
+
+logger = setup_logging("outbound_dispatcher")
+
+# Prioridades (menor = antes)
+PRIORITY_INTERACTIVE = 0  # respuesta dentro de un turno del usuario
+PRIORITY_NOTIFICATION = 1  # avisos a proveedores, seguimientos
+PRIORITY_BULK = 2  # recordatorios y envíos masivos
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_NOTIFICATION: "notification", PRIORITY_BULK: "bulk"}
+
+RETRIABLE_STATUS = {429, 500, 502, 503, 504}
+
+# Devuelve el wamid aceptado por Meta (o None)
+Sender = Callable[["OutboundJob"], Awaitable[Optional[str]]]
+# on_done(job, ok, wamid | motivo del fallo)
+DoneCallback = Callable[["OutboundJob", bool, Optional[str]], None]
+
+
+@dataclass
+class OutboundJob:
+    to_wa_id: str
+    kind: str
+    payload: dict
+    phone_number_id: str
+    priority: int
+    seq: int
+    turn: Optional[TurnInfo] = None
+    on_done: Optional[DoneCallback] = field(default=None, repr=False)
+    attempts: int = 0
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+class SendError(Exception):
+    """Fallo definitivo (4xx no reintentable)."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class RetriableSendError(SendError):
+    def __init__(self, reason: str, retry_after: Optional[float] = None):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+def default_priority() -> int:
+    """Dentro de un turno de usuario es interactivo; fuera (worker) es notificación."""
+    turn = current_turn.get()
+    return PRIORITY_INTERACTIVE if turn is not None and turn.inbound_message_id else PRIORITY_NOTIFICATION
+
+
+def retry_after_seconds(r: httpx.Response) -> Optional[float]:
+    try:
+        return float(r.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+class OutboundDispatcher:
+    """
+    Cola de salida hacia la Graph API.
+
+    - FIFO por destinatario: los mensajes a un mismo wa_id salen en orden y de a uno.
+    - Entre destinatarios manda la prioridad (respuestas interactivas antes que
+      recordatorios) y luego el orden de llegada.
+    - Un token bucket por phone_number_id respeta el throughput por número.
+    - 429/5xx/errores de red se reintentan con backoff exponencial con jitter
+      (o Retry-After); el destinatario queda en espera sin ocupar un worker.
+    - Concurrencia acotada: OUTBOUND_CONCURRENCY envíos en vuelo.
+    """
+
+    def __init__(self, sender: Sender, concurrency: int, rate_per_s: float, burst: int, max_queued: int):
+        self._sender = sender
+        self._concurrency = max(1, concurrency)
+        self._buckets = KeyedTokenBuckets(rate_per_s, burst, max_keys=1000)
+        self._max_queued = max_queued
+        self._seq = itertools.count()
+        self._by_recipient: Dict[str, Deque[OutboundJob]] = {}
+        self._ready: Optional[asyncio.PriorityQueue] = None
+        self._workers: list[asyncio.Task] = []
+        self._queued = 0
+        self._inflight = 0
+        self._idle: Optional[asyncio.Event] = None
+
+        metrics.register_gauge("outbound_queue_depth", lambda: self._queued)
+        metrics.register_gauge("outbound_inflight", lambda: self._inflight)
+        metrics.register_gauge("outbound_recipients_pending", lambda: len(self._by_recipient))
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._ready = asyncio.PriorityQueue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # Lo que se encoló antes de arrancar (o en otro loop) se vuelve a ofrecer
+        for to_wa_id, jobs in self._by_recipient.items():
+            self._ready.put_nowait((jobs[0].priority, jobs[0].seq, to_wa_id))
+            self._idle.clear()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"outbound-{i}") for i in range(self._concurrency)
+        ]
+        logger.info("📤 Outbound dispatcher iniciado | concurrency=%s", self._concurrency)
+
+    async def stop(self, drain_timeout_s: float = 10.0) -> None:
+        if not self._workers:
+            return
+        if self._queued:
+            try:
+                await asyncio.wait_for(self.drain(), timeout=drain_timeout_s)
+            except asyncio.TimeoutError:
+                logger.warning("⏱️ Outbound dispatcher: quedan %s mensajes sin enviar al detener", self._queued)
+        for t in self._workers:
+            t.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def drain(self) -> None:
+        """Espera a que la cola quede vacía (p.ej. al final de un tick del worker)."""
+        if self._idle is not None:
+            await self._idle.wait()
+
+    def enqueue(
+        self,
+        to_wa_id: str,
+        kind: str,
+        payload: dict,
+        phone_number_id: str,
+        priority: Optional[int] = None,
+        on_done: Optional[DoneCallback] = None,
+    ) -> dict:
+        if self._queued >= self._max_queued:
+            metrics.inc("outbound_rejected_total", reason="queue_full")
+            logger.error("❌ Outbound queue llena | to=%s | kind=%s", to_wa_id, kind)
+            return {"ok": False, "error": "queue_full"}
+        if not self._workers:
+            self.start()
+
+        job = OutboundJob(
+            to_wa_id=to_wa_id,
+            kind=kind,
+            payload=payload,
+            phone_number_id=phone_number_id,
+            priority=default_priority() if priority is None else priority,
+            seq=next(self._seq),
+            turn=current_turn.get(),
+            on_done=on_done,
+        )
+        self._queued += 1
+        self._idle.clear()
+        metrics.inc("outbound_enqueued_total", priority=PRIORITY_NAMES.get(job.priority, job.priority))
+
+        lane = self._by_recipient.get(to_wa_id)
+        if lane is None:
+            self._by_recipient[to_wa_id] = deque([job])
+            self._ready.put_nowait((job.priority, job.seq, to_wa_id))
+        else:
+            lane.append(job)
+        return {"ok": True, "queued": True, "seq": job.seq}
+
+    def _offer(self, to_wa_id: str) -> None:
+        lane = self._by_recipient.get(to_wa_id)
+        if lane:
+            head = lane[0]
+            self._ready.put_nowait((head.priority, head.seq, to_wa_id))
+
+    def _finish(self, to_wa_id: str, ok: bool, detail: Optional[str]) -> None:
+        lane = self._by_recipient[to_wa_id]
+        job = lane.popleft()
+        if job.on_done is not None:
+            try:
+                job.on_done(job, ok, detail)
+            except Exception:
+                logger.exception("❌ on_done falló | to=%s | kind=%s", to_wa_id, job.kind)
+        self._queued -= 1
+        if lane:
+            self._offer(to_wa_id)
+        else:
+            del self._by_recipient[to_wa_id]
+        if not self._queued:
+            self._idle.set()
+
+    def _backoff(self, attempts: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return min(settings.outbound_retry_max_seconds, retry_after)
+        base = settings.outbound_retry_base_seconds * (2 ** (attempts - 1))
+        return random.uniform(0, min(settings.outbound_retry_max_seconds, base))  # full jitter
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            _prio, _seq, to_wa_id = await self._ready.get()
+            job = self._by_recipient[to_wa_id][0]
+
+            wait = self._buckets.get(job.phone_number_id).reserve()
+            if wait > 0:
+                metrics.observe("outbound_throttle_wait_seconds", wait)
+                await asyncio.sleep(wait)
+
+            self._inflight += 1
+            job.attempts += 1
+            if job.attempts == 1:
+                metrics.observe(
+                    "outbound_queue_wait_seconds",
+                    time.perf_counter() - job.enqueued_at,
+                    priority=PRIORITY_NAMES.get(job.priority, job.priority),
+                )
+            token = current_turn.set(job.turn)
+            try:
+                wa_message_id = await self._sender(job)
+            except RetriableSendError as e:
+                if job.attempts >= settings.outbound_max_attempts:
+                    metrics.inc("outbound_failed_total", reason=e.reason)
+                    logger.error("❌ WA SEND agotó reintentos | to=%s | kind=%s | reason=%s", to_wa_id, job.kind, e.reason)
+                    self._finish(to_wa_id, False, e.reason)
+                else:
+                    delay = self._backoff(job.attempts, e.retry_after)
+                    metrics.inc("outbound_retries_total", reason=e.reason)
+                    logger.warning(
+                        "🔁 WA SEND reintento | to=%s | attempt=%s | reason=%s | in=%.2fs",
+                        to_wa_id, job.attempts, e.reason, delay,
+                    )
+                    loop.call_later(delay, self._offer, to_wa_id)
+            except SendError as e:
+                metrics.inc("outbound_failed_total", reason=e.reason)
+                self._finish(to_wa_id, False, e.reason)
+            except Exception:
+                metrics.inc("outbound_failed_total", reason="error")
+                logger.exception("❌ WA SEND EXCEPTION to=%s", to_wa_id)
+                self._finish(to_wa_id, False, "error")
+            else:
+                metrics.inc("outbound_sent_total", kind=job.kind)
+                self._finish(to_wa_id, True, wa_message_id)
+            finally:
+                current_turn.reset(token)
+                self._inflight -= 1
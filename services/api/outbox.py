@@ -0,0 +1,464 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional, Union
+
+from sqlalchemy import and_, delete, event, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.db import SessionLocal
+from services.api.delivery_tracking import TurnInfo, current_turn, turn_context
+from services.api.models import OutboxMessage
+from services.api.settings import settings
+
+logger = setup_logging("outbox")
+
+# Sesión del turno en curso: los send_* dejan sus envíos en el buffer de esa sesión.
+# Puede ser async (turnos del webhook) o sync (worker): el buffer vive en .info,
+# que AsyncSession comparte con su sync_session, y los eventos son los de Session.
+outbox_session: ContextVar[Optional[Union[Session, AsyncSession]]] = ContextVar("outbox_session", default=None)
+
+# Límite de Meta para text.body
+MAX_TEXT_BODY = 4096
+TEXT_JOINER = "\n\n"
+
+_BUFFER_KEY = "outbox_buffer"
+_AFTER_COMMIT_KEY = "outbox_after_commit"
+_WRITTEN_KEY = "outbox_written_ids"
+
+# Dispatcher lleno: la fila vuelve a PENDING y se reintenta pasado este tiempo
+REQUEUE_BACKOFF_S = 2.0
+
+
+@dataclass
+class PendingSend:
+    to_wa_id: str
+    kind: str
+    payload: dict
+    phone_number_id: str
+    priority: int
+    turn: Optional[TurnInfo]
+    parts: int = 1
+
+
+@contextmanager
+def bind_outbox(db: Union[Session, AsyncSession]) -> Iterator[Union[Session, AsyncSession]]:
+    token = outbox_session.set(db)
+    try:
+        yield db
+    finally:
+        outbox_session.reset(token)
+
+
+def _text_body(send: PendingSend) -> Optional[str]:
+    # Solo textos simples (sin preview_url ni contexto de respuesta) se pueden unir
+    if send.kind != "text" or set(send.payload) != {"messaging_product", "to", "type", "text"}:
+        return None
+    text = send.payload["text"]
+    return text["body"] if set(text) == {"body"} else None
+
+
+def buffer_send(db: Union[Session, AsyncSession], *, to_wa_id: str, kind: str, payload: dict, phone_number_id: str, priority: int) -> dict:
+    """
+    Deja el envío en el buffer de la transacción en curso; sale con el próximo
+    commit (ver _flush_buffer). Un texto que sigue a otro texto al mismo
+    destinatario se une a él (un solo POST a la Graph API) si cabe en MAX_TEXT_BODY.
+    """
+    buffer: list[PendingSend] = db.info.setdefault(_BUFFER_KEY, [])
+    turn = current_turn.get()
+    send = PendingSend(
+        to_wa_id=to_wa_id,
+        kind=kind,
+        payload=payload,
+        phone_number_id=phone_number_id,
+        priority=priority,
+        turn=replace(turn) if turn else None,
+    )
+
+    prev = next((p for p in reversed(buffer) if p.to_wa_id == to_wa_id), None)
+    prev_body = _text_body(prev) if prev is not None and prev.phone_number_id == phone_number_id else None
+    body = _text_body(send)
+    if prev_body is not None and body is not None and len(prev_body) + len(TEXT_JOINER) + len(body) <= MAX_TEXT_BODY:
+        prev.payload = {**prev.payload, "text": {"body": prev_body + TEXT_JOINER + body}}
+        prev.priority = min(prev.priority, priority)
+        prev.parts += 1
+        metrics.inc("outbound_coalesced_total")
+        return {"ok": True, "buffered": True, "coalesced": True}
+
+    buffer.append(send)
+    return {"ok": True, "buffered": True, "coalesced": False}
+
+
+def add_to_outbox(db: Session, send: PendingSend) -> None:
+    turn = send.turn
+    db.add(
+        OutboxMessage(
+            to_wa_id=send.to_wa_id,
+            kind=send.kind,
+            payload=send.payload,
+            phone_number_id=send.phone_number_id,
+            priority=send.priority,
+            status="PENDING",
+            conversation_wa_id=turn.wa_id if turn else None,
+            step=turn.step if turn else None,
+            inbound_message_id=turn.inbound_message_id if turn else None,
+            inbound_at=datetime.fromtimestamp(turn.inbound_at, tz=timezone.utc) if turn and turn.inbound_at else None,
+        )
+    )
+    metrics.inc("outbox_written_total", kind=send.kind)
+
+
+@event.listens_for(Session, "before_commit")
+def _flush_buffer(db: Session) -> None:
+    """
+    Vacía el buffer al confirmar la transacción: con OUTBOX_ENABLED=1 como filas
+    de outbox (mismo commit que el cambio de estado); si no, se encolan en el
+    dispatcher recién después del commit.
+    """
+    buffer = db.info.pop(_BUFFER_KEY, None)
+    if not buffer:
+        return
+    if settings.outbox_enabled:
+        for send in buffer:
+            add_to_outbox(db, send)
+    else:
+        db.info.setdefault(_AFTER_COMMIT_KEY, []).extend(buffer)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_written_ids(db: Session, flush_context) -> None:
+    # ids de las filas de outbox escritas por este proceso (drain() espera solo esas)
+    ids = [obj.id for obj in db.new if isinstance(obj, OutboxMessage)]
+    if ids:
+        db.info.setdefault(_WRITTEN_KEY, []).extend(ids)
+
+
+@event.listens_for(Session, "after_commit")
+def _enqueue_after_commit(db: Session) -> None:
+    written = db.info.pop(_WRITTEN_KEY, None)
+    if written:
+        outbox_relay.track(written)
+    buffer = db.info.pop(_AFTER_COMMIT_KEY, None)
+    if not buffer:
+        return
+    from services.api.whatsapp_cloud import dispatcher
+
+    for send in buffer:
+        token = current_turn.set(send.turn)
+        try:
+            dispatcher.enqueue(send.to_wa_id, send.kind, send.payload, send.phone_number_id, priority=send.priority)
+        finally:
+            current_turn.reset(token)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_buffer(db: Session) -> None:
+    # Rollback: el cambio de estado no quedó, sus mensajes tampoco salen
+    db.info.pop(_WRITTEN_KEY, None)
+    dropped = len(db.info.pop(_BUFFER_KEY, None) or ()) + len(db.info.pop(_AFTER_COMMIT_KEY, None) or ())
+    if dropped:
+        metrics.inc("outbox_discarded_total", dropped)
+        logger.warning("⚠️ Outbox: %s envíos descartados por rollback", dropped)
+
+
+def _claim_batch(limit: int) -> list[dict]:
+    """
+    PENDING -> SENDING (FOR UPDATE SKIP LOCKED). Es el único paso que entrega
+    una fila al dispatcher.
+
+    Solo la fila más antigua de cada destinatario, y solo si no tiene otra en
+    SENDING: orden por destinatario aunque haya varios relays (API y worker).
+    Una fila anterior en PENDING (bloqueada por otro relay o en backoff) retiene
+    a las siguientes.
+    """
+    o = aliased(OutboxMessage)
+    busy = aliased(OutboxMessage)
+    candidates = (
+        select(o.id)
+        .where(o.status == "PENDING")
+        .where(o.available_at <= func.now())
+        .where(
+            ~select(busy.id)
+            .where(busy.to_wa_id == o.to_wa_id)
+            .where(
+                or_(
+                    busy.status == "SENDING",
+                    and_(busy.status == "PENDING", busy.id < o.id),
+                )
+            )
+            .exists()
+        )
+        .order_by(o.id.asc())
+        .limit(limit)
+        .with_for_update(skip_locked=True, of=o)
+        .scalar_subquery()
+    )
+    stmt = (
+        update(OutboxMessage)
+        .where(OutboxMessage.id.in_(candidates))
+        .values(status="SENDING", claimed_at=func.now(), attempts=OutboxMessage.attempts + 1)
+        .returning(
+            OutboxMessage.id,
+            OutboxMessage.to_wa_id,
+            OutboxMessage.kind,
+            OutboxMessage.payload,
+            OutboxMessage.phone_number_id,
+            OutboxMessage.priority,
+            OutboxMessage.conversation_wa_id,
+            OutboxMessage.step,
+            OutboxMessage.inbound_message_id,
+            OutboxMessage.inbound_at,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    with SessionLocal() as db:
+        rows = db.execute(stmt).mappings().all()
+        db.commit()
+    return sorted((dict(r) for r in rows), key=lambda r: r["id"])
+
+
+def _unfinished(ids: list[int]) -> set[int]:
+    """De estas filas, las que siguen PENDING o SENDING."""
+    with SessionLocal() as db:
+        return set(
+            db.execute(
+                select(OutboxMessage.id)
+                .where(OutboxMessage.id.in_(ids))
+                .where(OutboxMessage.status.in_(("PENDING", "SENDING")))
+            ).scalars()
+        )
+
+
+def _write_results(results: list[dict]) -> None:
+    """UPDATE en lote (executemany por PK) de las filas ya entregadas o fallidas."""
+    with SessionLocal() as db:
+        db.execute(update(OutboxMessage), results)
+        db.commit()
+
+
+def _housekeeping(held: list[int]) -> None:
+    """
+    Filas SENDING abandonadas (un relay cayó antes de registrar el resultado) no
+    tienen wamid: vuelven a PENDING y se reenvían (al menos una vez: si Meta alcanzó
+    a aceptarla, el usuario la recibe dos veces). Tras OUTBOX_MAX_ATTEMPTS tomas
+    quedan FAILED para revisión. `held` son las filas que este relay aún tiene en
+    vuelo o con resultado sin escribir: esas no están abandonadas. Las SENT
+    antiguas se purgan.
+    """
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=settings.outbox_lock_timeout_seconds)
+    sent_before = now - timedelta(hours=settings.outbox_retention_hours)
+    stale = (
+        update(OutboxMessage)
+        .where(OutboxMessage.status == "SENDING")
+        .where(OutboxMessage.claimed_at < stale_before)
+        .where(OutboxMessage.wa_message_id.is_(None))
+    )
+    if held:
+        stale = stale.where(OutboxMessage.id.not_in(held))
+    with SessionLocal() as db:
+        requeued = db.execute(
+            stale.where(OutboxMessage.attempts < settings.outbox_max_attempts).values(
+                status="PENDING", claimed_at=None, available_at=func.now(), last_error="stale_sending"
+            )
+        ).rowcount
+        failed = db.execute(stale.values(status="FAILED", last_error="stale_sending")).rowcount
+        purged = db.execute(
+            delete(OutboxMessage)
+            .where(OutboxMessage.status == "SENT")
+            .where(OutboxMessage.sent_at < sent_before)
+        ).rowcount
+        db.commit()
+    if requeued or failed:
+        metrics.inc("outbox_stale_total", requeued + failed)
+        logger.warning(
+            "⚠️ Outbox: envíos en SENDING tras un corte | reencolados=%s | fallidos=%s", requeued, failed
+        )
+    if purged:
+        logger.info("🧹 Outbox housekeeping | purged=%s", purged)
+
+
+class OutboxRelay:
+    """
+    Drena outbox_messages hacia el OutboundDispatcher, en lotes.
+
+    - notify() lo despierta tras cada commit con filas nuevas (sin esperar el poll).
+    - Cada fila entregada vuelve por on_done y se marca SENT (con wamid) o FAILED
+      en un UPDATE por lote.
+    - Acota las filas en vuelo para no vaciar la tabla en memoria.
+    """
+
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._dispatcher = None
+        self._results: list[dict] = []
+        self._outstanding = 0
+        self._stopping = False
+        self._written: set[int] = set()  # filas escritas por este proceso aún sin resultado
+        self._held: set[int] = set()  # filas tomadas por este relay cuyo resultado aún no se escribe
+
+        metrics.register_gauge("outbox_outstanding", lambda: self._outstanding)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def notify(self) -> None:
+        if self._wake is not None:
+            self._wake.set()
+
+    async def start(self, dispatcher) -> None:
+        if self._task is not None:
+            return
+        self._dispatcher = dispatcher
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="outbox-relay")
+        logger.info("📮 Outbox relay iniciado")
+
+    async def stop(self, drain_timeout_s: float = 10.0) -> None:
+        """Deja de tomar filas, espera lo ya entregado al dispatcher y registra sus resultados."""
+        self._stopping = True
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._outstanding and self._dispatcher is not None:
+            try:
+                await asyncio.wait_for(self._dispatcher.drain(), timeout=drain_timeout_s)
+            except asyncio.TimeoutError:
+                logger.warning("⏱️ Outbox relay: %s envíos siguen en vuelo al detener", self._outstanding)
+        await self._flush_results()
+
+    def track(self, ids: list[int]) -> None:
+        if self._task is not None:
+            self._written.update(ids)
+
+    async def _prune_written(self) -> None:
+        # Las que tomó otro relay (API/worker) y ya terminaron dejan de esperarse
+        if self._written:
+            still = await asyncio.to_thread(_unfinished, list(self._written))
+            self._written &= still
+
+    async def drain(self, poll_s: float = 0.2) -> None:
+        """
+        Espera a que las filas escritas por este proceso salgan y a que no queden
+        envíos propios en vuelo (fin de tick del worker). Lo que escribió otro
+        proceso (tráfico de la API) no se espera.
+        """
+        while True:
+            self.notify()
+            await self._flush_results()
+            await self._prune_written()
+            if not self._outstanding and not self._written:
+                return
+            await asyncio.sleep(poll_s)
+
+    def _on_done(self, outbox_id: int, job, ok: bool, detail: Optional[str]) -> None:
+        self._outstanding -= 1
+        self._written.discard(outbox_id)
+        now = datetime.now(timezone.utc)
+        if ok:
+            self._results.append(
+                {"id": outbox_id, "status": "SENT", "sent_at": now, "wa_message_id": detail, "last_error": None}
+            )
+        else:
+            self._results.append(
+                {"id": outbox_id, "status": "FAILED", "sent_at": None, "wa_message_id": None, "last_error": detail}
+            )
+        self.notify()
+
+    async def _flush_results(self) -> None:
+        if not self._results:
+            return
+        results, self._results = self._results, []
+        try:
+            await asyncio.to_thread(_write_results, results)
+            metrics.inc("outbox_completed_total", len(results))
+            self._held.difference_update(r["id"] for r in results)
+        except Exception:
+            # Se reintenta en la próxima vuelta; mientras, housekeeping no las toma por abandonadas
+            self._results = results + self._results
+            logger.exception("❌ Outbox: no se pudo registrar el resultado de %s envíos", len(results))
+
+    def _hand_off(self, row: dict) -> bool:
+        self._held.add(row["id"])
+        inbound_at = row["inbound_at"]
+        with turn_context(
+            wa_id=row["conversation_wa_id"],
+            inbound_message_id=row["inbound_message_id"],
+            inbound_at=inbound_at.timestamp() if inbound_at else None,
+            step=row["step"],
+        ):
+            result = self._dispatcher.enqueue(
+                row["to_wa_id"],
+                row["kind"],
+                row["payload"],
+                row["phone_number_id"],
+                priority=row["priority"],
+                on_done=functools.partial(self._on_done, row["id"]),
+            )
+        if result.get("ok"):
+            self._outstanding += 1
+            return True
+        # Rechazada sin llegar al dispatcher (cola llena): nunca se envió, vuelve a PENDING
+        self._results.append(
+            {
+                "id": row["id"],
+                "status": "PENDING",
+                "claimed_at": None,
+                "available_at": datetime.now(timezone.utc) + timedelta(seconds=REQUEUE_BACKOFF_S),
+                "last_error": result.get("error"),
+            }
+        )
+        metrics.inc("outbox_requeued_total", reason=result.get("error") or "rejected")
+        return False
+
+    async def _run(self) -> None:
+        poll_s = max(0.05, settings.outbox_poll_interval_ms / 1000.0)
+        housekeeping_every_s = 60.0
+        loop = asyncio.get_running_loop()
+        last_housekeeping = 0.0
+
+        while not self._stopping:
+            try:
+                # Se limpia antes de trabajar: un notify() posterior despierta la espera de abajo
+                self._wake.clear()
+                await self._flush_results()
+                if loop.time() - last_housekeeping >= housekeeping_every_s:
+                    last_housekeeping = loop.time()
+                    await asyncio.to_thread(_housekeeping, list(self._held))
+                    await self._prune_written()
+
+                room = settings.outbox_max_outstanding - self._outstanding
+                rows = await asyncio.to_thread(_claim_batch, min(room, settings.outbox_batch_size)) if room > 0 else []
+                accepted = sum(self._hand_off(row) for row in rows)
+                if rows:
+                    metrics.inc("outbox_claimed_total", len(rows))
+                if accepted:
+                    continue
+                if rows:
+                    # Dispatcher lleno: se devuelven ya y se espera a que libere espacio
+                    await self._flush_results()
+
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=poll_s)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("❌ Outbox relay: error en el ciclo")
+                await asyncio.sleep(poll_s)
+
+
+outbox_relay = OutboxRelay()
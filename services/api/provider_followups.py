@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import re
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.models import Lead, Provider
+from services.api.outbound_dispatcher import PRIORITY_BULK
+from services.api.whatsapp_cloud import send_text
+
+logger = setup_logging("provider_followups")
+
+QUESTIONS = {
+    "CONTACT": "¿Pudiste *contactar* al cliente?",
+    "SERVICE": "¿Se *realizó* el servicio?",
+}
+
+# "12 SI", "12: no", "#12 1", "12-sí": una respuesta por línea y la línea completa
+# (en texto libre, "llego a las 3 no puedo" no es una respuesta para el LeadID 3)
+_PAIR = re.compile(r"^\s*#?(\d+)(?:\s*[:=\-.)]\s*|\s+)(si|sí|no|1|2)\s*[.!]*\s*$", re.IGNORECASE | re.MULTILINE)
+
+
+def pending_questions(db: Session, provider_id: int) -> dict[int, str]:
+    """LeadID -> pregunta (CONTACT | SERVICE) que el proveedor aún no responde."""
+    leads = (
+        db.query(Lead.id, Lead.status)
+        .filter(Lead.provider_id == provider_id)
+        .filter(
+            or_(
+                and_(Lead.status == "CONTACT_CONFIRM_PENDING", Lead.provider_contact_confirmed.is_(None)),
+                and_(Lead.status == "SERVICE_CONFIRM_PENDING", Lead.provider_service_confirmed.is_(None)),
+            )
+        )
+        .order_by(Lead.id.asc())
+        .all()
+    )
+    return {lead_id: ("CONTACT" if status == "CONTACT_CONFIRM_PENDING" else "SERVICE") for lead_id, status in leads}
+
+
+def _yes_no(token: str) -> bool:
+    return token.lower() in {"1", "si", "sí", "s"}
+
+
+def parse_reply(text: str, pending: dict[int, str]) -> dict[int, bool]:
+    """Respuestas "LeadID SI/NO" del texto, solo para LeadIDs pendientes."""
+    answers: dict[int, bool] = {}
+    for lead_id, token in _PAIR.findall(text or ""):
+        lead_id = int(lead_id)
+        if lead_id in pending:
+            answers[lead_id] = _yes_no(token)
+    return answers
+
+
+def digest_text(items: list[tuple[int, str]], reminder: bool) -> str:
+    """Un mensaje por proveedor con todas sus preguntas pendientes del tick."""
+    if len(items) == 1:
+        lead_id, question = items[0]
+        if reminder:
+            return f"Recordatorio LeadID {lead_id}: responde 1=SI 2=NO {QUESTIONS[question].replace('*', '')}"
+        return (
+            "Seguimiento ConectaPro 👋\n"
+            f"LeadID: {lead_id}\n"
+            f"{QUESTIONS[question]}\n"
+            "Responde:\n1) SI\n2) NO"
+        )
+    header = "Recordatorio ConectaPro ⏰" if reminder else "Seguimiento ConectaPro 👋"
+    lines = [f"• LeadID {lead_id}: {QUESTIONS[question]}" for lead_id, question in items]
+    example = items[0][0]
+    return (
+        f"{header}\n"
+        f"Tienes {len(items)} consultas pendientes:\n"
+        + "\n".join(lines)
+        + f"\n\nResponde con el LeadID y SI/NO, una por línea (ej: \"{example} SI\")."
+    )
+
+
+class ProviderDigest:
+    """
+    Junta las preguntas a proveedores que vencen en un mismo tick del worker y
+    envía un solo mensaje por proveedor (en vez de uno por lead).
+    """
+
+    def __init__(self) -> None:
+        self._items: "OrderedDict[int, tuple[Provider, list[tuple[int, str]], bool]]" = OrderedDict()
+
+    def add(self, provider: Provider, lead_id: int, question: str, *, reminder: bool = False) -> None:
+        if not provider.whatsapp_e164:
+            return
+        _, items, all_reminders = self._items.get(provider.id, (provider, [], True))
+        items.append((lead_id, question))
+        self._items[provider.id] = (provider, items, all_reminders and reminder)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def providers(self) -> list[Provider]:
+        return [provider for provider, _, _ in self._items.values()]
+
+    def lead_ids(self, provider_id: int) -> set[int]:
+        entry = self._items.get(provider_id)
+        return {lead_id for lead_id, _ in entry[1]} if entry else set()
+
+    async def flush(self) -> int:
+        """Envía los digests; devuelve cuántos mensajes se ahorraron frente a uno por lead."""
+        saved = 0
+        for provider, items, reminder in self._items.values():
+            await send_text(
+                provider.whatsapp_e164,
+                digest_text(items, reminder),
+                priority=PRIORITY_BULK if reminder else None,
+            )
+            saved += len(items) - 1
+            metrics.inc("provider_digest_sent_total")
+            metrics.observe("provider_digest_items", len(items), buckets=(1, 2, 3, 5, 10, 20, 50))
+        if saved:
+            metrics.inc("provider_digest_saved_messages_total", saved)
+            logger.info("📨 Digest a proveedores | mensajes=%s | ahorrados=%s", len(self._items), saved)
+        self._items.clear()
+        return saved
+
+
+def answer_summary(answers: dict[int, bool]) -> str:
+    return ", ".join(f"LeadID {lead_id}={'SI' if ans else 'NO'}" for lead_id, ans in sorted(answers.items()))
+
+
+def unresolved_prompt(pending: dict[int, str], answered: Optional[dict[int, bool]] = None) -> str:
+    rest = [(lead_id, q) for lead_id, q in pending.items() if not answered or lead_id not in answered]
+    lines = [f"• LeadID {lead_id}: {QUESTIONS[q]}" for lead_id, q in rest]
+    return "Aún pendientes:\n" + "\n".join(lines) + f"\nResponde con el LeadID y SI/NO (ej: \"{rest[0][0]} SI\")."
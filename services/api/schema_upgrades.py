@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from sqlalchemy import Index, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
+
+from services.common.logging_config import setup_logging
+from services.api.db import Base
+from services.api.match_keys import MATCH_KEY_DDL
+from services.api import models  # noqa: F401  (registra las tablas en Base.metadata)
+
+logger = setup_logging("schema_upgrades")
+
+# Índices de los lookups calientes (por mensaje y del worker). Definidos en models;
+# create_all los crea en bases nuevas y aquí se agregan a las existentes.
+HOT_PATH_INDEXES: tuple[str, ...] = (
+    "ix_providers_whatsapp_e164",
+    "ix_leads_customer_current",
+    "ix_leads_connected_due",
+    "ix_leads_followup_due",
+    "ix_leads_provider_pending",
+    "ix_provider_state_pending_lead",
+)
+
+
+def model_index(name: str) -> Index:
+    for table in Base.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(name)
+
+
+def create_index_ddl(name: str) -> str:
+    return str(CreateIndex(model_index(name), if_not_exists=True).compile(dialect=postgresql.dialect()))
+
+
+# create_all solo crea tablas nuevas: las columnas agregadas a tablas existentes
+# van aquí, idempotentes y en orden.
+UPGRADES: list[str] = [
+    "ALTER TABLE conversation_state ADD COLUMN IF NOT EXISTS phone_number_id VARCHAR(64)",
+    "ALTER TABLE providers ADD COLUMN IF NOT EXISTS phone_number_id VARCHAR(64)",
+    "ALTER TABLE inbound_queue ADD COLUMN IF NOT EXISTS phone_number_id VARCHAR(64)",
+    "ALTER TABLE outbox_messages ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    *MATCH_KEY_DDL,
+    # temp_data JSON -> JSONB; solo si aún es json
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'conversation_state' AND column_name = 'temp_data' AND data_type = 'json'
+        ) THEN
+            ALTER TABLE conversation_state ALTER COLUMN temp_data TYPE JSONB USING temp_data::jsonb;
+        END IF;
+    END
+    $$
+    """,
+    *(create_index_ddl(name) for name in HOT_PATH_INDEXES),
+    # Cubierto por ix_leads_customer_current (customer_wa_id, id DESC)
+    "DROP INDEX IF EXISTS ix_leads_customer_wa_id",
+]
+
+
+def apply_schema_upgrades(db: Session) -> None:
+    for stmt in UPGRADES:
+        db.execute(text(stmt))
+    logger.info("✅ Schema upgrades aplicados | statements=%s", len(UPGRADES))
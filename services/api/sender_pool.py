@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import zlib
+from typing import Optional, Union
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
+from services.api.delivery_tracking import current_turn
+from services.api.models import ConversationState, Provider
+from services.api.settings import settings
+
+logger = setup_logging("sender_pool")
+
+_CACHE_KEY = "sender_numbers"
+
+
+def _hashed(wa_id: str, pool: list[str]) -> str:
+    # Estable entre procesos y reinicios (hash() de Python no lo es)
+    return pool[zlib.crc32(wa_id.encode("utf-8")) % len(pool)]
+
+
+def _stored(db: Session, wa_id: str) -> tuple[Optional[object], Optional[str]]:
+    """Fila que guarda la asignación del wa_id (conversación del cliente o proveedor) y su número."""
+    state = db.query(ConversationState).filter(ConversationState.customer_wa_id == wa_id).first()
+    if state is not None:
+        return state, state.phone_number_id
+    provider = db.query(Provider).filter(Provider.whatsapp_e164 == wa_id).first()
+    if provider is not None:
+        return provider, provider.phone_number_id
+    return None, None
+
+
+def remember_sender(db: Session, owner, phone_number_id: Optional[str]) -> None:
+    """
+    Fija el número del pool por el que escribió el usuario en su conversación
+    (ConversationState o Provider). Las respuestas y seguimientos salen por él.
+    """
+    if not phone_number_id or phone_number_id not in settings.phone_number_pool():
+        return
+    if owner.phone_number_id != phone_number_id:
+        if owner.phone_number_id:
+            metrics.inc("sender_reassigned_total")
+        owner.phone_number_id = phone_number_id
+    wa_id = owner.customer_wa_id if isinstance(owner, ConversationState) else owner.whatsapp_e164
+    db.info.setdefault(_CACHE_KEY, {})[wa_id] = phone_number_id
+
+
+def pick_sender(to_wa_id: str, db: Optional[Session] = None) -> str:
+    """
+    phone_number_id por el que sale un envío a `to_wa_id`:
+      1) el número al que escribió el usuario en este turno;
+      2) la asignación guardada con su conversación;
+      3) uno del pool por hash del wa_id (y se guarda, si hay conversación).
+    Con un solo número configurado siempre es ese.
+    """
+    pool = settings.phone_number_pool()
+    if len(pool) <= 1:
+        return pool[0] if pool else ""
+
+    turn = current_turn.get()
+    if turn is not None and turn.wa_id == to_wa_id and turn.phone_number_id in pool:
+        return turn.phone_number_id
+    if db is None:
+        return _hashed(to_wa_id, pool)
+
+    cache: dict = db.info.setdefault(_CACHE_KEY, {})
+    number = cache.get(to_wa_id)
+    if number is None:
+        owner, number = _stored(db, to_wa_id)
+        if number not in pool:
+            number = _hashed(to_wa_id, pool)
+            if owner is not None:
+                owner.phone_number_id = number
+                metrics.inc("sender_assigned_total")
+        cache[to_wa_id] = number
+    return number
+
+
+async def resolve_sender(to_wa_id: str, db: Optional[Union[Session, AsyncSession]] = None) -> str:
+    """pick_sender para el camino async: con AsyncSession la consulta va por el driver async."""
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(lambda sync_db: pick_sender(to_wa_id, sync_db))
+    return pick_sender(to_wa_id, db)
@@ -10,8 +10,11 @@ class Settings(BaseSettings):
     # WhatsApp Cloud
     whatsapp_verify_token: str = "changeme-verify-token"
     whatsapp_phone_number_id: str = ""
+    # Pool de números emisores (CSV). Vacío = solo whatsapp_phone_number_id
+    whatsapp_phone_number_ids: str = ""
     whatsapp_access_token: str = ""
     whatsapp_graph_version: str = "v20.0"
+    whatsapp_graph_base_url: str = "https://graph.facebook.com"
     whatsapp_provider_template_name: str = ""
     whatsapp_provider_template_lang: str = "es_ES"
 
@@ -27,6 +30,7 @@ class Settings(BaseSettings):
     close_confirm_urgency_hoy_hours: int = 4
     close_confirm_urgency_1_2_dias_hours: int = 24
     close_confirm_urgency_semana_hours: int = 48
+    worker_metrics_log_interval_minutes: int = 5  # el worker no expone /metrics: vuelca el snapshot al log (0 = no)
 
     # Nuevo flujo (router + doble confirmación)
     followup_contact_after_hours: int = 24
@@ -48,11 +52,108 @@ class Settings(BaseSettings):
     # Matching
     top_providers_limit: int = 3
 
+    # Webhook ack-first: cola durable de entrada + consumidores
+    inbound_queue_enabled: int = 0
+    inbound_queue_consumers: int = 4
+    inbound_queue_batch_size: int = 10
+    inbound_queue_poll_interval_ms: int = 500
+    inbound_queue_max_attempts: int = 5
+    inbound_queue_lock_timeout_seconds: int = 120
+    inbound_queue_retention_hours: int = 24
+
+    # Idempotencia: cache en memoria de message_id recientes (antes de Postgres)
+    dedup_cache_size: int = 50000
+    dedup_cache_ttl_seconds: int = 3600
+
+    # Límite de entrada (token bucket por wa_id + global), antes de handle_user_incoming
+    inbound_rate_limit_enabled: int = 1
+    inbound_rate_limit_mode: str = "defer"  # defer | reject (reject descarta sin avisar)
+    inbound_user_rate_per_min: float = 20
+    inbound_user_burst: int = 10
+    inbound_global_rate_per_s: float = 50
+    inbound_global_burst: int = 200
+    inbound_defer_max_ms: int = 10000
+
+    # Modo degradado: apaga LLM (router + NLU híbrido) con cola o latencia altas
+    load_shedding_enabled: int = 1
+    load_shedding_enter_queue_depth: int = 200
+    load_shedding_exit_queue_depth: int = 50
+    load_shedding_enter_p99_seconds: float = 8.0
+    load_shedding_exit_p99_seconds: float = 4.0
+    load_shedding_window_seconds: float = 30
+    load_shedding_min_hold_seconds: float = 30
+    matching_cache_ttl_seconds: int = 60
+
+    # Retención de inbound_messages (claves de dedup) e inbound_message_log (textos, particionada por día)
+    inbound_dedup_window_hours: int = 168  # Meta reintenta webhooks hasta ~7 días
+    inbound_text_retention_days: int = 30  # 0 = no guardar textos
+    inbound_log_partitions_ahead: int = 3
+    inbound_prune_batch_size: int = 5000
+    inbound_maintenance_interval_minutes: int = 60
+
+    # Spool local si la DB no responde en el webhook (JSON lines + fsync por lotes)
+    inbound_spool_enabled: int = 1
+    inbound_spool_dir: str = ""  # vacío = $LOG_DIR/spool
+    inbound_spool_fsync_ms: int = 20
+    inbound_spool_replay_interval_seconds: float = 5.0
+    inbound_spool_replay_batch: int = 100
+
+    # Seguimiento de entrega (wamid + callbacks de estado)
+    delivery_tracking_enabled: int = 1
+    delivery_tracking_flush_ms: int = 500
+
+    # Cliente HTTP compartido para la Graph API (keep-alive + HTTP/2)
+    graph_http2: int = 1
+    graph_max_connections: int = 50
+    graph_max_keepalive_connections: int = 20
+    graph_keepalive_expiry_seconds: float = 60
+    graph_timeout_seconds: float = 20
+    graph_connect_timeout_seconds: float = 5
+
+    # Cola de salida: concurrencia, límite por número emisor y reintentos (429/5xx)
+    outbound_concurrency: int = 16
+    outbound_rate_per_number_per_s: float = 50
+    outbound_burst_per_number: int = 50
+    outbound_max_attempts: int = 5
+    outbound_retry_base_seconds: float = 0.5
+    outbound_retry_max_seconds: float = 30
+    outbound_queue_max: int = 20000
+
+    # Outbox transaccional (envíos escritos junto al cambio de estado y drenados por el relay)
+    outbox_enabled: int = 1
+    outbox_batch_size: int = 50
+    outbox_poll_interval_ms: int = 500
+    outbox_max_outstanding: int = 500
+    outbox_lock_timeout_seconds: int = 300
+    outbox_max_attempts: int = 3  # tomas de una fila (cortes antes de registrar el envío) antes de FAILED
+    outbox_retention_hours: int = 72
+
+    # Campañas masivas a proveedores (endpoints /admin/campaigns con X-Admin-Token)
+    admin_api_token: str = ""
+    campaign_max_inflight: int = 200
+    campaign_fetch_size: int = 500
+    campaign_checkpoint_every: int = 200
+
+    # Digest de seguimientos a proveedores: recordatorios que vencen dentro de esta
+    # ventana se adelantan si el proveedor ya recibe un digest en el tick
+    provider_digest_window_minutes: int = 180
+
+    # Executor por wa_id (orden por usuario, paralelismo entre usuarios)
+    conversation_max_concurrency: int = 32
+    # Ventana para fusionar ráfagas de textos del mismo usuario en un turno (0 = desactivado).
+    # Solo aplica con INBOUND_QUEUE_ENABLED=1: se fusionan los PENDING consecutivos de la cola
+    conversation_coalesce_ms: int = 400
+    conversation_coalesce_max_ms: int = 1500
+
     def allow_services_list(self) -> list[str]:
         return [x.strip() for x in self.allow_services.split(",") if x.strip()]
 
     def allow_urgency_list(self) -> list[str]:
         return [x.strip() for x in self.allow_urgency.split(",") if x.strip()]
 
+    def phone_number_pool(self) -> list[str]:
+        pool = [x.strip() for x in self.whatsapp_phone_number_ids.split(",") if x.strip()]
+        return pool or ([self.whatsapp_phone_number_id] if self.whatsapp_phone_number_id else [])
+
 
 settings = Settings()
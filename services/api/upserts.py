@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+from typing import Optional
+
+from sqlalchemy import Boolean, column, func, literal_column, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from services.api.models import ConversationState, Customer, Lead, ProviderState
+
+# Get-or-create de las filas que nacen con el primer mensaje: un solo round trip
+# (INSERT ... ON CONFLICT ... RETURNING) y seguro con el mismo wa_id en paralelo.
+
+# xmax = 0 solo en la versión de fila recién insertada (no en la que tocó DO UPDATE)
+_INSERTED = literal_column("(xmax = 0)", Boolean).label("inserted")
+
+_REFRESH = {"populate_existing": True}
+
+
+async def get_or_create_state(db: AsyncSession, wa_id: str) -> tuple[ConversationState, bool]:
+    """
+    ConversationState del wa_id (creada en START si no existía) y si se creó.
+    El DO UPDATE (sin cambios) devuelve la fila existente y la deja bloqueada
+    hasta el commit del turno: dos turnos del mismo wa_id, aunque corran en
+    procesos distintos, se serializan aquí.
+    """
+    stmt = pg_insert(ConversationState).values(customer_wa_id=wa_id, step="START", lead_id=None)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ConversationState.customer_wa_id],
+        set_={"customer_wa_id": stmt.excluded.customer_wa_id},
+    ).returning(ConversationState, _INSERTED)
+    state, inserted = (await db.execute(stmt, execution_options=_REFRESH)).one()
+    return state, inserted
+
+
+def _current_lead_sql() -> str:
+    cols = ", ".join(c.name for c in Lead.__table__.c)
+    return f"""
+        WITH cur AS (
+            SELECT {cols} FROM leads WHERE customer_wa_id = :wa_id ORDER BY id DESC LIMIT 1
+        ), ins AS (
+            INSERT INTO leads (customer_wa_id, status)
+            SELECT CAST(:wa_id AS VARCHAR), 'OPEN' WHERE NOT EXISTS (SELECT 1 FROM cur)
+            RETURNING {cols}
+        )
+        SELECT {cols}, false AS inserted FROM cur
+        UNION ALL
+        SELECT {cols}, true AS inserted FROM ins
+    """
+
+
+_CURRENT_LEAD = text(_current_lead_sql()).columns(*Lead.__table__.c, column("inserted", Boolean))
+
+
+async def get_or_create_current_lead(db: AsyncSession, wa_id: str) -> tuple[Lead, bool]:
+    """
+    Lead vigente del cliente (el de mayor id) o uno nuevo en OPEN, y si se creó.
+    leads no tiene clave única por cliente: la exclusión la da el lock de la fila
+    de conversation_state (llamar después de get_or_create_state).
+    """
+    stmt = select(Lead, column("inserted", Boolean)).from_statement(_CURRENT_LEAD.bindparams(wa_id=wa_id))
+    lead, inserted = (await db.execute(stmt, execution_options=_REFRESH)).one()
+    return lead, inserted
+
+
+async def ensure_customer(db: AsyncSession, wa_id: str) -> None:
+    """Crea el Customer si no existe (ON CONFLICT DO NOTHING)."""
+    stmt = pg_insert(Customer).values(wa_id=wa_id).on_conflict_do_nothing(index_elements=[Customer.wa_id])
+    await db.execute(stmt)
+
+
+def upsert_provider_state(db: Session, provider_id: int, pending_lead_id: Optional[int], pending_question: Optional[str]) -> None:
+    """Fija la pregunta pendiente del proveedor, creando su ProviderState si hace falta."""
+    stmt = pg_insert(ProviderState).values(
+        provider_id=provider_id,
+        pending_lead_id=pending_lead_id,
+        pending_question=pending_question,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ProviderState.provider_id],
+        set_={
+            "pending_lead_id": stmt.excluded.pending_lead_id,
+            "pending_question": stmt.excluded.pending_question,
+            "updated_at": func.now(),
+        },
+    )
+    db.execute(stmt)
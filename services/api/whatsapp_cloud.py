@@ -1,51 +1,107 @@
+from typing import Optional
+
 import httpx
 from services.common.logging_config import setup_logging
+from .delivery_tracking import delivery_tracker
+from .graph_client import graph_client
+from .outbound_dispatcher import (
+    RETRIABLE_STATUS,
+    DoneCallback,
+    OutboundDispatcher,
+    OutboundJob,
+    RetriableSendError,
+    SendError,
+    default_priority,
+    retry_after_seconds,
+)
+from .outbox import buffer_send, outbox_session
+from .sender_pool import resolve_sender
 from .settings import settings
 
 logger = setup_logging("api")
 
 
 def _is_configured() -> bool:
-    return bool(settings.whatsapp_phone_number_id and settings.whatsapp_access_token)
+    return bool(settings.phone_number_pool() and settings.whatsapp_access_token)
+
+
+def _track_sent(data: dict, to_wa_id: str, kind: str) -> Optional[str]:
+    """Registra el wamid devuelto por Meta para cruzarlo luego con los callbacks de estado."""
+    try:
+        wa_message_id = data["messages"][0]["id"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    delivery_tracker.record_outbound(wa_message_id, to_wa_id, kind)
+    return wa_message_id
+
+
+async def _send_job(job: OutboundJob) -> Optional[str]:
+    """Envío real (lo ejecuta el dispatcher). 429/5xx/red -> RetriableSendError."""
+    try:
+        r = await graph_client.post(f"{job.phone_number_id}/messages", job.payload)
+    except httpx.TransportError as exc:
+        raise RetriableSendError(type(exc).__name__) from exc
+
+    # Log útil SIEMPRE (para debug)
+    logger.info("WA SEND status=%s to=%s attempt=%s", r.status_code, job.to_wa_id, job.attempts)
+
+    if r.status_code in RETRIABLE_STATUS:
+        logger.warning("WA SEND RETRIABLE status=%s body=%s", r.status_code, r.text)
+        raise RetriableSendError(f"http_{r.status_code}", retry_after=retry_after_seconds(r))
+
+    # Si falla, loguea el cuerpo (Meta siempre explica el motivo)
+    if r.status_code >= 400:
+        logger.error("WA SEND ERROR status=%s body=%s", r.status_code, r.text)
+        raise SendError(f"http_{r.status_code}")
+
+    return _track_sent(r.json(), job.to_wa_id, job.kind)
+
+
+dispatcher = OutboundDispatcher(
+    _send_job,
+    concurrency=settings.outbound_concurrency,
+    rate_per_s=settings.outbound_rate_per_number_per_s,
+    burst=settings.outbound_burst_per_number,
+    max_queued=settings.outbound_queue_max,
+)
+
+
+async def _post_message(
+    payload: dict, to_wa_id: str, kind: str, priority: int | None, on_done: DoneCallback | None = None
+) -> dict:
+    """
+    Vuelve de inmediato. Dentro de un turno (sesión ligada con bind_outbox) el envío
+    queda en el buffer de la transacción y sale con su commit: como fila de
+    outbox_messages (OUTBOX_ENABLED=1) o encolado en el dispatcher. Textos seguidos
+    al mismo destinatario se unen en un solo envío. Fuera de un turno va directo
+    a la cola del dispatcher (con reintentos); on_done solo aplica en ese caso.
+    """
+    db = outbox_session.get()
+    phone_number_id = await resolve_sender(to_wa_id, db)
+    if db is not None and on_done is None:
+        return buffer_send(
+            db,
+            to_wa_id=to_wa_id,
+            kind=kind,
+            payload=payload,
+            phone_number_id=phone_number_id,
+            priority=default_priority() if priority is None else priority,
+        )
+    return dispatcher.enqueue(to_wa_id, kind, payload, phone_number_id, priority=priority, on_done=on_done)
 
 
-async def send_text(to_wa_id: str, text: str) -> dict:
+async def send_text(to_wa_id: str, text: str, priority: int | None = None) -> dict:
     if not _is_configured():
         logger.warning("[MOCK SEND] WHATSAPP no configurado. to=%s text=%s", to_wa_id, text)
         return {"mock": True, "to": to_wa_id, "text": text}
 
-    url = f"https://graph.facebook.com/{settings.whatsapp_graph_version}/{settings.whatsapp_phone_number_id}/messages"
-    headers = {
-        "Authorization": f"Bearer {settings.whatsapp_access_token}",
-        "Content-Type": "application/json",
-    }
     payload = {
         "messaging_product": "whatsapp",
         "to": to_wa_id,
         "type": "text",
         "text": {"body": text},
     }
-
-    try:
-        async with httpx.AsyncClient(timeout=20) as client:
-            r = await client.post(url, headers=headers, json=payload)
-
-        # Log útil SIEMPRE (para debug)
-        logger.info("WA SEND status=%s to=%s", r.status_code, to_wa_id)
-
-        # Si falla, loguea el cuerpo (Meta siempre explica el motivo)
-        if r.status_code >= 400:
-            logger.error("WA SEND ERROR status=%s body=%s", r.status_code, r.text)
-
-        r.raise_for_status()
-        return r.json()
-
-    except httpx.HTTPStatusError as exc:
-        logger.exception("WA SEND EXCEPTION to=%s status=%s", to_wa_id, exc.response.status_code)
-        return {"ok": False, "status_code": exc.response.status_code, "error": exc.response.text}
-    except Exception:
-        logger.exception("WA SEND EXCEPTION to=%s", to_wa_id)
-        return {"ok": False, "error": "unexpected_error"}
+    return await _post_message(payload, to_wa_id, "text", priority)
 
 
 async def send_list(
@@ -54,6 +110,7 @@ async def send_list(
     button_text: str,
     rows: list[dict],
     section_title: str = "Opciones",
+    priority: int | None = None,
 ) -> dict:
     if not _is_configured():
         logger.warning(
@@ -69,11 +126,6 @@ async def send_list(
             "button": button_text,
         }
 
-    url = f"https://graph.facebook.com/{settings.whatsapp_graph_version}/{settings.whatsapp_phone_number_id}/messages"
-    headers = {
-        "Authorization": f"Bearer {settings.whatsapp_access_token}",
-        "Content-Type": "application/json",
-    }
     payload = {
         "messaging_product": "whatsapp",
         "to": to_wa_id,
@@ -92,24 +144,7 @@ async def send_list(
             },
         },
     }
-
-    try:
-        async with httpx.AsyncClient(timeout=20) as client:
-            r = await client.post(url, headers=headers, json=payload)
-
-        logger.info("WA SEND status=%s to=%s", r.status_code, to_wa_id)
-        if r.status_code >= 400:
-            logger.error("WA SEND ERROR status=%s body=%s", r.status_code, r.text)
-
-        r.raise_for_status()
-        return r.json()
-    except httpx.HTTPStatusError as exc:
-        logger.exception("WA SEND EXCEPTION to=%s status=%s", to_wa_id, exc.response.status_code)
-        return {"ok": False, "status_code": exc.response.status_code, "error": exc.response.text}
-    except Exception:
-        logger.exception("WA SEND EXCEPTION to=%s", to_wa_id)
-        return {"ok": False, "error": "unexpected_error"}
-
+    return await _post_message(payload, to_wa_id, "list", priority)
 
 
 async def send_template(
@@ -117,6 +152,8 @@ async def send_template(
     template_name: str,
     language_code: str = "es_ES",
     components: list[dict] | None = None,
+    priority: int | None = None,
+    on_done: DoneCallback | None = None,
 ) -> dict:
     if not _is_configured():
         logger.warning(
@@ -131,11 +168,6 @@ async def send_template(
             "components": components or [],
         }
 
-    url = f"https://graph.facebook.com/{settings.whatsapp_graph_version}/{settings.whatsapp_phone_number_id}/messages"
-    headers = {
-        "Authorization": f"Bearer {settings.whatsapp_access_token}",
-        "Content-Type": "application/json",
-    }
     payload = {
         "messaging_product": "whatsapp",
         "to": to_wa_id,
@@ -148,19 +180,4 @@ async def send_template(
     if components:
         payload["template"]["components"] = components
 
-    try:
-        async with httpx.AsyncClient(timeout=20) as client:
-            r = await client.post(url, headers=headers, json=payload)
-
-        logger.info("WA SEND status=%s to=%s", r.status_code, to_wa_id)
-        if r.status_code >= 400:
-            logger.error("WA SEND ERROR status=%s body=%s", r.status_code, r.text)
-
-        r.raise_for_status()
-        return r.json()
-    except httpx.HTTPStatusError as exc:
-        logger.exception("WA SEND EXCEPTION to=%s status=%s", to_wa_id, exc.response.status_code)
-        return {"ok": False, "status_code": exc.response.status_code, "error": exc.response.text}
-    except Exception:
-        logger.exception("WA SEND EXCEPTION to=%s", to_wa_id)
-        return {"ok": False, "error": "unexpected_error"}
+    return await _post_message(payload, to_wa_id, "template", priority, on_done=on_done)
@@ -1,29 +1,191 @@
+import asyncio
+import functools
+
 from fastapi import APIRouter, Request
 
 from services.common.logging_config import setup_logging
-from services.api.db import SessionLocal
-from services.api.models import InboundMessage
+from services.api.db import AsyncSessionLocal
+from services.common.metrics import metrics
+from services.api.webhook_payload import InboundEvent, extract_events
+from services.api.delivery_tracking import delivery_tracker
+from services.api.dedup import claim_new_message_ids, recent_message_ids
 from services.api.settings import settings
-from services.api.leads_flow import handle_user_incoming
+from services.api.conversation_executor import executor
+from services.api.inbound_queue import consumers as inbound_consumers, enqueue_message
+from services.api.inbound_throttle import inbound_throttle
+from services.api.inbound_spool import inbound_spool
 
 router = APIRouter()
 logger = setup_logging("whatsapp_webhook")
 
+# Referencias a los envíos diferidos (evita que el GC cancele las tareas)
+_deferred: set[asyncio.Task] = set()
+
+
+def _log_failed_statuses(statuses: list[dict]) -> None:
+    for status in statuses:
+        logger.warning(
+            "❌ WA message failed | id=%s | recipient_id=%s | errors=%s",
+            status.get("id"),
+            status.get("recipient_id"),
+            status.get("errors"),
+        )
+
+
+def _drop_seen(messages: list[InboundEvent]) -> list[InboundEvent]:
+    """Duplicates inside the payload and recently seen IDs (in-memory cache), without Postgres."""
+    candidates: list[InboundEvent] = []
+    batch_keys: set[tuple[str, str]] = set()
+    for m in messages:
+        if m.msg_id:
+            key = (m.wa_id, m.msg_id)
+            if key in batch_keys or key in recent_message_ids:
+                metrics.inc("dedup_cache_hits_total")
+                logger.info("♻️ Duplicate message ignored (cache) | wa_id=%s | msg_id=%s", m.wa_id, m.msg_id)
+                continue
+            batch_keys.add(key)
+        candidates.append(m)
+    return candidates
+
+
+async def _filter_new(db, messages: list[InboundEvent]) -> list[InboundEvent]:
+    """Single idempotency pass for the whole batch.
+
+    1. duplicates inside the payload and recently seen IDs (in-memory cache)
+       are dropped without touching Postgres (_drop_seen);
+    2. the rest go through one INSERT ... ON CONFLICT DO NOTHING RETURNING
+       against uq_inbound_wa_msg.
+
+    New keys are added to the cache by the caller, only after commit.
+    """
+    candidates = _drop_seen(messages)
+
+    inserted = await db.run_sync(
+        claim_new_message_ids,
+        [
+            {"customer_wa_id": m.wa_id, "message_id": m.msg_id, "text": m.text or ""}
+            for m in candidates
+            if m.msg_id
+        ],
+    )
+
+    fresh: list[InboundEvent] = []
+    for m in candidates:
+        if m.msg_id:
+            key = (m.wa_id, m.msg_id)
+            if key not in inserted:
+                metrics.inc("dedup_db_hits_total")
+                recent_message_ids.add(key)
+                logger.info("♻️ Duplicate message ignored | wa_id=%s | msg_id=%s", m.wa_id, m.msg_id)
+                continue
+        fresh.append(m)
+    return fresh
 
-def _safe_get(d, *keys, default=None):
-    cur = d
-    for k in keys:
-        try:
-            cur = cur[k]
-        except Exception:
-            return default
-    return cur
+
+def _remember(messages: list[InboundEvent]) -> None:
+    recent_message_ids.add_many((m.wa_id, m.msg_id) for m in messages if m.msg_id)
+
+
+def _throttle(messages: list[InboundEvent]) -> tuple[list[InboundEvent], dict[int, float]]:
+    """Aplica el límite de entrada; devuelve los admitidos y el retraso (s) de los diferidos, por id(evento)."""
+    admitted: list[InboundEvent] = []
+    delays: dict[int, float] = {}
+    for m in messages:
+        delay = inbound_throttle.admit(m.wa_id)
+        if delay is None:
+            continue
+        if delay > 0:
+            delays[id(m)] = delay
+        admitted.append(m)
+    dropped = len(messages) - len(admitted)
+    if dropped:
+        logger.warning("🚦 Throttled | dropped=%s | deferred=%s", dropped, len(delays))
+    return admitted, delays
+
+
+async def _register(messages: list[InboundEvent], delays: dict[int, float]) -> list[InboundEvent]:
+    """
+    Idempotencia (+ encolado en modo ack-first) en una transacción, en la sesión
+    async: ni el round trip ni un Postgres caído bloquean el loop. Lanza si la DB falla.
+    """
+    async with AsyncSessionLocal() as db:
+        fresh = await _filter_new(db, messages)
+        if settings.inbound_queue_enabled:
+            # Ack-first: idempotencia + encolado del lote en una sola transacción
+            for m in fresh:
+                enqueue_message(
+                    db,
+                    wa_id=m.wa_id,
+                    msg_id=m.msg_id,
+                    text=m.text,
+                    raw_message=m.message,
+                    phone_number_id=m.phone_number_id,
+                    delay_s=delays.get(id(m), 0.0),
+                )
+        await db.commit()
+    _remember(fresh)
+    return fresh
+
+
+def _log_turn_error(m: InboundEvent, fut: asyncio.Future) -> None:
+    if not fut.cancelled() and fut.exception() is not None:
+        logger.error("❌ Error procesando mensaje | wa_id=%s | msg_id=%s | err=%r", m.wa_id, m.msg_id, fut.exception())
+
+
+async def replay_spooled(messages: list[InboundEvent]) -> None:
+    """Replay del spool (en orden): mismo registro que el webhook; sin esperar los turnos."""
+    fresh = await _register(messages, {})
+    logger.info("📼 Replay del spool | messages=%s | new=%s", len(messages), len(fresh))
+    if settings.inbound_queue_enabled:
+        if fresh:
+            inbound_consumers.notify()
+    else:
+        for m in fresh:
+            executor.submit(m.wa_id, m).add_done_callback(functools.partial(_log_turn_error, m))
+
+
+async def _spool(messages: list[InboundEvent]) -> None:
+    try:
+        await inbound_spool.append(messages)
+        logger.warning("📼 Lote guardado en spool local | messages=%s", len(messages))
+    except Exception:
+        logger.exception("❌ Spool local falló: lote perdido | messages=%s", len(messages))
+
+
+async def _submit_later(m: InboundEvent, delay_s: float) -> None:
+    """
+    Modo inline: el mensaje diferido se registra (idempotencia) recién al
+    ejecutarse. Si el proceso cae durante la espera no queda marcado como visto
+    y un reintento de Meta vuelve a entrar.
+    """
+    await asyncio.sleep(delay_s)
+    try:
+        fresh = await _register([m], {})
+    except Exception as e:
+        logger.exception("❌ Error registrando mensaje diferido | wa_id=%s | msg_id=%s | err=%s", m.wa_id, m.msg_id, e)
+        if settings.inbound_spool_enabled and inbound_spool.running:
+            await _spool([m])
+        return
+    if not fresh:
+        return
+    try:
+        await executor.submit(m.wa_id, m)
+    except Exception as e:
+        logger.error("❌ Error procesando mensaje diferido | wa_id=%s | msg_id=%s | err=%r", m.wa_id, m.msg_id, e)
 
 
 @router.post("/webhooks/whatsapp")
 async def whatsapp_webhook(request: Request):
     """Receives WhatsApp Cloud API webhooks.
 
+    The raw body is decoded once by the low-allocation extractor. Status
+    callbacks feed the delivery tracker (DELIVERY_TRACKING_ENABLED=1) or are
+    dropped before decoding. Meta may batch several entries, changes and
+    messages into one POST: all of them are extracted, deduplicated in one
+    round-trip (after an in-memory recent-ID cache that absorbs retry
+    storms) and dispatched as one batch to the per-wa_id executor: messages
+    of the same wa_id run in order, different wa_ids run concurrently.
+
     Logs:
       - event type (messages/statuses)
       - wa_id, msg_id, type, text
@@ -31,111 +193,100 @@ async def whatsapp_webhook(request: Request):
       - exceptions inside processing
 
     Returns 200 OK even on internal errors to avoid WhatsApp retry storms.
+
+    Before any DB work, messages not already in the recent-ID cache pass the
+    inbound token buckets (per wa_id and global): overflow is delayed
+    (INBOUND_RATE_LIMIT_MODE=defer, the default) or dropped (reject).
+
+    With INBOUND_QUEUE_ENABLED=1 (ack-first) the messages are only persisted to
+    the durable inbound queue and processed later by the queue consumers.
+
+    If the database is unavailable, the batch is appended to the local spool
+    (INBOUND_SPOOL_ENABLED=1) before answering 200 and replayed in order once
+    Postgres is back.
     """
 
     try:
-        payload = await request.json()
+        extracted = extract_events(await request.body(), want_statuses=bool(settings.delivery_tracking_enabled))
     except Exception as e:
         logger.exception("❌ No se pudo leer JSON del webhook: %s", e)
         return {"ok": True}
 
-    value = _safe_get(payload, "entry", 0, "changes", 0, "value", default={})
-    phone_number_id = value.get("metadata", {}).get("phone_number_id")
-    has_messages = "messages" in value
-    has_statuses = "statuses" in value
-
-    logger.info(
-        "📩 Webhook event | phone_number_id=%s | has_messages=%s | has_statuses=%s",
-        phone_number_id,
-        has_messages,
-        has_statuses,
-    )
+    if extracted.failed_statuses:
+        _log_failed_statuses(extracted.failed_statuses)
+    if extracted.statuses:
+        delivery_tracker.add_statuses(extracted.statuses)
+    if extracted.status_only:
+        metrics.inc("webhook_status_only_total")
+        return {"ok": True}
 
-    # Status updates (delivered/read/etc.)
-    if has_statuses and not has_messages:
-        statuses = value.get("statuses", [])
-        kinds = [s.get("status") for s in statuses]
-        logger.info("ℹ️ Status event | kinds=%s", kinds)
-        for status in statuses:
-            if status.get("status") == "failed":
-                logger.warning(
-                    "❌ WA message failed | id=%s | recipient_id=%s | errors=%s",
-                    status.get("id"),
-                    status.get("recipient_id"),
-                    status.get("errors"),
-                )
+    messages = extracted.events
+    logger.info("📩 Webhook event | messages=%s | skipped=%s", len(messages), extracted.skipped)
+    for m in messages:
+        logger.debug(
+            "💬 Incoming message | wa_id=%s | msg_id=%s | type=%s | text=%s",
+            m.wa_id,
+            m.msg_id,
+            m.type,
+            m.text,
+        )
+    if not messages:
+        logger.info("ℹ️ Event without processable messages (ignored)")
         return {"ok": True}
 
-    if not has_messages:
-        logger.info("ℹ️ Event without messages (ignored)")
+    # Reintentos de Meta y entregas duplicadas fuera antes del límite: no gastan tokens
+    messages = _drop_seen(messages)
+    if not messages:
         return {"ok": True}
 
-    # Extract first message
-    message = value["messages"][0]
-    wa_id = _safe_get(value, "contacts", 0, "wa_id", default=None)
-    msg_id = message.get("id")
-    mtype = message.get("type")
-
-    text = None
-    if mtype == "text":
-        text = _safe_get(message, "text", "body", default=None)
-    elif mtype == "interactive":
-        list_reply = _safe_get(message, "interactive", "list_reply", default={})
-        button_reply = _safe_get(message, "interactive", "button_reply", default={})
-        reply_title = list_reply.get("title") or button_reply.get("title")
-        reply_id = list_reply.get("id") or button_reply.get("id")
-        text = reply_title or reply_id
-        if reply_id and reply_id.startswith("comuna:"):
-            text = reply_id.split("comuna:", 1)[1]
-
-    logger.info(
-        "💬 Incoming message | wa_id=%s | msg_id=%s | type=%s | text=%s",
-        wa_id,
-        msg_id,
-        mtype,
-        text,
-    )
+    delays: dict[int, float] = {}
+    if settings.inbound_rate_limit_enabled:
+        messages, delays = _throttle(messages)
+        if not messages:
+            return {"ok": True}
 
-    if not wa_id:
-        logger.warning("⚠️ Missing wa_id in payload; cannot process")
+    spool_on = bool(settings.inbound_spool_enabled and inbound_spool.running)
+    if spool_on and inbound_spool.backlogged:
+        # Aún hay eventos en el spool: este lote va detrás de ellos (orden por usuario)
+        await _spool(messages)
         return {"ok": True}
 
-    if not text:
-        logger.info("ℹ️ Non-text message (ignored) | type=%s", mtype)
-        return {"ok": True}
+    batch = messages
+    deferred: list[InboundEvent] = []
+    if delays and not settings.inbound_queue_enabled:
+        # Inline: sin cola durable, el diferido se registra al ejecutarse (_submit_later)
+        deferred = [m for m in messages if id(m) in delays]
+        messages = [m for m in messages if id(m) not in delays]
 
-    db = None
     try:
-        db = SessionLocal()
-        if msg_id:
-            exists = (
-                db.query(InboundMessage)
-                .filter(InboundMessage.customer_wa_id == wa_id)
-                .filter(InboundMessage.message_id == msg_id)
-                .first()
-            )
-            if exists:
-                logger.info("♻️ Duplicate message ignored | wa_id=%s | msg_id=%s", wa_id, msg_id)
-                return {"ok": True}
-            db.add(InboundMessage(customer_wa_id=wa_id, message_id=msg_id, text=text or ""))
-            db.commit()
-        await handle_user_incoming(db=db, wa_id=wa_id, text=text, raw_message=message)
-        logger.info("✅ Processed message | wa_id=%s | msg_id=%s", wa_id, msg_id)
+        fresh = await _register(messages, delays)
     except Exception as e:
-        logger.exception(
-            "❌ Error procesando mensaje | wa_id=%s | msg_id=%s | err=%s",
-            wa_id,
-            msg_id,
-            e,
-        )
+        logger.exception("❌ Error registrando lote | messages=%s | err=%s", len(messages), e)
+        if spool_on:
+            # DB caída: al spool local; el replayer los procesa cuando Postgres vuelva
+            await _spool(batch)
         return {"ok": True}
-    finally:
-        try:
-            if db is not None:
-                db.close()
-        except Exception:
-            pass
+    if settings.inbound_queue_enabled:
+        if fresh:
+            inbound_consumers.notify()
+        logger.info("📥 Queued batch | messages=%s | new=%s", len(messages), len(fresh))
+        return {"ok": True}
+
+    for m in deferred:
+        task = asyncio.create_task(_submit_later(m, delays[id(m)]))
+        _deferred.add(task)
+        task.add_done_callback(_deferred.discard)
 
+    futures = [executor.submit(m.wa_id, m) for m in fresh]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    for m, res in zip(fresh, results):
+        if isinstance(res, Exception):
+            logger.error(
+                "❌ Error procesando mensaje | wa_id=%s | msg_id=%s | err=%r",
+                m.wa_id,
+                m.msg_id,
+                res,
+            )
     return {"ok": True}
 
 
@@ -0,0 +1,109 @@
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# Buckets en segundos (latencias típicas: ms de DB hasta decenas de segundos de LLM/Graph)
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def _key(name: str, labels: Dict[str, object]) -> str:
+    if not labels:
+        return name
+    inner = ",".join(f"{k}={labels[k]}" for k in sorted(labels))
+    return f"{name}{{{inner}}}"
+
+
+class Histogram:
+    """Histograma de buckets fijos (acumulados al exportar) con percentiles aproximados."""
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # último = +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        target = q * self.count
+        running = 0
+        for i, c in enumerate(self.counts):
+            running += c
+            if running >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        cumulative = {}
+        running = 0
+        for upper, c in zip(list(self.buckets) + [float("inf")], self.counts):
+            running += c
+            cumulative["+Inf" if upper == float("inf") else str(upper)] = running
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.50),
+            "p90": self.quantile(0.90),
+            "p99": self.quantile(0.99),
+            "buckets": cumulative,
+        }
+
+
+class MetricsRegistry:
+    """
+    Registro de métricas en memoria del proceso (contadores, gauges, histogramas).
+
+    Los gauges pueden registrarse como funciones para leer el valor al exportar
+    (ej: profundidad de colas). Se exporta como JSON vía /metrics.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._gauge_fns: Dict[str, Callable[[], float]] = {}
+        self._histograms: Dict[str, Histogram] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        k = _key(name, labels)
+        with self._lock:
+            self._counters[k] = self._counters.get(k, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def register_gauge(self, name: str, fn: Callable[[], float], **labels) -> None:
+        with self._lock:
+            self._gauge_fns[_key(name, labels)] = fn
+
+    def observe(self, name: str, value: float, buckets: Iterable[float] = DEFAULT_BUCKETS, **labels) -> None:
+        k = _key(name, labels)
+        with self._lock:
+            h = self._histograms.get(k)
+            if h is None:
+                h = self._histograms[k] = Histogram(buckets)
+            h.observe(value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            gauge_fns = dict(self._gauge_fns)
+            histograms = {k: h.snapshot() for k, h in self._histograms.items()}
+        for k, fn in gauge_fns.items():
+            try:
+                gauges[k] = fn()
+            except Exception:
+                gauges[k] = None
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+
+metrics = MetricsRegistry()
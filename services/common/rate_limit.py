@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+
+class TokenBucket:
+    """
+    Token bucket clásico: `rate` tokens/segundo, capacidad `burst`.
+
+    - try_acquire(): toma tokens solo si hay (rechazo barato, O(1)).
+    - reserve(): toma tokens aunque deje el saldo negativo y devuelve cuántos
+      segundos hay que esperar; reservas sucesivas quedan en orden.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "_clock")
+
+    def __init__(self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = max(1e-9, float(rate))
+        self.burst = max(1.0, float(burst))
+        self._clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def try_acquire(self, n: float = 1.0) -> bool:
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def wait_time(self, n: float = 1.0) -> float:
+        """Segundos hasta que haya `n` tokens (0 si ya hay)."""
+        self._refill()
+        missing = n - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def reserve(self, n: float = 1.0) -> float:
+        delay = self.wait_time(n)
+        self.tokens -= n
+        return delay
+
+    def refund(self, n: float = 1.0) -> None:
+        self.tokens = min(self.burst, self.tokens + n)
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class KeyedTokenBuckets:
+    """
+    Un TokenBucket por clave (p.ej. wa_id), acotado a `max_keys` (LRU).
+
+    Expulsar un bucket equivale a devolverlo lleno: solo se pierde el castigo
+    de una clave inactiva, nunca se bloquea a alguien por falta de memoria.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max(1, max_keys)
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def get(self, key: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def peek(self, key: Hashable) -> Optional[TokenBucket]:
+        return self._buckets.get(key)
@@ -0,0 +1,152 @@
+"""
+Graph API falsa para pruebas locales de carga y latencia.
+
+Atiende POST /{version}/{phone_number_id}/messages como Meta: exige el header
+Authorization, registra el payload y responde con un wamid realista. Puede
+inyectar latencia (fija + jitter) y errores 429 (con Retry-After) y 5xx con la
+probabilidad configurada, para ejercitar el camino real de envío
+(graph_client -> dispatcher -> outbox) sin red.
+
+Se apunta la API/worker con WHATSAPP_GRAPH_BASE_URL=http://fake_graph:9000
+(perfil "loadtest" de docker-compose). La configuración se puede cambiar en
+caliente con POST /_fake/config.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import itertools
+import random
+import time
+from collections import deque
+from typing import Deque, Optional
+
+from fastapi import FastAPI, Header, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from services.common.logging_config import setup_logging
+
+logger = setup_logging("fake_graph")
+
+
+class FakeGraphSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="FAKE_GRAPH_", extra="ignore")
+
+    latency_ms: int = 80
+    latency_jitter_ms: int = 40
+    rate_429: float = 0.0
+    rate_5xx: float = 0.0
+    retry_after_seconds: int = 1
+    max_recorded: int = 10000
+    seed: Optional[int] = None
+
+
+class FakeGraphConfig(BaseModel):
+    latency_ms: Optional[int] = None
+    latency_jitter_ms: Optional[int] = None
+    rate_429: Optional[float] = None
+    rate_5xx: Optional[float] = None
+    retry_after_seconds: Optional[int] = None
+
+
+config = FakeGraphSettings()
+_rng = random.Random(config.seed)
+_seq = itertools.count(1)
+_recorded: Deque[dict] = deque(maxlen=config.max_recorded)
+_stats = {"requests": 0, "accepted": 0, "throttled": 0, "server_errors": 0, "unauthorized": 0}
+
+app = FastAPI(title="Fake WhatsApp Graph API", version="0.1.0")
+
+
+def _wamid(to: str) -> str:
+    # Mismo formato que Meta: "wamid." + base64 de un identificador con el destinatario
+    raw = f"\x15\x02\x00\x11\x18\x12{to}{next(_seq):020d}".encode("utf-8")
+    return "wamid." + base64.b64encode(raw).decode("ascii")
+
+
+def _error(status: int, code: int, message: str, headers: Optional[dict] = None) -> JSONResponse:
+    return JSONResponse(
+        status_code=status,
+        headers=headers,
+        content={"error": {"message": message, "type": "OAuthException", "code": code, "fbtrace_id": "FAKE"}},
+    )
+
+
+@app.post("/{version}/{phone_number_id}/messages")
+async def messages(
+    version: str,
+    phone_number_id: str,
+    request: Request,
+    authorization: Optional[str] = Header(default=None),
+):
+    _stats["requests"] += 1
+    if not authorization or not authorization.startswith("Bearer "):
+        _stats["unauthorized"] += 1
+        return _error(401, 190, "Invalid OAuth access token.")
+
+    delay_ms = config.latency_ms + _rng.uniform(0, config.latency_jitter_ms)
+    if delay_ms > 0:
+        await asyncio.sleep(delay_ms / 1000.0)
+
+    roll = _rng.random()
+    if roll < config.rate_429:
+        _stats["throttled"] += 1
+        return _error(
+            429, 130429, "Rate limit hit", headers={"Retry-After": str(config.retry_after_seconds)}
+        )
+    if roll < config.rate_429 + config.rate_5xx:
+        _stats["server_errors"] += 1
+        return _error(_rng.choice((500, 502, 503)), 131000, "Something went wrong")
+
+    payload = await request.json()
+    to = str(payload.get("to", ""))
+    wamid = _wamid(to)
+    _recorded.append(
+        {
+            "wamid": wamid,
+            "version": version,
+            "phone_number_id": phone_number_id,
+            "received_at": time.time(),
+            "payload": payload,
+        }
+    )
+    _stats["accepted"] += 1
+    return {
+        "messaging_product": "whatsapp",
+        "contacts": [{"input": to, "wa_id": to}],
+        "messages": [{"id": wamid}],
+    }
+
+
+@app.get("/_fake/messages")
+def recorded_messages(to: Optional[str] = None, limit: int = 100):
+    items = [m for m in _recorded if to is None or m["payload"].get("to") == to]
+    return {"count": len(items), "messages": items[-limit:]}
+
+
+@app.delete("/_fake/messages")
+def reset():
+    _recorded.clear()
+    for k in _stats:
+        _stats[k] = 0
+    return {"ok": True}
+
+
+@app.get("/_fake/stats")
+def stats():
+    return {**_stats, "recorded": len(_recorded), "config": config.model_dump()}
+
+
+@app.post("/_fake/config")
+def update_config(body: FakeGraphConfig):
+    for k, v in body.model_dump(exclude_none=True).items():
+        setattr(config, k, v)
+    logger.info("🧪 Fake Graph config | %s", config.model_dump())
+    return config.model_dump()
+
+
+@app.get("/health")
+def health():
+    return {"ok": True}
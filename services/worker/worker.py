@@ -1,16 +1,26 @@
 from __future__ import annotations
 
 import asyncio
+import json
 import time
 from datetime import datetime, timedelta
+from typing import Optional
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, or_, select, union
 from sqlalchemy.orm import Session
 
 from services.common.logging_config import setup_logging
+from services.common.metrics import metrics
 from services.api.settings import settings
 from services.api.models import Lead, Provider, Customer, ProviderState
-from services.api.whatsapp_cloud import send_text
+from services.api.outbound_dispatcher import PRIORITY_BULK
+from services.api.whatsapp_cloud import dispatcher, send_text
+from services.api.graph_client import graph_client
+from services.api.delivery_tracking import delivery_tracker, turn_context
+from services.api.inbound_retention import run_maintenance
+from services.api.outbox import bind_outbox, outbox_relay
+from services.api.provider_followups import ProviderDigest, pending_questions
+from services.api.upserts import upsert_provider_state
 
 logger = setup_logging("worker")
 
@@ -27,11 +37,21 @@ def _is_due(dt: datetime | None, *, hours: int) -> bool:
     return dt.replace(tzinfo=None) <= (_now() - timedelta(hours=hours))
 
 
-async def _send_contact_followup(db: Session, lead: Lead, provider: Provider):
+def _confirm_pending_to_review(db: Session, status: str, user_col, provider_col) -> list[Lead]:
+    """
+    Leads en `status` con algo que hacer en el tick: recordatorio vencido (24h,
+    range scan sobre ix_leads_followup_due) o alguna respuesta ya registrada.
+    Los que solo esperan respuesta no se cargan.
+    """
+    due = select(Lead.id).where(Lead.status == status, Lead.followup_sent_at <= _now() - timedelta(hours=24))
+    answered = select(Lead.id).where(Lead.status == status, or_(user_col.is_not(None), provider_col.is_not(None)))
+    return db.query(Lead).filter(Lead.id.in_(union(due, answered))).order_by(Lead.id.asc()).all()
+
+
+async def _send_contact_followup(db: Session, lead: Lead, provider: Provider, digest: ProviderDigest):
     lead.status = "CONTACT_CONFIRM_PENDING"
     lead.followup_stage = "CONTACT"
     lead.followup_sent_at = _now()
-    db.commit()
 
     # barrera práctica: quedan bloqueados hasta responder (o hasta que venza el bloqueo, si no responden)
     block_until = _now() + timedelta(days=settings.practical_block_days)
@@ -40,20 +60,10 @@ async def _send_contact_followup(db: Session, lead: Lead, provider: Provider):
     if cust:
         cust.pending_lead_id = lead.id
         cust.blocked_until = block_until
-        db.commit()
 
     provider.blocked_until = block_until
-    db.commit()
 
-    st = db.query(ProviderState).filter(ProviderState.provider_id == provider.id).first()
-    if not st:
-        st = ProviderState(provider_id=provider.id)
-        db.add(st)
-        db.commit()
-        db.refresh(st)
-    st.pending_lead_id = lead.id
-    st.pending_question = "CONTACT"
-    db.commit()
+    upsert_provider_state(db, provider.id, lead.id, "CONTACT")
 
     await send_text(
         lead.customer_wa_id,
@@ -61,42 +71,26 @@ async def _send_contact_followup(db: Session, lead: Lead, provider: Provider):
         "¿Pudiste *contactar* al profesional?\n"
         "Responde:\n1) SI\n2) NO",
     )
-
-    if provider.whatsapp_e164:
-        await send_text(
-            provider.whatsapp_e164,
-            "Seguimiento ConectaPro 👋\n"
-            f"LeadID: {lead.id}\n"
-            "¿Pudiste *contactar* al cliente?\n"
-            "Responde:\n1) SI\n2) NO",
-        )
+    # Al proveedor: una sola pregunta por tick con todos sus leads (digest)
+    digest.add(provider, lead.id, "CONTACT")
+    # Estado y mensajes (outbox) en una sola transacción
+    db.commit()
 
 
-async def _send_service_followup(db: Session, lead: Lead, provider: Provider):
+async def _send_service_followup(db: Session, lead: Lead, provider: Provider, digest: ProviderDigest):
     lead.status = "SERVICE_CONFIRM_PENDING"
     lead.followup_stage = "SERVICE"
     lead.followup_sent_at = _now()
-    db.commit()
 
     block_until = _now() + timedelta(days=settings.practical_block_days)
     cust = db.query(Customer).filter(Customer.wa_id == lead.customer_wa_id).first()
     if cust:
         cust.pending_lead_id = lead.id
         cust.blocked_until = block_until
-        db.commit()
 
     provider.blocked_until = block_until
-    db.commit()
 
-    st = db.query(ProviderState).filter(ProviderState.provider_id == provider.id).first()
-    if not st:
-        st = ProviderState(provider_id=provider.id)
-        db.add(st)
-        db.commit()
-        db.refresh(st)
-    st.pending_lead_id = lead.id
-    st.pending_question = "SERVICE"
-    db.commit()
+    upsert_provider_state(db, provider.id, lead.id, "SERVICE")
 
     await send_text(
         lead.customer_wa_id,
@@ -104,29 +98,20 @@ async def _send_service_followup(db: Session, lead: Lead, provider: Provider):
         "¿Se *realizó* el servicio?\n"
         "Responde:\n1) SI\n2) NO",
     )
-
-    if provider.whatsapp_e164:
-        await send_text(
-            provider.whatsapp_e164,
-            "Seguimiento ConectaPro 👋\n"
-            f"LeadID: {lead.id}\n"
-            "¿Se *realizó* el servicio?\n"
-            "Responde:\n1) SI\n2) NO",
-        )
+    digest.add(provider, lead.id, "SERVICE")
+    db.commit()
 
 
 async def _send_rating_request(db: Session, lead: Lead):
     lead.status = "RATING_PENDING"
     lead.followup_stage = "RATING"
     lead.followup_sent_at = _now()
-    db.commit()
 
     block_until = _now() + timedelta(days=settings.practical_block_days)
     cust = db.query(Customer).filter(Customer.wa_id == lead.customer_wa_id).first()
     if cust:
         cust.pending_lead_id = lead.id
         cust.blocked_until = block_until
-        db.commit()
 
     await send_text(
         lead.customer_wa_id,
@@ -135,6 +120,72 @@ async def _send_rating_request(db: Session, lead: Lead):
         "1-5 estrellas (ej: '5 excelente')\n"
         "0 para omitir",
     )
+    db.commit()
+
+
+_last_maintenance = 0.0
+
+
+_maintenance_task: Optional[asyncio.Task] = None
+
+
+def _run_maintenance_sync() -> None:
+    with Session(engine) as db:
+        run_maintenance(db)
+
+
+async def _run_maintenance() -> None:
+    try:
+        await asyncio.to_thread(_run_maintenance_sync)
+    except Exception:
+        logger.exception("Mantención de inbound falló")
+
+
+def _maybe_run_maintenance():
+    """
+    Particiones + retención de inbound (como mucho una vez cada INBOUND_MAINTENANCE_INTERVAL_MINUTES).
+    Corre en un thread, en segundo plano: el DDL y los prunes por lotes no frenan
+    el relay de outbox, los ticks ni el volcado de métricas.
+    """
+    global _last_maintenance, _maintenance_task
+    now = time.monotonic()
+    if _last_maintenance and now - _last_maintenance < settings.inbound_maintenance_interval_minutes * 60:
+        return
+    if _maintenance_task is not None and not _maintenance_task.done():
+        return
+    _last_maintenance = now
+    _maintenance_task = asyncio.create_task(_run_maintenance(), name="inbound-maintenance")
+
+
+_last_metrics_log = 0.0
+
+
+def _maybe_log_metrics():
+    """Snapshot de métricas del proceso al log (cada WORKER_METRICS_LOG_INTERVAL_MINUTES): el worker no sirve /metrics."""
+    global _last_metrics_log
+    interval = settings.worker_metrics_log_interval_minutes * 60
+    now = time.monotonic()
+    if interval <= 0 or (_last_metrics_log and now - _last_metrics_log < interval):
+        return
+    _last_metrics_log = now
+    logger.info("📊 Métricas worker | %s", json.dumps(metrics.snapshot(), sort_keys=True, default=str))
+
+
+def _pull_forward_reminders(db: Session, digest: ProviderDigest) -> None:
+    """
+    Recordatorios de un proveedor que vencen dentro de PROVIDER_DIGEST_WINDOW_MINUTES
+    viajan en el digest que ya recibe en este tick: sus ciclos de 24h quedan alineados.
+    """
+    hours = 24 - settings.provider_digest_window_minutes / 60.0
+    for provider in digest.providers():
+        already = digest.lead_ids(provider.id)
+        for lead_id, question in pending_questions(db, provider.id).items():
+            if lead_id in already:
+                continue
+            lead = db.get(Lead, lead_id)
+            if lead.followup_sent_at and lead.followup_sent_at.replace(tzinfo=None) <= _now() - timedelta(hours=hours):
+                lead.followup_sent_at = _now()
+                digest.add(provider, lead_id, question, reminder=True)
 
 
 def _clear_provider_state(db: Session, provider_id: int):
@@ -146,21 +197,31 @@ def _clear_provider_state(db: Session, provider_id: int):
 
 
 async def tick():
-    with Session(engine) as db:
+    digest = ProviderDigest()
+    with Session(engine) as db, bind_outbox(db):
         # 1) Programar followup de contacto para leads CONNECTED
-        leads_connected = db.query(Lead).filter(Lead.status == "CONNECTED").all()
+        # (solo los vencidos: range scan sobre ix_leads_connected_due)
+        contact_cutoff = _now() - timedelta(hours=settings.followup_contact_after_hours)
+        leads_connected = (
+            db.query(Lead)
+            .filter(Lead.status == "CONNECTED", Lead.connected_at <= contact_cutoff)
+            .order_by(Lead.connected_at.asc())
+            .all()
+        )
         for lead in leads_connected:
-            if lead.connected_at and _is_due(lead.connected_at, hours=settings.followup_contact_after_hours):
-                if not lead.provider_id:
-                    continue
-                provider = db.query(Provider).filter(Provider.id == lead.provider_id).first()
-                if not provider or not provider.active:
-                    continue
-                logger.info("Followup CONTACT | lead_id=%s", lead.id)
-                await _send_contact_followup(db, lead, provider)
+            if not lead.provider_id:
+                continue
+            provider = db.query(Provider).filter(Provider.id == lead.provider_id).first()
+            if not provider or not provider.active:
+                continue
+            logger.info("Followup CONTACT | lead_id=%s", lead.id)
+            with turn_context(step="FOLLOWUP_CONTACT"):
+                await _send_contact_followup(db, lead, provider, digest)
 
         # 2) Avanzar o cerrar CONTACT_CONFIRM_PENDING
-        leads_contact = db.query(Lead).filter(Lead.status == "CONTACT_CONFIRM_PENDING").all()
+        leads_contact = _confirm_pending_to_review(
+            db, "CONTACT_CONFIRM_PENDING", Lead.user_contact_confirmed, Lead.provider_contact_confirmed
+        )
         for lead in leads_contact:
             if not lead.provider_id:
                 continue
@@ -185,20 +246,24 @@ async def tick():
             # Si ambos confirmaron SI
             if lead.user_contact_confirmed is True and lead.provider_contact_confirmed is True:
                 logger.info("CONTACT ok -> SERVICE | lead_id=%s", lead.id)
-                await _send_service_followup(db, lead, provider)
+                with turn_context(step="FOLLOWUP_SERVICE"):
+                    await _send_service_followup(db, lead, provider, digest)
                 continue
 
             # Si falta respuesta, re-preguntar cada 24h (sin spamear)
             if lead.followup_sent_at and _is_due(lead.followup_sent_at, hours=24):
                 lead.followup_sent_at = _now()
+                with turn_context(step="FOLLOWUP_REMINDER"):
+                    if lead.user_contact_confirmed is None:
+                        await send_text(lead.customer_wa_id, "Recordatorio: responde 1=SI 2=NO ¿Pudiste contactar al profesional?", priority=PRIORITY_BULK)
+                if lead.provider_contact_confirmed is None:
+                    digest.add(provider, lead.id, "CONTACT", reminder=True)
                 db.commit()
-                if lead.user_contact_confirmed is None:
-                    await send_text(lead.customer_wa_id, "Recordatorio: responde 1=SI 2=NO ¿Pudiste contactar al profesional?")
-                if lead.provider_contact_confirmed is None and provider.whatsapp_e164:
-                    await send_text(provider.whatsapp_e164, f"Recordatorio LeadID {lead.id}: responde 1=SI 2=NO ¿Pudiste contactar al cliente?")
 
         # 3) Avanzar o cerrar SERVICE_CONFIRM_PENDING
-        leads_service = db.query(Lead).filter(Lead.status == "SERVICE_CONFIRM_PENDING").all()
+        leads_service = _confirm_pending_to_review(
+            db, "SERVICE_CONFIRM_PENDING", Lead.user_service_confirmed, Lead.provider_service_confirmed
+        )
         for lead in leads_service:
             if not lead.provider_id:
                 continue
@@ -224,28 +289,61 @@ async def tick():
                 _clear_provider_state(db, provider.id)
                 provider.blocked_until = None
                 db.commit()
-                await _send_rating_request(db, lead)
+                with turn_context(step="FOLLOWUP_RATING"):
+                    await _send_rating_request(db, lead)
                 continue
 
             if lead.followup_sent_at and _is_due(lead.followup_sent_at, hours=24):
                 lead.followup_sent_at = _now()
+                with turn_context(step="FOLLOWUP_REMINDER"):
+                    if lead.user_service_confirmed is None:
+                        await send_text(lead.customer_wa_id, "Recordatorio: responde 1=SI 2=NO ¿Se realizó el servicio?", priority=PRIORITY_BULK)
+                if lead.provider_service_confirmed is None:
+                    digest.add(provider, lead.id, "SERVICE", reminder=True)
                 db.commit()
-                if lead.user_service_confirmed is None:
-                    await send_text(lead.customer_wa_id, "Recordatorio: responde 1=SI 2=NO ¿Se realizó el servicio?")
-                if lead.provider_service_confirmed is None and provider.whatsapp_e164:
-                    await send_text(provider.whatsapp_e164, f"Recordatorio LeadID {lead.id}: responde 1=SI 2=NO ¿Se realizó el servicio?")
+
+        # 4) Un mensaje por proveedor con todo lo que venció en este tick
+        if digest:
+            _pull_forward_reminders(db, digest)
+            with turn_context(step="FOLLOWUP_DIGEST"):
+                await digest.flush()
+            db.commit()
+
+    # Espera a que salgan los envíos del tick y registra sus wamid
+    try:
+        if outbox_relay.running:
+            await asyncio.wait_for(outbox_relay.drain(), timeout=60)
+        else:
+            await asyncio.wait_for(dispatcher.drain(), timeout=60)
+    except asyncio.TimeoutError:
+        logger.warning("Envíos pendientes tras el tick; siguen en la cola de salida")
+    await delivery_tracker.flush()
+
+
+async def run_forever():
+    # Un solo event loop para todo el proceso: el cliente HTTP de la Graph API
+    # (graph_client) conserva sus conexiones keep-alive entre ticks.
+    if settings.outbox_enabled:
+        await outbox_relay.start(dispatcher)
+    try:
+        while True:
+            _maybe_run_maintenance()
+            try:
+                await tick()
+            except Exception:
+                logger.exception("Worker tick falló")
+            _maybe_log_metrics()
+            await asyncio.sleep(30)
+    finally:
+        await outbox_relay.stop()
+        await dispatcher.stop()
+        await graph_client.aclose()
 
 
 def main():
     logger.info("Worker iniciado")
     time.sleep(3)
-
-    while True:
-        try:
-            asyncio.run(tick())
-        except Exception:
-            logger.exception("Worker tick falló")
-        time.sleep(30)
+    asyncio.run(run_forever())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from services.api.conversation_executor import ConversationExecutor
+from services.api.webhook_payload import InboundEvent
+
+
+def _event(wa_id, text):
+    return InboundEvent(wa_id=wa_id, msg_id=f"{wa_id}-{text}", type="text", text=text)
+
+
+def test_same_wa_id_runs_in_order_one_at_a_time():
+    log = []
+    running = {}
+
+    async def handler(wa_id, item):
+        running[wa_id] = running.get(wa_id, 0) + 1
+        assert running[wa_id] == 1
+        log.append((wa_id, item.text))
+        await asyncio.sleep(0.01)
+        running[wa_id] -= 1
+        return item.text
+
+    async def scenario():
+        executor = ConversationExecutor(handler, max_concurrency=4)
+        futs = [executor.submit("569111", _event("569111", t)) for t in ("1", "2", "3")]
+        assert await asyncio.gather(*futs) == ["1", "2", "3"]
+        await asyncio.sleep(0)
+        assert executor.queue_depth() == 0
+        assert not executor._lanes
+
+    asyncio.run(scenario())
+    assert log == [("569111", "1"), ("569111", "2"), ("569111", "3")]
+
+
+def test_different_wa_ids_run_concurrently():
+    started = []
+    release = None
+
+    async def handler(wa_id, item):
+        started.append(wa_id)
+        await release.wait()
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        executor = ConversationExecutor(handler, max_concurrency=4)
+        futs = [executor.submit(wa_id, _event(wa_id, "hola")) for wa_id in ("569111", "569222")]
+        await asyncio.sleep(0.01)
+        assert sorted(started) == ["569111", "569222"]
+        release.set()
+        await asyncio.gather(*futs)
+
+    asyncio.run(scenario())
+
+
+def test_failure_resolves_its_future_and_lane_continues():
+    async def handler(wa_id, item):
+        if item.text == "boom":
+            raise RuntimeError("boom")
+        return item.text
+
+    async def scenario():
+        executor = ConversationExecutor(handler, max_concurrency=1)
+        bad = executor.submit("569111", _event("569111", "boom"))
+        good = executor.submit("569111", _event("569111", "ok"))
+        with pytest.raises(RuntimeError):
+            await bad
+        assert await good == "ok"
+
+    asyncio.run(scenario())
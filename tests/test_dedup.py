@@ -0,0 +1,31 @@
+from services.api import dedup
+from services.api.dedup import RecentIdCache
+
+
+def test_evicts_least_recently_used():
+    cache = RecentIdCache(max_size=2, ttl_seconds=60)
+    cache.add("a")
+    cache.add("b")
+    assert "a" in cache  # "a" pasa a ser el más reciente
+    cache.add("c")
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert len(cache) == 2
+
+
+def test_expires_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup.time, "monotonic", lambda: now[0])
+    cache = RecentIdCache(max_size=10, ttl_seconds=5)
+    cache.add(("569111", "wamid.1"))
+    now[0] += 4
+    assert ("569111", "wamid.1") in cache
+    now[0] += 2
+    assert ("569111", "wamid.1") not in cache
+    assert len(cache) == 0
+
+
+def test_add_many_keeps_the_newest():
+    cache = RecentIdCache(max_size=3, ttl_seconds=60)
+    cache.add_many(range(5))
+    assert [k for k in range(5) if k in cache] == [2, 3, 4]
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from services.api import inbound_queue
+from services.api.models import InboundQueueItem
+
+
+@pytest.fixture
+def queue_db(monkeypatch):
+    # Una sola conexión compartida: _process_item escribe desde asyncio.to_thread
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    InboundQueueItem.__table__.create(engine)
+    Session = sessionmaker(bind=engine)
+    monkeypatch.setattr(inbound_queue, "SessionLocal", Session)
+    monkeypatch.setattr(inbound_queue.settings, "conversation_coalesce_ms", 10)
+    monkeypatch.setattr(inbound_queue.settings, "conversation_coalesce_max_ms", 50)
+    return Session
+
+
+def _enqueue(Session, wa_id, *texts):
+    with Session() as db:
+        for i, text in enumerate(texts):
+            inbound_queue.enqueue_message(
+                db, wa_id=wa_id, msg_id=f"{wa_id}-{i}", text=text, raw_message={"type": "text"}
+            )
+        db.commit()
+
+
+def _statuses(Session):
+    with Session() as db:
+        return db.execute(select(InboundQueueItem.text, InboundQueueItem.status).order_by(InboundQueueItem.id)).all()
+
+
+def test_claims_only_oldest_pending_per_wa_id(queue_db):
+    _enqueue(queue_db, "569111", "hola", "necesito gasfiter")
+    _enqueue(queue_db, "569222", "buenas")
+    claimed = inbound_queue._claim_batch(10)
+    assert [(r["customer_wa_id"], r["text"]) for r in claimed] == [("569111", "hola"), ("569222", "buenas")]
+    # Con 569111 en PROCESSING, su segundo mensaje no se entrega
+    assert inbound_queue._claim_batch(10) == []
+
+
+def test_consecutive_texts_run_as_one_turn(queue_db, monkeypatch):
+    _enqueue(queue_db, "569111", "hola", "necesito un gasfiter", "1")
+    turns = []
+
+    def submit(wa_id, turn):
+        turns.append((wa_id, turn))
+        fut = asyncio.get_running_loop().create_future()
+        fut.set_result(None)
+        return fut
+
+    monkeypatch.setattr(inbound_queue.executor, "submit", submit)
+
+    [head] = inbound_queue._claim_batch(10)
+    asyncio.run(inbound_queue._process_item(head))
+
+    assert len(turns) == 1
+    wa_id, turn = turns[0]
+    assert wa_id == "569111"
+    assert turn.text == "hola necesito un gasfiter"
+    assert turn.msg_id == "569111-1"
+    # La respuesta de menú queda para su propio turno
+    assert _statuses(queue_db) == [("hola", "DONE"), ("necesito un gasfiter", "DONE"), ("1", "PENDING")]
+
+
+def test_menu_answer_is_not_merged(queue_db, monkeypatch):
+    _enqueue(queue_db, "569111", "2", "hola")
+    turns = []
+
+    def submit(wa_id, turn):
+        turns.append(turn.text)
+        fut = asyncio.get_running_loop().create_future()
+        fut.set_result(None)
+        return fut
+
+    monkeypatch.setattr(inbound_queue.executor, "submit", submit)
+
+    [head] = inbound_queue._claim_batch(10)
+    asyncio.run(inbound_queue._process_item(head))
+    assert turns == ["2"]
+    assert _statuses(queue_db) == [("2", "DONE"), ("hola", "PENDING")]
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import os
+
+from sqlalchemy.exc import OperationalError
+
+from services.api.inbound_spool import MAX_LINE_FAILURES, InboundSpool
+from services.api.webhook_payload import InboundEvent
+
+
+def _events(*texts):
+    return [InboundEvent(wa_id="569111", msg_id=f"wamid.{t}", type="text", text=t) for t in texts]
+
+
+async def _started(tmp_path, handler):
+    # replay_interval alto: el replayer de fondo queda dormido y los tests llaman _replay_pass() a mano
+    spool = InboundSpool(str(tmp_path), fsync_ms=0, replay_interval_s=3600, replay_batch=2)
+    await spool.start(handler)
+    await asyncio.sleep(0)
+    return spool
+
+
+def test_replays_segments_in_order_and_clears_backlog(tmp_path):
+    seen = []
+
+    async def handler(events):
+        seen.extend(e.text for e in events)
+
+    async def scenario():
+        spool = await _started(tmp_path, handler)
+        try:
+            await spool.append(_events("a", "b", "c"))
+            assert spool.backlogged
+            assert await spool._replay_pass()
+            await spool.append(_events("d"))  # va a un segmento nuevo
+            assert await spool._replay_pass()
+            assert await spool._replay_pass()
+            assert not spool.backlogged
+        finally:
+            await spool.stop()
+
+    asyncio.run(scenario())
+    assert seen == ["a", "b", "c", "d"]
+    assert os.listdir(tmp_path) == []
+
+
+def test_db_outage_pauses_and_resumes_from_the_same_line(tmp_path):
+    seen = []
+    down = [True]
+
+    async def handler(events):
+        if down[0] and any(e.text == "c" for e in events):
+            raise OperationalError("INSERT", {}, ConnectionError("db down"))
+        seen.extend(e.text for e in events)
+
+    async def scenario():
+        spool = await _started(tmp_path, handler)
+        try:
+            await spool.append(_events("a", "b", "c", "d"))
+            assert not await spool._replay_pass()
+            assert spool.backlogged
+            down[0] = False
+            assert await spool._replay_pass()
+        finally:
+            await spool.stop()
+
+    asyncio.run(scenario())
+    assert seen == ["a", "b", "c", "d"]
+
+
+def test_poison_line_goes_to_dead_letter(tmp_path):
+    seen = []
+
+    async def handler(events):
+        if any(e.text == "bad" for e in events):
+            raise ValueError("bad event")
+        seen.extend(e.text for e in events)
+
+    async def scenario():
+        spool = await _started(tmp_path, handler)
+        try:
+            await spool.append(_events("a", "bad", "c"))
+            for _ in range(MAX_LINE_FAILURES - 1):
+                assert not await spool._replay_pass()
+            assert await spool._replay_pass()
+            assert await spool._replay_pass()
+            assert not spool.backlogged
+        finally:
+            await spool.stop()
+
+    asyncio.run(scenario())
+    assert seen == ["a", "c"]
+    assert os.listdir(tmp_path) == ["dead-letter.jsonl"]
+    with open(tmp_path / "dead-letter.jsonl", "rb") as fh:
+        [line] = fh.read().splitlines()
+    assert json.loads(line)["text"] == "bad"
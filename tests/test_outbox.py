@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from services.api import outbox
+from services.api.models import OutboxMessage
+from services.api.outbox import MAX_TEXT_BODY, TEXT_JOINER, buffer_send
+
+
+class _FakeSession:
+    def __init__(self):
+        self.info = {}
+
+
+def _text(to, body):
+    return {"messaging_product": "whatsapp", "to": to, "type": "text", "text": {"body": body}}
+
+
+def _send(db, to, payload, kind="text", priority=0, phone_number_id="pn1"):
+    return buffer_send(db, to_wa_id=to, kind=kind, payload=payload, phone_number_id=phone_number_id, priority=priority)
+
+
+def _buffer(db):
+    return db.info[outbox._BUFFER_KEY]
+
+
+def test_consecutive_texts_to_one_recipient_are_merged():
+    db = _FakeSession()
+    assert _send(db, "569111", _text("569111", "Hola"), priority=5)["coalesced"] is False
+    assert _send(db, "569111", _text("569111", "¿Qué comuna?"), priority=1)["coalesced"] is True
+    [send] = _buffer(db)
+    assert send.payload["text"]["body"] == "Hola" + TEXT_JOINER + "¿Qué comuna?"
+    assert send.priority == 1
+    assert send.parts == 2
+
+
+def test_merges_with_the_last_send_of_the_same_recipient():
+    db = _FakeSession()
+    _send(db, "569111", _text("569111", "a"))
+    _send(db, "569222", _text("569222", "b"))
+    _send(db, "569111", _text("569111", "c"))
+    assert [(s.to_wa_id, s.payload["text"]["body"]) for s in _buffer(db)] == [
+        ("569111", "a" + TEXT_JOINER + "c"),
+        ("569222", "b"),
+    ]
+
+
+def test_non_text_sends_break_the_merge():
+    db = _FakeSession()
+    _send(db, "569111", _text("569111", "a"))
+    _send(db, "569111", {"messaging_product": "whatsapp", "type": "interactive"}, kind="list")
+    _send(db, "569111", _text("569111", "b"))
+    assert [s.kind for s in _buffer(db)] == ["text", "list", "text"]
+
+
+def test_no_merge_over_body_limit_or_across_sender_numbers():
+    db = _FakeSession()
+    _send(db, "569111", _text("569111", "x" * (MAX_TEXT_BODY - 1)))
+    _send(db, "569111", _text("569111", "y"))
+    _send(db, "569111", _text("569111", "z"), phone_number_id="pn2")
+    assert len(_buffer(db)) == 3
+
+
+@pytest.fixture
+def outbox_db(monkeypatch):
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    OutboxMessage.__table__.create(engine)
+    Session = sessionmaker(bind=engine)
+    monkeypatch.setattr(outbox, "SessionLocal", Session)
+    return Session
+
+
+def _rows(Session):
+    with Session() as db:
+        return db.execute(select(OutboxMessage.id, OutboxMessage.status).order_by(OutboxMessage.id)).all()
+
+
+def test_claims_only_the_oldest_row_per_recipient(outbox_db):
+    with outbox_db() as db:
+        for to in ("569111", "569111", "569222"):
+            db.add(OutboxMessage(to_wa_id=to, kind="text", payload=_text(to, "hola"), status="PENDING"))
+        db.commit()
+    assert [(r["id"], r["to_wa_id"]) for r in outbox._claim_batch(10)] == [(1, "569111"), (3, "569222")]
+    assert outbox._claim_batch(10) == []
+
+
+def test_abandoned_sending_rows_are_requeued_until_max_attempts(outbox_db, monkeypatch):
+    monkeypatch.setattr(outbox.settings, "outbox_max_attempts", 2)
+    with outbox_db() as db:
+        for to in ("569111", "569222", "569333"):
+            db.add(OutboxMessage(to_wa_id=to, kind="text", payload=_text(to, "hola"), status="PENDING"))
+        db.commit()
+    outbox._claim_batch(10)
+    with outbox_db() as db:
+        db.execute(update(OutboxMessage).values(claimed_at=datetime.utcnow() - timedelta(hours=1)))
+        db.execute(update(OutboxMessage).where(OutboxMessage.id == 2).values(attempts=2))
+        db.commit()
+    # La fila 3 sigue en vuelo en este relay: no está abandonada
+    outbox._housekeeping([3])
+    assert _rows(outbox_db) == [(1, "PENDING"), (2, "FAILED"), (3, "SENDING")]
@@ -0,0 +1,32 @@
+from services.api.provider_followups import parse_reply
+
+PENDING = {3: "CONTACT", 12: "SERVICE", 15: "CONTACT"}
+
+
+def test_one_answer_per_line():
+    text = "12 SI\n15: no\n#3 1"
+    assert parse_reply(text, PENDING) == {12: True, 15: False, 3: True}
+
+
+def test_separators_and_case():
+    assert parse_reply("12-sí", PENDING) == {12: True}
+    assert parse_reply("12) NO.", PENDING) == {12: False}
+    assert parse_reply("  15 = 2  ", PENDING) == {15: False}
+
+
+def test_free_text_is_not_an_answer():
+    assert parse_reply("llego a las 3 no puedo", PENDING) == {}
+    assert parse_reply("el 12 si pero mañana", PENDING) == {}
+
+
+def test_requires_separator_between_id_and_answer():
+    assert parse_reply("31", {3: "CONTACT"}) == {}
+
+
+def test_only_pending_lead_ids():
+    assert parse_reply("99 SI\n12 no", PENDING) == {12: False}
+
+
+def test_empty_text():
+    assert parse_reply("", PENDING) == {}
+    assert parse_reply(None, PENDING) == {}